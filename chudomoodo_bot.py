@@ -8,24 +8,41 @@ Telegram-бот "Дневник маленьких радостей".
 - ЕЖЕДНЕВНЫЙ РЕЖИМ:
     - в 20:00 — напоминание, если за день не было ни одной радости;
     - в 22:00 — отчёт с радостями за текущего дня;
+    - время и часовой пояс у каждого свои (/settings), рассылка
+      размазывается по окну в несколько минут;
 - защита от тоски: отдельные реакции на грусть, усталость, тревогу, тяжёлые фразы;
 - спокойные тексты-ответы с одним эмодзи в начале;
-- статистика по команде /stats;
+- статистика по команде /stats (всего, за неделю, серии дней подряд);
 - письмо себе в будущее по команде /letter с возможностью отмены /cancel;
 - расширенные словари грусти, усталости, тревоги и «не знаю, что написать»;
 - более широкое распознавание приветствий, включая опечатки и раскладку;
-- отчёт wantnow со всеми записанными радостями;
+- отчёт wantnow со всеми записанными радостями (по страницам, «wantnow 2» или кнопки);
 - на одно сообщение — один ответ (без дублирующих реакций).
+- приём updates через long polling или webhook (встроенный HTTP-сервер).
 """
 
 import os
+import sys
 import time
 import sqlite3
 import threading
 import random
 import re
 import json
-from datetime import datetime, timedelta, date
+import argparse
+import bisect
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
+import queue
+import secrets
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta, date, time as dtime, timezone
 
 # Таймзона Минска с защитой: на некоторых хостингах нет tzdata / другой Python
 try:
@@ -39,12 +56,10 @@ def now_minsk() -> datetime:
         return datetime.now(MINSK_TZ)
     return datetime.now()
 
-def today_minsk() -> date:
-    return now_minsk().date()
-
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Iterable, Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
 
 # --------------------------
 # CONFIG
@@ -60,392 +75,151 @@ DB_PATH = os.path.join(os.path.dirname(__file__), "joys.db")
 POLL_TIMEOUT = 30
 POLL_SLEEP = 1
 
-# --------------------------
-# СЛОВАРИ (паттерны)
-# --------------------------
-
-# Расширенный список матов и "жёсткой" лексики (корни)
-BAD_WORDS = [
-    "хуй", "хуи", "хуе", "хуё", "хуя", "хуем", "хуйн", "хуит", "хуяр",
-    "хер", "хрен", "хрена", "хренов", "хренот", "хренотень",
-    "пизд", "пизда", "пиздец", "пезд", "пидор", "пидар", "педрила",
-    "еба", "ебу", "ебё", "ебе", "ебан", "ёбн", "ебло", "ебальн", "выеб",
-    "еблись", "ебуч", "ебанут", "доеб", "заеб", "заёб", "заипал", "заипали",
-    "сука", "суки", "сучк", "сучар", "сучонок",
-    "бляд", "бля", "блят", "бляха", "бляха-муха", "бляха муха",
-    "мразь", "тварь", "тварн", "скотина", "ублюд", "уебк", "уёбк",
-    "гандон", "презик", "конча", "конченный", "конченый",
-    "хуйня", "хуёв", "хренот", "говно", "говн", "дерьм", "срака",
-    "сука-блять", "сука блять", "долбоеб", "долбоёб", "дебил", "идиот",
-    "кретин", "мудак", "мудила", "чмо", "чмошн", "козлина", "урод", "уродин",
-    "шлюх", "проститут", "шалав", "траха", "трахну", "срать", "срал", "насрать", "насрал",
-    "бесишь", "морда кирпичом", "иди в жопу", "пошел в жопу", "пошла в жопу",
-    "блять", "блядь", "блядина", "блядство", "блядюга", "ебись", "ёбись", "ёбнутый",
-    "выебнулся", "долбаёб", "долбоёбина", "заебись", "заёбись", "заебали", "заебало",
-    "заебал", "заебала", "заебанный", "наебнуться", "наебать", "наебаться",
-    "отъебись", "отъебище", "поебать", "поебень", "подъеб", "подъебать",
-    "разъебать", "разъебанный", "съебать", "съебаться", "уебать", "уебаться", "уёбище",
-    "хуев", "хуёвый", "хуёвина", "хуета", "хуетень", "хуило", "хуила", "хуище",
-    "хуйло", "хуйня", "хуйцово", "хуй знает", "похуй", "нахуй", "нихуя", "нихуя себе",
-    "охуеть", "охуительно", "похуист", "херня", "херово", "херовый", "хер знает",
-    "пиздец", "пиздецовый", "пиздёж", "пиздовать", "пиздолиз", "пиздолюб",
-    "пиздострадалец", "пиздоха", "пиздюк", "пиздюлина", "пиздюля", "распиздяй",
-    "спиздить", "упиздить", "бздеть", "бзднуть", "обосрать", "обосраться",
-    "посрать", "срака", "сраку", "сраный", "срань", "срач", "срачка",
-    "засранец", "засранка", "пердеть", "пердун", "пердунья", "пердак",
-    "дерьмо", "дерьмовый", "залупа", "залупень", "мусор", "мусорный",
-    "отброс", "падла", "падлюка", "сволочь", "сволочи", "стерва", "стервоза",
-    "тварина", "ублюдок", "уродина", "уродка", "выродок", "дегенерат",
-    "дебилоид", "имбецил", "олигофрен", "даун", "дауняра", "отморозок",
-    "погань", "поганый", "подонок", "подонки", "подлец", "подлый",
-    "предатель", "продажный", "продажник", "сукин сын", "сукина дочь",
-    "ебаный в рот", "ёбаный в рот", "ёб твою мать", "пошёл на хуй", "пошла на хуй",
-    "иди на хуй", "пошёл в пизду", "иди в пизду", "пошёл к чёрту", "иди к чёрту",
-    "чёрт побери", "чёрт возьми", "дьявол", "сатана", "проклятие",
-    "проклятый", "проклятая", "адовый", "адский", "дьявольский", "бесовский",
-    "бес", "нечисть", "чертов", "чёртов", "окаянный", "греховный", "грешный",
-    "порочный", "развратный", "блуд", "блудник", "блудница", "похотливый",
-    "сладострастный", "похоть", "вожделение", "срам", "срамной", "сквернословие",
-    "матерщинник", "матерщина", "матерный", "нецензурный", "непечатный",
-    "неприличный", "непристойный", "непотребный", "вульгарный", "грубый",
-    "хамский", "нахальный", "наглый", "бесстыжий", "беспардонный", "наглец",
-    "нахал", "хам", "грубиян", "невежа", "невоспитанный", "некультурный",
-    "деревенщина", "быдло", "плебей", "чернь", "простонародье", "совковый",
-    "совок", "ватник", "гомофоб", "трансфоб", "расист", "нацист", "фашист",
-    "шовинист", "ксенофоб", "антисемит", "мизогин", "эйджист", "дискриминатор",
-    "угнетатель", "эксплуататор", "тиран", "деспот", "диктатор", "тоталитарист",
-    "репрессивный", "цензура", "пропагандист", "демагог", "популист", "фанатик",
-    "экстремист", "террорист", "сепаратист", "коллаборационист", "шпион",
-    "диверсант", "саботажник", "вредитель", "изменник", "предатель родины",
-    "враг народа", "диссидент", "инакомыслящий", "еретик", "отступник",
-    "богохульник", "кощунник", "святотатец", "нечестивец"
-]
-
-# Грусть, тоска, пустота, одиночество (частично сокращено)
-SAD_PATTERNS = [
-    "ничего хорошего не было", "ничего хорошего сегодня не было", "ничего хорошего",
-    "ничего не радует", "ничто не радует", "всё плохо", "все плохо", "все ужасно",
-    "всё ужасно", "совсем плохо", "ужасный день", "отвратительный день", "день говно",
-    "день отстой", "день был ужасный", "день не задался", "день коту под хвост",
-    "всё бесит", "все бесит", "все раздражает", "всё раздражает", "плохо", "очень плохо",
-    "крайне плохо", "тяжело", "очень тяжело", "душно внутри", "грустно", "очень грустно",
-    "мне грустно", "мне очень грустно", "тоскливо", "мне тоскливо", "хреново", "фигово",
-    "отстойно", "мерзко на душе", "депрессивно", "депрессия накрыла", "депрессняк",
-    "душа ноет", "ничего не хочется", "не хочу ничего", "ничего не могу", "нет желания вообще",
-    "нет настроения", "ужас", "разочарование", "сплошное разочарование", "одиночество",
-    "чувствую себя одиноко", "мне одиноко", "я одна", "я один", "осталась одна", "остался один",
-    " никому не нужна", "никому не нужен", "меня никто не понимает", " никто не понимает",
-    "меня не слышат", "я реву", "я плачу", "хочу плакать", "плакать хочется", "рыдаю",
-    "опять сорвалась в слезы", "опять плачу", "сердце болит", "на душе тяжело", "на душе пусто",
-    "внутри пусто", "как будто пустота", "очень пусто внутри", "не вижу радости", "радости нет",
-    "нет ничего хорошего", "не за что зацепиться", "не к чему прижаться внутри", "все серое",
-    "сплошная серая масса", "ощущение безысходности", "безысходность", "чувствую себя разбитой",
-    "чувствую себя разбитым", "разбитое состояние", "все пропало", "всё пропало", "все кончено",
-    "всё кончено", "нет выхода", "не вижу выхода", "безвыходная ситуация", "опускаются руки",
-    "руки опускаются", "опустил руки", "опустила руки", "нет надежды", "надежды нет",
-    "потерял надежду", "потеряла надежду", "все бессмысленно", "всё бессмысленно",
-    "жизнь бессмысленна", "нет сил бороться", "не могу бороться", "устал бороться",
-    "устала бороться", "все надоело", "всё надоело", "жизнь надоела", "все достало",
-    "нет радости", "радости не чувствую", "не могу радоваться", "постоянно плачу",
-    "слезы наворачиваются", "готов расплакаться", "внутренняя боль", "душевная боль",
-    "боль в душе", "сердце разрывается", "чувствую себя ненужным", "чувствую себя ненужной",
-    "ощущаю свою ненужность", " никто не ценит", "меня не ценит", "не ценят мои усилия",
-    "потерял смысл", "потеряла смысл", "смысл жизни потерян", "все валится из рук",
-    "всё валится из рук", "ничего не получается", "постоянные неудачи", "одни неудачи",
-    "не везет", "чувствую себя неудачником", "я неудачник", "я неудачница", "все против меня",
-    "всё против меня", "мир против меня", "несправедливо", "жизнь несправедлива",
-    "все несправедливо", "потерял веру", "потеряла веру", "вера потеряна", "все рухнуло",
-    "всё рухнуло", "мир рухнул", "нет поддержки", "не на кого опереться", "некому помочь",
-    "один на один с проблемами", "одна на одна с проблемами", "все сложно", "всё сложно",
-    "слишком сложно", "не могу справиться", "не справляюсь", "не выдерживаю", "постоянный стресс",
-    "хронический стресс", "живу в стрессе", "нет покоя", "покоя нет", "не могу успокоиться",
-    "все раздражает", "всё раздражает", "раздражают все", "нет терпения", "терпения нет",
-    "потерял терпение", "чувствую себя загнанным", "чувствую себя загнанной", "в тупике",
-    "зашел в тупик", "зашла в тупик", "нет перспектив", "перспектив нет", "будущее пугает","печально",
-    "печаль",
-    "печалька",
-    "грусть",
-    "грустно",
-    "тоскливо",
-    "тоска",
-    "печль",
-]
-
-# Усталость, выгорание
-TIRED_PATTERNS = [
-    "устала", "устал", "я так устала", "я так устал", "очень устала", "очень устал",
-    "сильно устала", "сильно устал", "сегодня вообще без сил", "сегодня нет сил", "сил нет",
-    "нет сил", "ни на что нет сил", "совсем нет сил", "ни капли сил", "я вымоталась", "я вымотался",
-    "вымоталась", "вымотался", "выгорела", "выгорел", " я выгорела", " я выгорел", "эмоционально выгорела",
-    "эмоционально выгорел", "морально устала", "морально устал", "я очень устала морально",
-    "я очень устал морально", "обессилена", "обессилен", "обессиленный", "обессиленная", "мне тяжело",
-    "очень тяжело", "невыносимо тяжело", "чувствую сильную усталость", "чувствую усталость",
-    "никаких сил", "сил буквально ноль", "пустая как выжатый лимон", "как выжатый лимон",
-    "просто нет энергии", "энергия на нуле", "истощена", "истощен", "очень истощена", "очень истощен",
-    "не могу больше", "не могу тянуть", "не тяну", "не хочу ничего делать", "нет ресурса",
-    "нет ресурса вообще", "надоело все тащить", "слишком много нагрузки", "нет больше сил",
-    "силы на исходе", "на пределе", "выжата как лимон", "выжат как лимон", "выжатый лимон",
-    "батарейка села", "энергия на нуле", "разрядился", "упадок сил", "упадок энергии", "нет бодрости",
-    "постоянная усталость", "хроническая усталость", "синдром хронической усталости", "цфс",
-    "фибромиалгия", "боли от усталости", "мышечная слабость", "ноги не держат", "руки не поднимаются",
-    "тяжело двигаться", "нет тонуса", "мышцы вялые", "тело ватное", "разбитость", "ощущение разбитоности",
-    "разбитый корытом", "разбитая корытом", "устал как собака", "устала как собака", "усталость с утра",
-    "просыпаюсь уставшим", "не выспалась", "не выспался", "недосып", "бессонница", "плохо сплю",
-    "нарушения сна", "прерывистый сон", "не могу уснуть", "раннее пробуждение", "дневная сонливость",
-    "хочется спать днем", "засыпаю на ходу", "клюю носом", "борюсь со сном", "кофе не помогает",
-    "энергетики не работают", "нет концентрации", "не могу сосредоточиться", "мозг не работает",
-    "мысли путаются", "туман в голове", "мозговой туман", "когнитивные нарушения", "память ухудшилась",
-    "внимание рассеяно", "рассеянность", "забывчивость", "все забываю", "медленно соображаю",
-    "туго думается", "умственная усталость", "интеллектуальное истощение", "творческое истощение",
-    "нет вдохновения", "выгорание на работе", "профессиональное выгорание", "эмоциональное истощение",
-    "нет эмоциональных сил", "апатия", "безразличие", "ничего не чувствую", "эмоциональная пустота",
-    "чувствую себя пустым", "нет мотивации", "демотивация", "ничего не хочется", "прокрастинация",
-    "откладываю все", "не могу заставить себя", "нет воли", "сила воли на нуле", "самодисциплина отсутствует",
-    "лень", "лень что-либо делать", "общая лень", "физическое истощение", "тело истощено",
-    "истощение ресурсов", "резервы исчерпаны", "перетренированность", "слишком много тренировок",
-    "спортивная усталость", "мышцы не восстанавливаются", "боль в мышцах", "крепатура", "мышцы болят",
-    "суставы болят", "кости ноют", "все тело болит", "головная боль от усталости", "голова раскалывается",
-    "мигрень", "сильная головная боль", "головокружение", "кружится голова", "тошнота от усталости",
-    "подташнивает", "снижение иммунитета", "часто болею", "простуды", "постоянно простужаюсь",
-    "обострение хронических болезней", "болячки вылезают", "проблемы с пищеварением", "желудок шалит"
-]
-
-# Тревога, страх, паника (сокращённый список)
-ANXIETY_PATTERNS = [
-    "боюсь", "очень боюсь", "безумно боюсь", "мне страшно", "страшно", "дико страшно",
-    "переживаю", "очень переживаю", "сильно переживаю", "я переживаю", "я опять переживаю",
-    "тревожно", "очень тревожно", "дико тревожно", "меня трясет", "меня трясёт", "паника",
-    "паническую", "панически", "паническая атака", "паникую", "опять паникую", "вдруг не получится",
-    "вдруг всё испорчу", "вдруг всё пойдет не так", "вдруг всё пойдёт не так", "я не уверена",
-    "я не уверен", " я не уверена в себе", "я не уверен в себе", "я сомневаюсь", "сомневаюсь в себе",
-    "волнуюсь", "я волнуюсь", "очень волнуюсь", "я все испортила", "я все испортил", "я всё испортила",
-    "я всё испортил", "боюсь ошибиться", "боюсь сделать ошибку", "страх, что не справлюсь",
-    "боюсь, что не справлюсь", "страх будущего", "страшно за будущее", "сердце колотится",
-    "сердце стучит слишком сильно", "руки трясутся", "мне тяжело дышать от тревоги",
-    "как будто всё валится", "ощущение, что всё рухнет", "мне не по себе", "очень не по себе",
-    "тревожные мысли", "навязчивые мысли", "не могу перестать думать", "постоянное беспокойство",
-    "вечно переживаю", "тревожусь по любому поводу", "социальная тревожность", "боюсь людей",
-    "страх общения", "панические атаки", "приступы паники", "внезапный страх", "сердце выскакивает",
-    "пульс зашкаливает", "не хватает воздуха", "задыхаюсь", "одышка от страха", "тошнота от тревоги",
-    "мутит от страха", "головокружение", "земля уходит из-под ног", "все плывет",
-]
-
-# Очень тяжёлые фразы
-SEVERE_SAD_PATTERNS = [
-    "не хочу жить", "не хочу больше жить", "нет смысла жить", "не вижу смысла жить",
-    "не вижу смысла", "нет смысла", "жизнь бессмысленна", "жизнь не имеет смысла",
-    "ненавижу свою жизнь", "ненавижу жизнь", "хочу умереть", "хочу просто исчезнуть",
-    "лучше бы меня не было", "лучше бы я не родилась", "лучше бы я не родился",
-    "не хочу существовать", "не хочу ничего чувствовать", "я ничтожество", "я никчемная",
-    "я никчемный", "я бесполезная", "я бесполезный", "ненавижу себя", "себя ненавижу",
-    "ненавижу всё", "ненавижу всех", "никому не нужна", "никому не нужен", " никто меня не любит",
-    "меня никто не любит", "никто меня не слышит вообще", "мне кажется, что всем без разницы",
-    "всем плевать на меня", "не хочу просыпаться", "не хочу вставать по утрам", "больше не вижу выхода",
-    "хочу покончить с собой", "думаю о самоубийстве", "суицидальные мысли", "планирую суицид",
-    "готовлюсь к суициду", "решил покончить с собой", "решила покончить с собой", "не хочу больше так жить",
-    "все равно умру", "скоро умру", "жду смерти", "смерть будет избавлением", "лучше умереть",
-    "проще умереть", "не вижу света в конце тоннеля", "потерял надежду на улучшение",
-    "надежды больше нет", "все кончено", "все пропало", "жизнь закончена", " я обуза для всех",
-    "я только мешаю", "всем будет лучше без меня", "я недостоин жить", "не заслуживаю жизни",
-    "не имею права жить", "мир станет лучше без меня", " никто не заметит моего отсутствия",
-    "я уже мертв внутри", "внутри все умерло", "душа мертва", "не чувствую себя живым",
-    "существую но не живу", "жизнь - это боль", "сплошные страдания", "одна боль", "не выдерживаю больше",
-    "больше не могу терпеть", "дошел до предела", "дошла до предела", "на грани",
-    "собираюсь совершить суицид", "планирую уйти из жизни"
-]
-
-# Нейтральные/пустые фразы «не знаю, что написать»
-NO_JOY_PATTERNS = [
-    "не знаю что написать", "не знаю, что написать", "не знаю что писать", "не знаю, что писать",
-    "не знаю что еще написать", "не знаю, что ещё написать", "не знаю что еще писать", "не знаю, что ещё писать",
-    "вообще не знаю что написать", "вообще не знаю, что написать", "вообще не знаю что писать",
-    "вообще не знаю, что писать", "не знаю как писать", "не знаю о чем писать", "нечего писать",
-    "нечего сказать", "нечего добавлять", "совсем нечего писать", "вообще нечего писать", "нечего рассказать",
-    "ничего не могу вспомнить", "ничего не запомнилось", "ничего такого не вспомнила",
-    "обычный день", "ничего особенного не было", "ничего интересного не было", "ничего такого не было",
-    "обычный день без радостей", "пустой день", "серый день", "мне все равно", "не чувствую ничего",
-    "никаких эмоций", "просто день и день", "ничего не чувствую", "эмоций нет", "не сейчас", "позже напишу",
-    "потом напишу", "может позже вспомню", "не готова писать", "не знаю радость ли это", "не уверена что это радость",
-    "сомневаюсь что это считается", "это вроде не радость", "не уверена стоит ли это писать", "ничего хорошего",
-    "ничего не радует", "ничего хорошего сегодня не было", "явно нечему радоваться", "не за что зацепиться",
-    "нет настроения писать", "нет вдохновения", "пока не до радостей", "не время для радостей",
-    "не могу собраться с мыслями", "честно говоря нечего", "вроде что-то было",
-    "может завтра вспомню", "рано писать", "ничего пока", "лень думать", "лень писать",
-    "мне лень", "ок", "такое себе", "обычно", "нормально, нечего писать",
-    "ничего не изменилось", "не знаю", "вообще не знаю", "абсолютно не знаю"
-]
-
-# Приветствия — расширенный набор + опечатки + раскладка
-GREETING_PATTERNS = [
-    "привет", "привет!", "приветик", "приветики", "привет)", "привет))", "приветствую",
-    "здравствуй", "здравствуйте", "здравствуйте)", "добрый день", "добрый вечер", "доброе утро",
-    "доброй ночи", "хай", "хай!", "хай)", "хэй", "хей", "хелло", "хеллоу", "hello", "hi", "hey",
-    "йоу", " йо", "йоу)", "йоу!", "ку", "ку!", "ку)", "здорово", "здоров", "здарова", "здаров",
-    "здорова", "салют", "шалом", "бонжур", "хола", "доброго дня", "доброго вечера", "рад тебя видеть",
-    "рада тебя видеть", "снова я", "это я снова", "привет-привет", "здравствуй-здравствуй",
-    "приветствую тебя", "рад приветствовать", "рада приветствовать", "добро пожаловать",
-    "с возвращением", "как дела", "как ты", "как жизнь", "что нового", "как настроение",
-    "приветики-приветики", "здрасьте", "здрасте", "приветствую вас", "доброго времени суток",
-    "доброго здоровья", "мое почтение", "здравия желаю",
-    # опечатки и раскладка
-    "првиет", "превет", "привте", "прювет", "прив", "ghbdtn", "ghbdtn!", "ghbdtn)", "privet", "privet!", "privetik",
-    "privetik!", "privet)", "privetik)"
-]
-
-# Сообщения для отмены
-CANCEL_PATTERNS = [
-    "отмена", "отменить", "я передумала", "я передумал", "не хочу писать", "не хочу письмо",
-    "не хочу продолжать", "не буду писать", "/cancel"
-]
+# Webhook-режим (python chudomoodo_bot.py webhook): встроенный HTTP-сервер.
+# WEBHOOK_URL — публичный адрес для setWebhook (если пусто — регистрирует прокси/оператор).
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = 1000        # updates, принятых, но ещё не обработанных
+WEBHOOK_BATCH_MAX = 100          # сколько updates обрабатывать одной транзакцией
+WEBHOOK_MAX_BODY = 1024 * 1024   # байт
+# Одно соединение — Telegram шлёт updates строго по порядку (watermark дедупликации)
+WEBHOOK_MAX_CONNECTIONS = 1
+
+# Настройки доставки по умолчанию (новые пользователи — по Минску)
+DEFAULT_TZ_NAME = "Europe/Minsk"
+DEFAULT_REMINDER_TIME = dtime(20, 0)
+DEFAULT_REPORT_TIME = dtime(22, 0)
+# Рассылка размазывается по окну после выбранного времени (сек):
+# у каждого чата свой постоянный сдвиг — вместо двух пиков в 20:00 и 22:00
+DELIVERY_STAGGER_WINDOW = 600
+
+# Планировщик: максимальный сон за раз (сек) — страховка от перевода часов
+SCHEDULER_MAX_SLEEP = 300
+# Сколько получателей рассылки планируем одним запросом
+# (2 параметра на пользователя, у старых SQLite лимит — 999 параметров)
+FANOUT_CHUNK = 400
+# Сколько сообщений рассылки одновременно "в полёте" и как часто печатать прогресс
+FANOUT_CONCURRENCY = 64
+FANOUT_PROGRESS_EVERY = 500
+
+# Лимит длины одного сообщения Telegram (символов)
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Сколько радостей на одной странице отчёта wantnow
+WANTNOW_PAGE_SIZE = 50
+
+# HTTP: keep-alive сессия на поток, таймауты (connect, read) по типу вызова
+HTTP_POOL_CONNECTIONS = 1    # api.telegram.org — один хост
+HTTP_POOL_MAXSIZE = 2        # соединений в пуле на поток
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_POLL_READ_MARGIN = 5     # long-poll: read timeout = timeout + запас
+HTTP_SEND_READ_TIMEOUT = 10
+HTTP_ACTION_READ_TIMEOUT = 5
+
+# Входящие updates: обработка параллельно по чатам (порядок внутри чата сохраняется)
+DISPATCH_WORKERS = 8
+DISPATCH_QUEUE_SIZE = 100   # updates в очереди одного воркера; дальше — ожидание (backpressure)
+
+# Групповой коммит: поток-писатель ждёт попутные записи не дольше
+# DB_WRITE_MAX_LATENCY секунд и коммитит их одной транзакцией (до DB_WRITE_MAX_BATCH)
+DB_WRITE_MAX_LATENCY = 0.01
+DB_WRITE_MAX_BATCH = 256
+
+# Кеш состояний диалога (письмо в будущее): размер и время жизни записи (сек)
+DIALOG_CACHE_SIZE = 10000
+DIALOG_CACHE_TTL = 3600
+
+# Память о чатах (последнее сообщение, последний ответ на радость):
+# не больше SESSION_CACHE_SIZE чатов, забываются через SESSION_TTL секунд тишины
+SESSION_CACHE_SIZE = 50000
+SESSION_TTL = 24 * 3600
+
+# Нормализация текста для словарей: результаты для коротких сообщений
+# (до NORMALIZE_CACHE_MAX_LEN символов) запоминаются в LRU на NORMALIZE_CACHE_SIZE текстов
+NORMALIZE_CACHE_SIZE = 20000
+NORMALIZE_CACHE_MAX_LEN = 200
+
+# Дедупликация update_id: сколько последних id держим в памяти поверх watermark
+UPDATE_DEDUP_WINDOW = 1000
+# Сколько раз пробуем обработать update, который падает, прежде чем пропустить его
+UPDATE_MAX_ATTEMPTS = 3
+# Как часто фоновый поток чистит старые строки processed_updates (сек)
+UPDATE_PRUNE_INTERVAL = 600
+UPDATE_PRUNE_CHUNK = 1000
+
+# Как часто печатать в лог состояние очереди исходящих и кешей (сек)
+STATS_LOG_INTERVAL = 300
+
+# "Человеческая" пауза перед ответом (сек) — набирает сообщение...
+HUMAN_DELAY_RANGE = (0.8, 1.5)
+
+# Словари и тексты ответов — внешние файлы (правятся без перезапуска)
+LEXICON_DIR = os.getenv("LEXICON_DIR", os.path.join(os.path.dirname(__file__), "lexicons"))
+# Как часто проверять, не поменялись ли файлы словарей (сек)
+LEXICON_RELOAD_INTERVAL = 5
+
+# Очередь исходящих: лимиты Telegram (~30 сообщений/с всего, ~1/с в один чат)
+OUTBOUND_WORKERS = 4
+OUTBOUND_GLOBAL_RATE = 30.0
+OUTBOUND_GLOBAL_BURST = 5
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_MAX_ATTEMPTS = 5
+OUTBOUND_BACKOFF_BASE = 1.0
+OUTBOUND_BACKOFF_MAX = 60.0
 
 # --------------------------
-# ТЕКСТОВЫЕ ОТВЕТЫ
+# Telegram API
 # --------------------------
 
-# Приветственные ответы (greeting)
-GREETING_RESPONSES = [
-    "Привет! Большое счастье состоит из маленьких мгновений. Какое из них запомнилось тебе сегодня?",
-    "Ооооо)) Рад тебя видеть здесь. Давай отметим что-нибудь приятное из этого дня?",
-    "Хей! Первая радость — ты. Вторая — то, что ты сейчас мне расскажешь.",
-    "Привет! Давай честно: что сегодня было нормального и не бесило? Такие вещи надо уважать.",
-    "Ооо, ты здесь! Подкинь событие, после которого ты не закатила глаза. Это редкость, коллекционный экземпляр!",
-    "Ооо))) Самая простая радость случилась — ты появилась! Теперь давай вторую, пока победа не испарилась.",
-    "Привет! Предлагаю стартануть с чего-то очевидного: что сегодня было твоим базовым минимумом? Еда, музыка или кофе?",
-    "Я тут! Кидай свою победу дня. Даже если победила только собственную лень — мы такое уважаем!",
-    "Рад, что ты заглянула! Давай, вспоминай: что в этот день было хорошего? Хоть что-то? Хоть кто-то?",
-    "Хэй! Я тут, ты тут — уже неплохо, согласись. А что ещё хорошего произошло?",
-    "Привет, цыпа! Мир всё ещё на месте, а ты всё ещё красавица. Что хорошего сегодня произошло?",
-    "Привет! Я тут уже подумал, что ты сегодня была настолько счастлива, что забыла про всё на свете. Такое бывает!",
-    "Ооо, рада, что ты не стала NPC в своей же жизни! Давай запишем, что сегодня было по-настоящему классным!",
-    "Эй, ну что, опять решила быть счастливой? Ладно, я с тобой.",
-    "Хей! Кажется, твой день слишком хорош, чтобы пройти мимо.",
-    "Привет! Давай отметим все радостные мелочи, которые делают день лучше.",
-    "Эй! Кажется, день полон маленьких побед. Запишем их?",
-    "Привет! Радость — штука заразительная, так что делись!",
-    "Хэй! Каждое маленькое счастье заслуживает внимания. Давай запишем твоё!",
-    "Привет! Ну что, опять решила быть счастливой? Смело. Мне нравится.",
-    "Эй! День подозрительно хорош. Срочно фиксируем радости.",
-    "Привет! Я тут, чтобы напомнить: даже мелкая радость — уже победа.",
-    "Эй, ну что, опять решила радоваться? Сразу видно: день твой."
-]
-
-JOY_EMOJIS = ["✨", "😊", "🌈", "💛", "🌟"]
-REMINDER_TEXTS = [
-    "Так-так, кажется, кто-то сегодня так увлекся жизнью, что забыл оставить мне отчет. Итак, что сегодня было у тебя хорошего?",
-    "«Алло! Мы тут вообще-то коллекционируем счастье, а ты прогуливаешь. Вспоминай приятности, я на связи!»",
-    "💪 Ну что, сегодня лень победила? Быстро вспоминай: что заставило тебя улыбнуться? Даже если это был всего лишь мем.",
-    "😇 Ты сегодня была к себе добра? Это самая важная радость. Если да, то почему?",
-    "👽 Не верю, что ты скрываешь от меня радость! Это контрабанда счастья! Быстро делись, пока я не вызвал патруль!",
-    "🔮 Я уже вижу, что ты была счастлива. Просто ты забыла мне сказать. Подтверди моё подозрение, напиши о самом приятном моменте!",
-    "🚨 Внимание, тревога! В списке радостей обнаружена пустота! Это незаконно. Срочно исправляй ситуацию одной приятной мелочью😊",
-    "🚨 Внимание, тревога! В списке радостей обнаружена пустота! Это незаконно. Срочно исправляй ситуацию одной приятной мелочью.",
-    "🚀 Эй, не откладывай радость на завтра! Срочно вспоминай, что сегодня было хорошего, пока я не начал давить на совесть.",
-    "⏰ Кажется, ты забила на самую важную встречу дня – встречу со своими радостями! Вспоминай, я жду!",
-    "🔮 Я уже вижу, что ты была счастлива. Просто ты забыла мне сказать. Подтверди моё подозрение, напиши о самом радостном моменте!",
-    "📜 Твоя коллекция радостей — это очень ценный артефакт. Не оставляй в нём пробелов! Что добавим в список реликвий?",
-]
-STATS_EMOJIS = ["📊", "📈", "⭐"]
-CALM_EMOJIS = ["🙂", "🌿", "✨", "☕", "🕊", "🍃"]
-
-# Ответы на грусть
-SAD_RESPONSES = [
-    "Звучит как очень непростой день. Не обязательно прямо сейчас искать в нём плюсы. Если вдруг ты вспомнишь приятную мелочь (даже самую крошечную) — просто напиши. Я сохраню.",
-
-    "Понимаю, что сегодня могло быть тяжело. Ты всегда умница, даже если самой так не кажется.",
-    "Понимаю, день мог быть тяжковатым — жизнь иногда любит драму. Но ты всё равно умница, даже когда твой день в энергосберегающем режиме.",
-
-    "Вижу, что тебе сейчас непросто. Ты можешь просто выдохнуть. Радости подождут, они не убегут.",
-
-    "Понимаю, что сегодня было тяжеловато. Не заставляй себя искать плюсы. Если вечером вспомнится что-то приятное — например «горячий душ» или «тишина» — пришли, я запишу.",
-
-    "Ты сегодня прошла через многое. Не обязательно быть собранной. Я здесь, даже если у тебя нет сил на рассказы.",
-
-    "Чувствую, что сегодня было нелегко. Не стоит форсировать хорошее. Если невзначай вспомнится момент, когда стало чуть легче — напиши в двух словах. Я сохраню.",
-
-    "Окей, вижу, день был такой себе. Героизм можно официально перенести на завтра. А если что-то всё же порадовало — даже случайно — расскажи.",
-
-    "Хм, похоже, сегодняшний день хотел, чтобы ты сдалась. Но ты тут — а значит, он проиграл. Напишешь, что помогло тебе выиграть?",
-
-    "Ого, день явно устроил тебе финал «Игры престолов». Но и ты-то не первый сезон. И если в этой серии был хоть один приятный кадр — пиши, я его добавлю в режиссёрскую версию."
-]
-
-# Ответы на усталость
-TIRED_RESPONSES = [
-    "Ловлю твоё настроение без слов. Если вдруг позже вспомнится что-то простое вроде «дождь закончился как по заказу» — я на подхвате!",
-    "Всё нормально, я рядом. Не ты слабая — день был сильным. Если вдруг поймёшь, что ужин сегодня неожиданно был вкусным — это тоже радость. Пиши — я запомню!",
-    "Ты не уставшая — ты герой без пафоса. Можно ничего не говорить. Если вдруг поймаешь себя на мысли «У меня же остались конфеты!» — это уже повод для нашего чата!",
-    "Окей, вижу, что слов нет. Молчу как рыба. Если вдруг вспомнишь, как твой котик спал рядом — я на низком старте! Отправлю в нашу коллекцию радостей.",
-    "Ты не сдаёшься — ты просто немного устала. Если вдруг вспомнится момент, когда стало хоть чуть-чуть светлее — это уже прорыв! Сообщи — запишем в наш архив побед.",
-]
-
-# Ответы на тревогу
-ANXIETY_RESPONSES = [
-    "Похоже, твоя тревожность решила пройтись по всем сценариям сразу. Но это потому, что ты умеешь заранее видеть то, что другим приходит в голову через неделю.",
-    "Так, слышу характерный звук: «загрузился новый уровень тревоги». Но если прислушаться — это всего лишь твоя внимательность, которая чуть перегнула палку.",
-    "Так-так, тревога на горизонте! Но если присмотреться — это просто замаскированная забота о том, что тебе дорого.",
-    "Слушай, а ведь твоя тревожка — это как суперспособность — гиперзабота о важном. Просто пока прокачана не до конца.",
-    "Эх, смотрю, внутренний критик опять устроил драму, как в сериале. А ведь это просто твоя суперсила — замечать каждую мелочь!",
-]
-
-# Ответы, когда человек пишет «не знаю, что написать»
-NO_JOY_RESPONSES = [
-    "Ничего, что сегодня нечего написать. Бывает. Не переживай. Если вечером вспомнишь, что играла любимая песня или были классные скидки на WB — напиши мне. Я сохраню.",
-    "Пустота в днях — это как пауза в музыке. Не обязательно её заполнять.",
-    "Никаких обязательных радостей! Но если вдруг вспомнишь голубя со смешной походкой или неожиданный комплимент — это повод написать мне!",
-    "Ничего, что сегодняшний день как чистый лист. Бывает и такое. Если вдруг вечером вспомнится что-то — я на низком старте.",
-    "Разрешаю тебе сегодня просто побыть.",
-    "Пустота — это не ошибка. Это пауза, которая тоже нужна.",
-    "Бывает, когда «ничего» — это лучшее, что мир может предложить.",
-    "Если после спокойствия появится что-то маленькое и приятное — я хочу об этом знать.",
-]
-
-# Ответы на радости
-JOY_RESPONSES = [
-    "Зафиксировала и поставила печать: момент официально признан прекрасным.",
-    "Ок, добавила. И да — ты официально человек, который умеет видеть хорошее.",
-    "💅 Записала. Так и быть — тебе зачёт за способность замечать хорошее, госпожа внимательная.",
-    "Передано в отдел ценных воспоминаний!",
-    "Сохранила в разделе экстренной помощи настроению. Теперь это твой личный запас радости!",
-    "Зафиксировала в журнале поводов для улыбки!",
-    "Передано в отдел ценных мгновений! Этот момент теперь имеет статус неприкосновенного запаса хорошего настроения.",
-    "Записала! Ты, как всегда, заметила то, что другие бы пропустили.",
-    "Кинула в папку «ну ничего себе». Не потеряй такой темп 🙄",
-    "Оу, вижу, ты сегодня опасно близка к счастью. Зафиксировано 😈",
-    "Легенда гласит, что такие моменты лечат нервную систему. Сохранила!",
-    "Сохранение завершено ✔️ Ты снова в клубе побед!",
-    "Зафиксировано — я знала, что твой день не подведёт ✨",
-    "Записала как победу — таких у тебя будет ещё много!",
-    "Так. Стоп. Это было хорошо. Прям вот хорошо.",
-     "Так, тихо. Это был хороший момент.",
-    "Не трогаем, не обесцениваем. Просто записываю сюда!",
-    "Вот за такие штуки я тебя и люблю.",
-    "Записала, не спорь.",
-    "Ого! Радость официально зарегистрирована.",
-    "Ну всё, радостный момент пойман. Назад ему дороги нет.",
-    "Всё, этот момент теперь наш. Не отдаём.",
-    "Если бы радость умела краснеть — она бы сейчас это делала.",
-    "Слушай, а ты умеешь ловить моменты. Это редкий скилл.",
-    "Ну привет! Опять решил сделать день чуть лучше? Смело — я поддержу!",
-    "Слушай, а ты вообще умеешь проигрывать скуке? Похоже, что нет!",
-    "Эй, осторожно… твоя радость заразительна, предупреждаю!",
-    "Ну всё… эта радость теперь официально твоя!"
-]
-
-LAST_JOY_INDEX: Dict[int, int] = {}
-
-# для защиты от двойных ответов на одно и то же сообщение
-_LAST_MESSAGE_CACHE: Dict[int, Tuple[str, float]] = {}
+# Одна keep-alive сессия на поток (long-poll, отправщики, планировщик):
+# соединение с api.telegram.org переиспользуется без нового TCP+TLS.
+_HTTP_LOCAL = threading.local()
+_HTTP_SESSIONS: List[requests.Session] = []
+_HTTP_SESSIONS_LOCK = threading.Lock()
+
+
+def http_session() -> requests.Session:
+    """HTTP-сессия текущего потока с пулом keep-alive соединений."""
+    session = getattr(_HTTP_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_CONNECTIONS,
+            pool_maxsize=HTTP_POOL_MAXSIZE,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _HTTP_LOCAL.session = session
+        with _HTTP_SESSIONS_LOCK:
+            _HTTP_SESSIONS.append(session)
+    return session
+
+
+def close_http_sessions():
+    """Закрывает HTTP-сессии всех потоков (при остановке бота)."""
+    with _HTTP_SESSIONS_LOCK:
+        sessions = list(_HTTP_SESSIONS)
+        _HTTP_SESSIONS.clear()
+    for session in sessions:
+        try:
+            session.close()
+        except Exception as e:
+            print("HTTP close error:", e)
 
-# --------------------------
-# Telegram API
-# --------------------------
 
 def get_updates(offset: Optional[int] = None, timeout: int = POLL_TIMEOUT) -> List[dict]:
     params = {"timeout": timeout}
     if offset is not None:
         params["offset"] = offset
     try:
-        resp = requests.get(f"{API_URL}/getUpdates", params=params, timeout=timeout + 5)
+        resp = http_session().get(
+            f"{API_URL}/getUpdates",
+            params=params,
+            timeout=(HTTP_CONNECT_TIMEOUT, timeout + HTTP_POLL_READ_MARGIN),
+        )
         data = resp.json()
         if not data.get("ok"):
             print("getUpdates error:", data)
@@ -456,33 +230,588 @@ def get_updates(offset: Optional[int] = None, timeout: int = POLL_TIMEOUT) -> Li
         return []
 
 
-def send_message(chat_id: int, text: str, human_delay: bool = True):
+# Ответы, накопленные во время обработки батча (см. deferred_sends)
+_SEND_LOCAL = threading.local()
+
+
+@contextmanager
+def deferred_sends():
+    """
+    Внутри блока send_message в текущем потоке не отправляет, а копит ответы.
+    Вызывающий отправляет их сам — например, после коммита транзакции.
+    """
+    outbox: List[Tuple[int, str, bool, Optional[dict]]] = []
+    _SEND_LOCAL.outbox = outbox
+    try:
+        yield outbox
+    finally:
+        _SEND_LOCAL.outbox = None
+
+
+# Результаты отправки для очереди исходящих
+SEND_OK = "ok"
+SEND_RETRY = "retry"      # 429 или временная ошибка — повторить позже
+SEND_FAILED = "failed"    # постоянная ошибка (чат не найден, бот заблокирован)
+
+
+def _telegram_send(method: str, payload: dict, read_timeout: float) -> Tuple[str, Optional[float]]:
+    """
+    Один вызов метода отправки.
+    Возвращает (результат, retry_after): retry_after задан для 429.
+    """
     try:
-        if human_delay:
-            # Показываем "набирает сообщение..."
-            requests.post(
-                f"{API_URL}/sendChatAction",
-                json={"chat_id": chat_id, "action": "typing"},
-                timeout=5,
-            )
-            # Короткая задержка (не 2–3 сек, чтобы не тормозить бота)
-            time.sleep(random.uniform(0.8, 1.5))
-
-        # Отправляем сообщение
-        requests.post(
-            f"{API_URL}/sendMessage",
-            json={"chat_id": chat_id, "text": text},
-            timeout=10,
+        resp = http_session().post(
+            f"{API_URL}/{method}",
+            json=payload,
+            timeout=(HTTP_CONNECT_TIMEOUT, read_timeout),
         )
-    except Exception as e:
-        print("sendMessage error:", e)
+    except requests.RequestException as e:
+        print(f"{method} error:", e)
+        return SEND_RETRY, None
+
+    if resp.status_code == 429:
+        retry_after = None
+        try:
+            retry_after = float(resp.json().get("parameters", {}).get("retry_after"))
+        except Exception:
+            pass
+        return SEND_RETRY, retry_after or OUTBOUND_BACKOFF_BASE
+    if resp.status_code >= 500:
+        print(f"{method} error: HTTP {resp.status_code}")
+        return SEND_RETRY, None
+    if resp.status_code >= 400:
+        print(f"{method} error: HTTP {resp.status_code} {resp.text[:200]}")
+        return SEND_FAILED, None
+    return SEND_OK, None
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет доступен один токен (0 — уже есть)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _OutboundTask:
+    __slots__ = ("kind", "chat_id", "text", "not_before", "attempts", "on_done", "markup")
+
+    def __init__(self, kind: str, chat_id: int, text: str, not_before: float, on_done=None,
+                 markup: Optional[dict] = None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.text = text
+        self.not_before = not_before
+        self.attempts = 0
+        self.on_done = on_done
+        self.markup = markup
+
+
+class _ChatLane:
+    """Очередь одного чата: задачи строго по порядку, в работе — максимум одна."""
+
+    __slots__ = ("tasks", "bucket", "busy", "blocked_until", "scheduled")
+
+    def __init__(self):
+        self.tasks: deque = deque()
+        self.bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+        self.busy = False
+        self.blocked_until = 0.0
+        self.scheduled = False
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих сообщений с учётом лимитов Telegram.
+
+    - у каждого чата своя FIFO-очередь (порядок ответов сохраняется);
+    - общий token bucket (~30/с) и token bucket на чат (~1/с);
+    - задачи могут ждать своего времени (пауза "набирает сообщение...");
+    - 429: ждём retry_after и повторяем — пауза общая для всех чатов
+      (лимит Telegram — на бота целиком); сетевые ошибки, 5xx и любые
+      неожиданные ошибки — повтор с экспоненциальной паузой; прочие 4xx —
+      сообщение отбрасывается;
+    - несколько потоков-отправщиков, каждый спит ровно до ближайшей задачи.
+    """
+
+    def __init__(self, workers: int = OUTBOUND_WORKERS):
+        self._cond = threading.Condition()
+        self._heap: List[Tuple[float, int, int]] = []  # (когда, порядок, chat_id)
+        self._seq = itertools.count()
+        self._lanes: Dict[int, _ChatLane] = {}
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST)
+        # До какого момента Telegram просил не слать ничего (429 retry_after)
+        self._blocked_until = 0.0
+        self._workers_count = workers
+        self._workers: List[threading.Thread] = []
+        self._queued = 0
+        self._inflight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def _ensure_started(self):
+        self._workers = [t for t in self._workers if t.is_alive()]
+        while len(self._workers) < self._workers_count:
+            t = threading.Thread(target=self._run, name=f"outbound-{len(self._workers)}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _schedule_lane(self, chat_id: int, lane: _ChatLane, when: float):
+        lane.scheduled = True
+        heapq.heappush(self._heap, (when, next(self._seq), chat_id))
+
+    def enqueue(self, chat_id: int, text: str, delay: float = 0.0, kind: str = "message",
+                on_done=None, markup: Optional[dict] = None):
+        """
+        Поставить отправку в очередь (kind: "message", "typing" или "callback" —
+        ответ на нажатие кнопки, тогда text — id callback_query).
+        on_done(chat_id, result) вызывается после окончательного результата
+        (SEND_OK или SEND_FAILED) из потока-отправщика.
+        """
+        with self._cond:
+            now = time.monotonic()
+            lane = self._lanes.get(chat_id)
+            if lane is None:
+                lane = self._lanes[chat_id] = _ChatLane()
+            lane.tasks.append(_OutboundTask(kind, chat_id, text, now + delay, on_done, markup))
+            self._queued += 1
+            if not lane.busy and not lane.scheduled:
+                self._schedule_lane(chat_id, lane, max(now + delay, lane.blocked_until))
+            self._ensure_started()
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "queued": self._queued,
+                "inflight": self._inflight,
+                "chats": len(self._lanes),
+                "sent": self.sent,
+                "failed": self.failed,
+                "retried": self.retried,
+            }
+
+    def drain(self, timeout: float = 10.0) -> bool:
+        """Ждёт, пока очередь опустеет (при остановке). True — всё отправлено."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queued:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _next_task(self) -> _OutboundTask:
+        """Ждёт задачу, которую уже можно отправлять, и забирает токены под неё."""
+        while True:
+            if not self._heap:
+                self._cond.wait()
+                continue
+            when, _, chat_id = self._heap[0]
+            now = time.monotonic()
+            if when > now:
+                self._cond.wait(when - now)
+                continue
+            heapq.heappop(self._heap)
+
+            lane = self._lanes[chat_id]
+            lane.scheduled = False
+            task = lane.tasks[0]
+            wait = max(
+                task.not_before - now, lane.blocked_until - now,
+                self._blocked_until - now, self._global.wait_time(now),
+            )
+            if task.kind == "message":
+                wait = max(wait, lane.bucket.wait_time(now))
+            if wait > 0:
+                self._schedule_lane(chat_id, lane, now + wait)
+                continue
+
+            self._global.take(now)
+            if task.kind == "message":
+                lane.bucket.take(now)
+            lane.busy = True
+            self._inflight += 1
+            return task
+
+    @staticmethod
+    def _send(task: _OutboundTask) -> Tuple[str, Optional[float]]:
+        if task.kind == "typing":
+            return _telegram_send(
+                "sendChatAction", {"chat_id": task.chat_id, "action": "typing"},
+                HTTP_ACTION_READ_TIMEOUT,
+            )
+        if task.kind == "callback":
+            return _telegram_send(
+                "answerCallbackQuery", {"callback_query_id": task.text},
+                HTTP_ACTION_READ_TIMEOUT,
+            )
+        payload = {"chat_id": task.chat_id, "text": task.text}
+        if task.markup is not None:
+            payload["reply_markup"] = task.markup
+        return _telegram_send("sendMessage", payload, HTTP_SEND_READ_TIMEOUT)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+
+            # Что бы ни случилось при отправке, чат освобождается (_finish):
+            # иначе его очередь встанет навсегда, а drain() не дождётся конца
+            result, retry_after = SEND_RETRY, None
+            try:
+                result, retry_after = self._send(task)
+            except Exception as e:
+                print(f"Ошибка отправки ({task.kind}) в {task.chat_id}: {e}")
+            finally:
+                # "печатает..." и ответ на кнопку не стоит повторять — просто идём дальше
+                if task.kind != "message" and result == SEND_RETRY:
+                    result = SEND_FAILED
+                with self._cond:
+                    result = self._finish(task, result, retry_after)
+                    self._cond.notify_all()
+
+            if result != SEND_RETRY and task.on_done is not None:
+                try:
+                    task.on_done(task.chat_id, result)
+                except Exception as e:
+                    print("on_done error:", e)
+
+    def _finish(self, task: _OutboundTask, result: str, retry_after: Optional[float]) -> str:
+        now = time.monotonic()
+        lane = self._lanes[task.chat_id]
+        lane.busy = False
+        self._inflight -= 1
+
+        if retry_after is not None:
+            # 429 — флуд-лимит всего бота: пауза для всех чатов, не только этого
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+
+        if result == SEND_RETRY:
+            task.attempts += 1
+            if task.attempts < OUTBOUND_MAX_ATTEMPTS:
+                self.retried += 1
+                if retry_after is None:
+                    retry_after = min(OUTBOUND_BACKOFF_MAX, OUTBOUND_BACKOFF_BASE * 2 ** (task.attempts - 1))
+                lane.blocked_until = now + retry_after
+            else:
+                print(f"sendMessage: не удалось отправить в {task.chat_id} после {task.attempts} попыток")
+                result = SEND_FAILED
+
+        if result != SEND_RETRY:
+            lane.tasks.popleft()
+            self._queued -= 1
+            if result == SEND_OK:
+                if task.kind == "message":
+                    self.sent += 1
+            elif task.kind == "message":
+                self.failed += 1
+
+        if lane.tasks:
+            self._schedule_lane(task.chat_id, lane, max(lane.tasks[0].not_before, lane.blocked_until))
+        elif lane.blocked_until <= now:
+            del self._lanes[task.chat_id]
+        return result
+
+
+OUTBOUND = OutboundQueue()
+
+
+def send_message(chat_id: int, text: str, human_delay: bool = True, on_done=None,
+                 reply_markup: Optional[dict] = None):
+    outbox = getattr(_SEND_LOCAL, "outbox", None)
+    if outbox is not None and on_done is None:
+        outbox.append((chat_id, text, human_delay, reply_markup))
+        return
+
+    if human_delay:
+        # Показываем "набирает сообщение..." сразу, а сам ответ уйдёт после
+        # короткой паузы — обработка других чатов не ждёт
+        OUTBOUND.enqueue(chat_id, "", kind="typing")
+        OUTBOUND.enqueue(chat_id, text, delay=random.uniform(*HUMAN_DELAY_RANGE), on_done=on_done,
+                         markup=reply_markup)
+        return
+
+    OUTBOUND.enqueue(chat_id, text, on_done=on_done, markup=reply_markup)
+
+
+def answer_callback(chat_id: int, callback_query_id: str):
+    """Подтверждает нажатие inline-кнопки (убирает "часики" на кнопке)."""
+    OUTBOUND.enqueue(chat_id, callback_query_id, kind="callback")
+
+# --------------------------
+# Часовые пояса и время доставки
+# --------------------------
+
+DELIVERY_KINDS = ("reminder", "report")
+
+_UTC_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def to_utc_iso(dt: datetime) -> str:
+    """UTC-время строкой фиксированного формата (сравнивается лексикографически)."""
+    return dt.astimezone(timezone.utc).strftime(_UTC_FORMAT)
+
+
+def from_utc_iso(value: str) -> datetime:
+    return datetime.strptime(value, _UTC_FORMAT).replace(tzinfo=timezone.utc)
+
+
+@functools.lru_cache(maxsize=256)
+def get_zone(tz_name: str):
+    """tzinfo по имени IANA; без zoneinfo/tzdata — Минск или локальная зона сервера."""
+    try:
+        return ZoneInfo(tz_name)
+    except Exception:
+        return MINSK_TZ
+
+
+def parse_tz_name(value: str) -> Optional[str]:
+    """
+    Часовой пояс из ввода пользователя: имя IANA ("Europe/Moscow")
+    или смещение ("UTC+5", "GMT-3", "+3"). None — если не распознали.
+    """
+    value = value.strip()
+    match = re.fullmatch(r"(?i)(?:utc|gmt)?\s*([+-])\s*(\d{1,2})", value)
+    if match:
+        hours = int(match.group(2))
+        if hours > 14:
+            return None
+        # В Etc/GMT знак обратный: UTC+5 — это Etc/GMT-5
+        sign = "-" if match.group(1) == "+" else "+"
+        value = "Etc/GMT" if hours == 0 else f"Etc/GMT{sign}{hours}"
+    elif value.lower() in ("utc", "gmt"):
+        value = "UTC"
+    try:
+        ZoneInfo(value)
+    except Exception:
+        return None
+    return value
+
+
+def parse_hhmm(value: str) -> Optional[dtime]:
+    match = re.fullmatch(r"(\d{1,2})[:.](\d{2})", value.strip())
+    if not match:
+        return None
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        return None
+    return dtime(hour, minute)
+
+
+def _local_to_utc(local: datetime, zone) -> datetime:
+    if zone is None:
+        return local.astimezone().astimezone(timezone.utc)  # локальная зона сервера
+    return local.replace(tzinfo=zone).astimezone(timezone.utc)
+
+
+def _utc_to_local(moment: datetime, zone) -> datetime:
+    return moment.astimezone(zone) if zone is not None else moment.astimezone()
+
+
+class UserSettings:
+    """
+    Часовой пояс и время напоминания/отчёта пользователя.
+    Все моменты доставки считаются в UTC: выбранное местное время
+    плюс постоянный сдвиг чата внутри DELIVERY_STAGGER_WINDOW.
+    """
+
+    __slots__ = ("chat_id", "tz_name", "reminder_time", "report_time", "stored")
+
+    def __init__(self, chat_id: int, tz_name: str = DEFAULT_TZ_NAME,
+                 reminder_time: dtime = DEFAULT_REMINDER_TIME,
+                 report_time: dtime = DEFAULT_REPORT_TIME, stored: bool = False):
+        self.chat_id = chat_id
+        self.tz_name = tz_name
+        self.reminder_time = reminder_time
+        self.report_time = report_time
+        self.stored = stored
+
+    @property
+    def zone(self):
+        return get_zone(self.tz_name)
+
+    @property
+    def stagger(self) -> timedelta:
+        if not DELIVERY_STAGGER_WINDOW:
+            return timedelta(0)
+        return timedelta(seconds=(self.chat_id * 2654435761) % DELIVERY_STAGGER_WINDOW)
+
+    def today(self) -> date:
+        """Сегодняшняя дата в часовом поясе пользователя."""
+        return _utc_to_local(utc_now(), self.zone).date()
+
+    def time_for(self, kind: str) -> dtime:
+        return self.reminder_time if kind == "reminder" else self.report_time
+
+    def due_at(self, kind: str, day: date) -> datetime:
+        """Момент доставки (UTC) для местного дня day."""
+        local = datetime.combine(day, self.time_for(kind))
+        return _local_to_utc(local, self.zone) + self.stagger
+
+    def day_of(self, kind: str, due: datetime) -> date:
+        """К какому местному дню относится момент доставки due."""
+        return _utc_to_local(due - self.stagger, self.zone).date()
+
+    def next_due(self, kind: str, after: datetime) -> datetime:
+        """Ближайший момент доставки строго позже after."""
+        day = _utc_to_local(after, self.zone).date() - timedelta(days=1)
+        while True:
+            due = self.due_at(kind, day)
+            if due > after:
+                return due
+            day += timedelta(days=1)
+
+    def deadline(self, kind: str, day: date) -> datetime:
+        """
+        До какого момента ещё имеет смысл догонять доставку за day:
+        напоминание — до отчёта (или до конца дня), отчёт — до конца дня.
+        """
+        end_of_day = _local_to_utc(datetime.combine(day + timedelta(days=1), dtime(0, 0)), self.zone)
+        if kind == "reminder" and self.report_time > self.reminder_time:
+            return self.due_at("report", day)
+        return end_of_day + self.stagger
+
+
+# --------------------------
+# Кеши в памяти
+# --------------------------
+
+class LruCache:
+    """
+    Потокобезопасный LRU-кеш с TTL и ограничением по числу записей.
+    Считает попадания, промахи и вытеснения (по размеру и по TTL).
+    """
+
+    _MISSING = object()
+
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[object, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is self._MISSING:
+                self.misses += 1
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_create(self, key, factory):
+        """Значение по ключу; если его нет (или истекло) — создаёт factory() и кладёт."""
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is not self._MISSING:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.expirations += 1
+            self.misses += 1
+            value = factory()
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            return value
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
 
 # --------------------------
 # DB
 # --------------------------
-def db_connect():
+# Одно долгоживущее соединение на поток (main_loop, scheduler, воркеры):
+# PRAGMA выполняются один раз, а подготовленные выражения кешируются
+# модулем sqlite3 внутри соединения (cached_statements).
+DB_CACHED_STATEMENTS = 256
+
+_DB_LOCAL = threading.local()
+_DB_CONNECTIONS: List[sqlite3.Connection] = []
+_DB_CONNECTIONS_LOCK = threading.Lock()
+# Увеличивается при close_db_connections: потоки со старым соединением откроют новое
+_DB_GENERATION = 0
+
+
+def _open_db_connection() -> sqlite3.Connection:
     # timeout помогает при конкуренции потоков (scheduler + main_loop)
-    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=30,
+        cached_statements=DB_CACHED_STATEMENTS,
+        # закрыть соединение при остановке можно из любого потока,
+        # но пользуется им только поток-владелец
+        check_same_thread=False,
+    )
     # WAL сильно уменьшает шанс "database is locked"
     try:
         conn.execute("PRAGMA journal_mode=WAL;")
@@ -491,7 +820,361 @@ def db_connect():
         pass
     return conn
 
-def init_db():
+
+def db_connect() -> sqlite3.Connection:
+    """Соединение текущего потока (создаётся при первом обращении)."""
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None or getattr(_DB_LOCAL, "generation", None) != _DB_GENERATION:
+        conn = _open_db_connection()
+        with _DB_CONNECTIONS_LOCK:
+            _DB_CONNECTIONS.append(conn)
+            _DB_LOCAL.generation = _DB_GENERATION
+        _DB_LOCAL.conn = conn
+        _DB_LOCAL.tx_depth = 0
+    return conn
+
+
+def close_db_connections():
+    """Закрывает все соединения всех потоков (вызывать при остановке бота)."""
+    global _DB_GENERATION
+    with _DB_CONNECTIONS_LOCK:
+        connections = list(_DB_CONNECTIONS)
+        _DB_CONNECTIONS.clear()
+        _DB_GENERATION += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except Exception as e:
+            print("DB close error:", e)
+
+
+@contextmanager
+def db_transaction():
+    """
+    Транзакция на соединении текущего потока.
+    Вложенные вызовы становятся SAVEPOINT-ами: ошибка внутри откатывает
+    только свой уровень, а коммит делает самый внешний.
+    """
+    conn = db_connect()
+    depth = getattr(_DB_LOCAL, "tx_depth", 0)
+    if depth == 0:
+        conn.execute("BEGIN")
+    else:
+        conn.execute(f"SAVEPOINT sp_{depth}")
+    _DB_LOCAL.tx_depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        _DB_LOCAL.tx_depth = depth
+        if depth == 0:
+            conn.rollback()
+        else:
+            conn.execute(f"ROLLBACK TO sp_{depth}")
+            conn.execute(f"RELEASE sp_{depth}")
+        raise
+    _DB_LOCAL.tx_depth = depth
+    if depth == 0:
+        conn.commit()
+    else:
+        conn.execute(f"RELEASE sp_{depth}")
+
+
+class WriteHandle:
+    """
+    Результат записи через DbWriter. wait() дожидается коммита и возвращает
+    результат функции записи (или пробрасывает её ошибку) — для тех,
+    кому нужно сразу прочитать свою запись.
+    """
+
+    __slots__ = ("fn", "args", "result", "error", "deferred", "_done")
+
+    def __init__(self, fn, args: tuple, deferred: bool = False):
+        self.fn = fn
+        self.args = args
+        self.result = None
+        self.error: Optional[BaseException] = None
+        # Запись update: коммитится вместе со всем update, после обработчика
+        self.deferred = deferred
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None):
+        if self.deferred and not self.done():
+            raise RuntimeError("Запись update коммитится после обработчика — используйте after_commit")
+        if not self._done.wait(timeout):
+            raise TimeoutError("Запись в БД не завершилась вовремя")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def _finish(self):
+        self.fn = self.args = None
+        self._done.set()
+
+
+class DbWriter:
+    """
+    Один поток-писатель с очередью записей. Записи, пришедшие почти
+    одновременно (в пределах max_latency), выполняются одной транзакцией —
+    один fsync на группу вместо одного на каждую запись. Каждая запись
+    идёт в своём SAVEPOINT: ошибка одной не откатывает остальные.
+    Порядок записей сохраняется.
+    """
+
+    def __init__(self, max_latency: float = DB_WRITE_MAX_LATENCY, max_batch: int = DB_WRITE_MAX_BATCH):
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self._cond = threading.Condition()
+        self._queue: deque = deque()
+        self._busy = 0
+        self._thread: Optional[threading.Thread] = None
+        self.commits = 0
+        self.writes = 0
+
+    def submit(self, fn, *args) -> WriteHandle:
+        """Поставить fn(*args) в очередь; fn пишет через db_connect()/db_transaction()."""
+        handle = WriteHandle(fn, args)
+        with self._cond:
+            self._queue.append(handle)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+        return handle
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Ждёт, пока все поставленные записи закоммитятся. True — очередь пуста."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _take_batch(self) -> List[WriteHandle]:
+        while not self._queue:
+            self._cond.wait()
+        # Ждём попутчиков, но не дольше max_latency от первой записи
+        deadline = time.monotonic() + self.max_latency
+        while len(self._queue) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.max_batch))]
+        self._busy = len(batch)
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            self._commit(batch)
+            with self._cond:
+                self._busy = 0
+                self.commits += 1
+                self.writes += len(batch)
+                self._cond.notify_all()
+
+    def _commit(self, batch: List[WriteHandle]):
+        try:
+            with db_transaction():
+                for handle in batch:
+                    try:
+                        with db_transaction():
+                            handle.result = handle.fn(*handle.args)
+                    except Exception as e:
+                        handle.error = e
+                        print(f"Ошибка записи в БД ({getattr(handle.fn, '__name__', handle.fn)}): {e}")
+        except Exception as e:
+            print("Ошибка группового коммита:", e)
+            for handle in batch:
+                if handle.error is None:
+                    handle.error = e
+        for handle in batch:
+            handle._finish()
+
+
+DB_WRITER = DbWriter()
+
+
+def db_write(fn, *args) -> WriteHandle:
+    """
+    Запись fn(*args) с групповым коммитом.
+    Если текущий поток уже внутри db_transaction (сам писатель, пересчёты),
+    запись выполняется сразу и станет частью этой транзакции.
+    Внутри update_writes запись откладывается до конца обработки update
+    и коммитится вместе с отметкой update_id (см. commit_update).
+    Иначе запись уходит потоку-писателю.
+    """
+    if getattr(_DB_LOCAL, "tx_depth", 0):
+        handle = WriteHandle(fn, args)
+        with db_transaction():
+            handle.result = fn(*args)
+        handle._finish()
+        return handle
+    unit = getattr(_DB_LOCAL, "update_unit", None)
+    if unit is not None:
+        handle = WriteHandle(fn, args, deferred=True)
+        unit.writes.append(handle)
+        return handle
+    return DB_WRITER.submit(fn, *args)
+
+
+def on_update_commit(callback):
+    """
+    callback() после коммита текущего update (и только если он прошёл):
+    так состояние в памяти не расходится с БД, если update упадёт
+    и будет обработан повторно. Вне обработки update — сразу.
+    """
+    unit = getattr(_DB_LOCAL, "update_unit", None)
+    if unit is None:
+        callback()
+        return
+    unit.on_commit.append(callback)
+
+
+def after_commit(handle: WriteHandle, callback):
+    """callback() после коммита записи handle (см. on_update_commit)."""
+    if handle.deferred and not handle.done():
+        on_update_commit(callback)
+        return
+    handle.wait()
+    callback()
+
+
+class UpdateWrites:
+    """Записи одного update и действия после их коммита."""
+
+    __slots__ = ("update_id", "writes", "on_commit")
+
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.writes: List[WriteHandle] = []
+        self.on_commit: List = []
+
+
+@contextmanager
+def update_writes(update_id: int):
+    """Внутри блока db_write текущего потока копит записи в UpdateWrites."""
+    unit = UpdateWrites(update_id)
+    _DB_LOCAL.update_unit = unit
+    try:
+        yield unit
+    finally:
+        _DB_LOCAL.update_unit = None
+
+
+def _write_update(update_id: int, writes: List[WriteHandle]) -> bool:
+    """
+    В потоке-писателе, одним SAVEPOINT: отметка update_id в processed_updates
+    и все записи update. Если update уже отмечен (повторная доставка после
+    рестарта) — записи не выполняются, возвращает False.
+    """
+    cur = db_connect().cursor()
+    cur.execute(
+        """
+        INSERT INTO processed_updates (update_id, processed_at)
+        VALUES (?, ?)
+        ON CONFLICT(update_id) DO NOTHING
+        """,
+        (update_id, now_minsk().isoformat(timespec="seconds")),
+    )
+    if cur.rowcount == 0:
+        return False
+    for handle in writes:
+        handle.result = handle.fn(*handle.args)
+    return True
+
+
+def commit_update(unit: UpdateWrites) -> bool:
+    """
+    Коммитит записи update вместе с отметкой update_id (в группе с другими
+    update). True — записи применены, False — update уже был обработан.
+    Ошибка записи пробрасывается: ни отметки, ни записей в БД не остаётся.
+    Update без записей в БД не ходит вовсе: от повторов его бережёт watermark.
+    """
+    if not unit.writes:
+        for callback in unit.on_commit:
+            callback()
+        return True
+    try:
+        fresh = DB_WRITER.submit(_write_update, unit.update_id, unit.writes).wait()
+    except BaseException as e:
+        for handle in unit.writes:
+            handle.error = e
+            handle._finish()
+        raise
+    for handle in unit.writes:
+        if not fresh:
+            handle.error = RuntimeError(f"Update {unit.update_id} уже обработан")
+        handle._finish()
+    if fresh:
+        for callback in unit.on_commit:
+            callback()
+    return fresh
+
+
+def _table_columns(cur: sqlite3.Cursor, table: str) -> List[str]:
+    cur.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cur.fetchall()]
+
+
+def _migrate_joys_day(cur: sqlite3.Cursor):
+    """
+    Календарный день радости (YYYY-MM-DD по Минску) в отдельной колонке
+    с индексами — вместо substr(created_at, 1, 10), который не использует индекс.
+    Старые базы (например, joys.db без колонки day) дополняются на месте.
+    """
+    if "day" not in _table_columns(cur, "joys"):
+        cur.execute("ALTER TABLE joys ADD COLUMN day TEXT")
+    # Бэкфилл: строки из старых баз и от старых версий бота
+    cur.execute("UPDATE joys SET day = substr(created_at, 1, 10) WHERE day IS NULL")
+    # created_at в хвосте индекса — отчёт за день читается уже отсортированным
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_joys_chat_day ON joys (chat_id, day, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_joys_chat_created ON joys (chat_id, created_at)")
+
+
+def _migrate_joys_labels(cur: sqlite3.Cursor):
+    """
+    Метки классификатора (flags) и версия словарей, по которой они посчитаны.
+    NULL — ещё не размечено: такие строки размечает backfill_joy_labels.
+    """
+    columns = _table_columns(cur, "joys")
+    if "flags" not in columns:
+        cur.execute("ALTER TABLE joys ADD COLUMN flags INTEGER")
+    if "lexicon_version" not in columns:
+        cur.execute("ALTER TABLE joys ADD COLUMN lexicon_version TEXT")
+
+
+def _migrate_user_settings(cur: sqlite3.Cursor):
+    """Настройки по умолчанию для всех, у кого уже есть записи, но нет строки настроек."""
+    cur.execute("""
+        SELECT DISTINCT chat_id
+        FROM joys
+        WHERE chat_id NOT IN (SELECT chat_id FROM user_settings)
+    """)
+    rows = [_user_settings_row(UserSettings(chat_id)) for (chat_id,) in cur.fetchall()]
+    cur.executemany(
+        """
+        INSERT OR IGNORE INTO user_settings
+            (chat_id, tz, reminder_time, report_time, next_reminder_at, next_report_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+
+
+def init_db(backfill_labels: bool = True):
+    """
+    Создаёт таблицы и мигрирует старые базы.
+    backfill_labels=False — не размечать строки без меток здесь
+    (например, это сделает reanalyze параллельно).
+    """
     conn = db_connect()
     cur = conn.cursor()
 
@@ -501,11 +1184,40 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER NOT NULL,
             text TEXT NOT NULL,
-            created_at TEXT NOT NULL
+            created_at TEXT NOT NULL,
+            day TEXT
+        )
+    """)
+    _migrate_joys_day(cur)
+    _migrate_joys_labels(cur)
+
+    # Агрегаты для /stats: итоги и серии по пользователю, число записей по дням.
+    # Обновляются в той же транзакции, что и add_joy; rebuild_joy_stats — пересчёт.
+    stats_created = "joy_stats" not in _existing_tables(cur)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS joy_stats (
+            chat_id INTEGER PRIMARY KEY,
+            total INTEGER NOT NULL,
+            first_day TEXT NOT NULL,
+            last_day TEXT NOT NULL,
+            current_streak INTEGER NOT NULL,
+            longest_streak INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
         )
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS joy_day_counts (
+            chat_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, day)
+        ) WITHOUT ROWID
+    """)
 
-    # Для отслеживания обработанных update_id
+    # Журнал update_id выше watermark, у которых были записи: строка пишется
+    # в одном коммите с ними (см. commit_update), поэтому повторная доставка
+    # после рестарта не задвоит радость. Update без записей сюда не попадают.
+    # Строки не выше watermark подчищает prune_processed_updates.
     cur.execute("""
         CREATE TABLE IF NOT EXISTS processed_updates (
             update_id INTEGER PRIMARY KEY,
@@ -513,6 +1225,23 @@ def init_db():
         )
     """)
 
+    # Служебные значения бота (watermark update_id и т.п.)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    # Базы до появления watermark: начинаем с максимума старого журнала
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO bot_state (key, value, updated_at)
+        SELECT ?, MAX(update_id), ? FROM processed_updates HAVING MAX(update_id) IS NOT NULL
+        """,
+        (UpdateDeduplicator.STATE_KEY, now_minsk().isoformat(timespec="seconds")),
+    )
+
     # Для напоминаний и отчётов
     cur.execute("""
         CREATE TABLE IF NOT EXISTS sent_reminders (
@@ -525,6 +1254,28 @@ def init_db():
         )
     """)
 
+    # Часовой пояс, время доставки и ближайшие моменты доставки (UTC)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS user_settings (
+            chat_id INTEGER PRIMARY KEY,
+            tz TEXT NOT NULL,
+            reminder_time TEXT NOT NULL,
+            report_time TEXT NOT NULL,
+            next_reminder_at TEXT NOT NULL,
+            next_report_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_settings_next_reminder
+        ON user_settings (next_reminder_at, chat_id)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_user_settings_next_report
+        ON user_settings (next_report_at, chat_id)
+    """)
+    _migrate_user_settings(cur)
+
     # Для диалога письма в будущее
     cur.execute("""
         CREATE TABLE IF NOT EXISTS dialog_state (
@@ -536,87 +1287,350 @@ def init_db():
     """)
 
     conn.commit()
-    conn.close()
 
+    if stats_created:
+        # Старая база: считаем агрегаты по уже записанным радостям
+        rebuild_joy_stats()
+    # Строки без меток (старые базы) размечаем один раз
+    if backfill_labels:
+        labelled = backfill_joy_labels()
+        if labelled:
+            print(f"Размечено радостей: {labelled}")
 
-def add_joy(chat_id: int, text: str):
-    conn = db_connect()
-    cur = conn.cursor()
+
+def _existing_tables(cur: sqlite3.Cursor) -> set:
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    return {row[0] for row in cur.fetchall()}
+
+
+def add_joy(chat_id: int, text: str,
+            classification: Optional["MessageClassification"] = None) -> WriteHandle:
+    """
+    Сохраняет радость (групповым коммитом). Внутри обработки update запись
+    коммитится вместе с update (см. after_commit), иначе wait() на результате
+    дожидается записи.
+    classification — результат classify_message, если сообщение уже
+    классифицировано: метки и версия словарей берутся из него.
+    """
+    if classification is None:
+        classification = classify_message(text)
+    flags = joy_flags(classification)
+    settings = get_user_settings(chat_id)
     created_at = now_minsk().isoformat(timespec="seconds")
-    cur.execute(
-        "INSERT INTO joys (chat_id, text, created_at) VALUES (?, ?, ?)",
-        (chat_id, text, created_at),
-    )
-    conn.commit()
-    conn.close()
+    # day — календарный день в часовом поясе пользователя
+    day = settings.today().isoformat()
+    return db_write(_write_joy, settings, text, created_at, day, flags, classification.version)
 
 
-def get_joy_count(chat_id: int) -> int:
-    conn = db_connect()
-    cur = conn.cursor()
+def _write_joy(settings: UserSettings, text: str, created_at: str, day: str,
+               flags: int, lexicon_version: str):
+    cur = db_connect().cursor()
     cur.execute(
-        "SELECT COUNT(*) FROM joys WHERE chat_id = ?",
-        (chat_id,),
+        """
+        INSERT INTO joys (chat_id, text, created_at, day, flags, lexicon_version)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (settings.chat_id, text, created_at, day, flags, lexicon_version),
     )
-    count = cur.fetchone()[0]
-    conn.close()
-    return count
+    _bump_joy_stats(cur, settings.chat_id, day)
+    if not settings.stored:
+        insert_user_settings(settings)
 
 
-def get_todays_joys(chat_id: int) -> List[str]:
-    conn = db_connect()
-    cur = conn.cursor()
-    today = today_minsk().isoformat()
+def _bump_joy_stats(cur: sqlite3.Cursor, chat_id: int, day: str):
+    """Учитывает одну новую радость за day в агрегатах (внутри транзакции add_joy)."""
     cur.execute(
         """
-        SELECT text
-        FROM joys
-        WHERE chat_id = ?
-          AND substr(created_at, 1, 10) = ?
-        ORDER BY created_at ASC
+        INSERT INTO joy_day_counts (chat_id, day, count) VALUES (?, ?, 1)
+        ON CONFLICT(chat_id, day) DO UPDATE SET count = count + 1
         """,
-        (chat_id, today),
+        (chat_id, day),
     )
-    joys = [row[0] for row in cur.fetchall()]
-    joys = [j for j in joys if not is_sad_message(j)]
-    conn.close()
-    return joys
-
+    cur.execute(
+        "SELECT total, first_day, last_day, current_streak, longest_streak FROM joy_stats WHERE chat_id = ?",
+        (chat_id,),
+    )
+    row = cur.fetchone()
+    updated_at = now_minsk().isoformat(timespec="seconds")
+    if row is None:
+        cur.execute(
+            """
+            INSERT INTO joy_stats
+                (chat_id, total, first_day, last_day, current_streak, longest_streak, updated_at)
+            VALUES (?, 1, ?, ?, 1, 1, ?)
+            """,
+            (chat_id, day, day, updated_at),
+        )
+        return
 
-def get_all_joys(chat_id: int) -> List[Tuple[str, str]]:
-    """Получить все радости пользователя с датами."""
-    conn = db_connect()
-    cur = conn.cursor()
+    total, first_day, last_day, current, longest = row
+    if day > last_day:
+        gap = (date.fromisoformat(day) - date.fromisoformat(last_day)).days
+        current = current + 1 if gap == 1 else 1
+        last_day = day
+        longest = max(longest, current)
+    # day <= last_day (тот же день или сдвиг часового пояса назад) — серия не меняется
     cur.execute(
         """
-        SELECT text, created_at
-        FROM joys
+        UPDATE joy_stats
+        SET total = ?, first_day = ?, last_day = ?, current_streak = ?, longest_streak = ?, updated_at = ?
         WHERE chat_id = ?
-        ORDER BY created_at DESC
         """,
+        (total + 1, min(first_day, day), last_day, current, longest, updated_at, chat_id),
+    )
+
+
+def _streaks(days: List[str]) -> Tuple[int, int]:
+    """(серия, заканчивающаяся последним днём; самая длинная серия) по отсортированным дням."""
+    current = longest = 0
+    prev: Optional[date] = None
+    for day_str in days:
+        day_obj = date.fromisoformat(day_str)
+        current = current + 1 if prev is not None and (day_obj - prev).days == 1 else 1
+        longest = max(longest, current)
+        prev = day_obj
+    return current, longest
+
+
+def rebuild_joy_stats(chat_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Пересчитывает агрегаты /stats по таблице joys (для всех или для chat_ids).
+    Пользователи обрабатываются по одному, каждый — своей транзакцией.
+    Возвращает число пересчитанных пользователей.
+    """
+    conn = db_connect()
+    cur = conn.cursor()
+    if chat_ids is None:
+        chat_ids = get_all_user_ids()
+    updated_at = now_minsk().isoformat(timespec="seconds")
+    rebuilt = 0
+    for chat_id in chat_ids:
+        with db_transaction():
+            cur.execute(
+                "SELECT day, COUNT(*) FROM joys WHERE chat_id = ? GROUP BY day ORDER BY day",
+                (chat_id,),
+            )
+            day_counts = cur.fetchall()
+            cur.execute("DELETE FROM joy_day_counts WHERE chat_id = ?", (chat_id,))
+            cur.execute("DELETE FROM joy_stats WHERE chat_id = ?", (chat_id,))
+            if day_counts:
+                cur.executemany(
+                    "INSERT INTO joy_day_counts (chat_id, day, count) VALUES (?, ?, ?)",
+                    [(chat_id, day, count) for day, count in day_counts],
+                )
+                current, longest = _streaks([day for day, _ in day_counts])
+                cur.execute(
+                    """
+                    INSERT INTO joy_stats
+                        (chat_id, total, first_day, last_day, current_streak, longest_streak, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        chat_id, sum(count for _, count in day_counts),
+                        day_counts[0][0], day_counts[-1][0], current, longest, updated_at,
+                    ),
+                )
+        rebuilt += 1
+    return rebuilt
+
+
+class JoyStats:
+    """Агрегаты пользователя для /stats."""
+
+    __slots__ = ("total", "first_day", "last_day", "current_streak", "longest_streak", "week_total")
+
+    def __init__(self, total: int = 0, first_day: Optional[date] = None, last_day: Optional[date] = None,
+                 current_streak: int = 0, longest_streak: int = 0, week_total: int = 0):
+        self.total = total
+        self.first_day = first_day
+        self.last_day = last_day
+        self.current_streak = current_streak
+        self.longest_streak = longest_streak
+        self.week_total = week_total
+
+
+def get_joy_stats(chat_id: int, today: Optional[date] = None) -> JoyStats:
+    """
+    Агрегаты пользователя: одна строка joy_stats по ключу и до 7 строк
+    joy_day_counts по первичному ключу — без прохода по joys.
+    Серия считается текущей, если последняя запись сегодня или вчера.
+    """
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute(
+        "SELECT total, first_day, last_day, current_streak, longest_streak FROM joy_stats WHERE chat_id = ?",
         (chat_id,),
     )
-    joys = [(row[0], row[1]) for row in cur.fetchall()]
-    conn.close()
-    return joys
+    row = cur.fetchone()
+    if row is None:
+        return JoyStats()
+
+    total, first_day, last_day, current, longest = row
+    today = today or get_user_settings(chat_id).today()
+    last_day_obj = date.fromisoformat(last_day)
+    if (today - last_day_obj).days > 1:
+        current = 0
+    cur.execute(
+        "SELECT COALESCE(SUM(count), 0) FROM joy_day_counts WHERE chat_id = ? AND day > ? AND day <= ?",
+        (chat_id, (today - timedelta(days=7)).isoformat(), today.isoformat()),
+    )
+    week_total = cur.fetchone()[0]
+    return JoyStats(total, date.fromisoformat(first_day), last_day_obj, current, longest, week_total)
 
 
-def has_joy_for_date(chat_id: int, date_obj: date) -> bool:
+def get_joy_count(chat_id: int) -> int:
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute("SELECT total FROM joy_stats WHERE chat_id = ?", (chat_id,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+# Сколько строк размечать за одну транзакцию
+JOY_LABEL_CHUNK = 1000
+
+
+def backfill_joy_labels(chunk: int = JOY_LABEL_CHUNK) -> int:
+    """
+    Размечает строки joys без меток (flags IS NULL) по id-курсору, пачками.
+    Возвращает число размеченных строк.
+    """
+    conn = db_connect()
+    cur = conn.cursor()
+    last_id = 0
+    labelled = 0
+    while True:
+        cur.execute(
+            "SELECT id, text FROM joys WHERE id > ? AND flags IS NULL ORDER BY id LIMIT ?",
+            (last_id, chunk),
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return labelled
+        lexicon = LEXICON
+        with db_transaction():
+            cur.executemany(
+                "UPDATE joys SET flags = ?, lexicon_version = ? WHERE id = ?",
+                [(classify_joy(text, lexicon), lexicon.version, joy_id) for joy_id, text in rows],
+            )
+        labelled += len(rows)
+        last_id = rows[-1][0]
+
+
+# Порядок отчёта wantnow: новые дни сверху, внутри дня — новые записи сверху.
+# Ключ (day, created_at, id) целиком лежит в idx_joys_chat_day (+ rowid),
+# поэтому страница — это диапазонный проход по индексу от курсора.
+_JOYS_PAGE_ORDER_DESC = "day DESC, created_at DESC, id DESC"
+_JOYS_PAGE_ORDER_ASC = "day ASC, created_at ASC, id ASC"
+
+
+def _joy_page_key(cur: sqlite3.Cursor, chat_id: int, joy_id: int) -> Optional[Tuple[str, str, int]]:
+    cur.execute("SELECT day, created_at, id FROM joys WHERE id = ? AND chat_id = ?", (joy_id, chat_id))
+    return cur.fetchone()
+
+
+def iter_joys_page(chat_id: int, limit: int, before_id: Optional[int] = None,
+                   after_id: Optional[int] = None,
+                   from_id: Optional[int] = None) -> Iterator[Tuple[int, str, str]]:
+    """
+    Страница радостей (id, day, text) в порядке отчёта, не больше limit.
+    Keyset-пагинация: before_id — записи старше указанной (следующая страница),
+    after_id — новее неё (предыдущая), from_id — начиная с неё самой.
+    Строки читаются курсором, по одной.
+    """
+    conn = db_connect()
+    cur = conn.cursor()
+    if after_id is not None:
+        key = _joy_page_key(cur, chat_id, after_id)
+        if key is None:
+            return
+        # Ближайшие более новые — по возрастанию, затем разворачиваем (их не больше limit)
+        cur.execute(
+            f"""
+            SELECT id, day, text FROM joys
+            WHERE chat_id = ? AND (day, created_at, id) > (?, ?, ?)
+            ORDER BY {_JOYS_PAGE_ORDER_ASC}
+            LIMIT ?
+            """,
+            (chat_id, *key, limit),
+        )
+        yield from reversed(cur.fetchall())
+        return
+
+    if before_id is not None or from_id is not None:
+        key = _joy_page_key(cur, chat_id, before_id if before_id is not None else from_id)
+        if key is None:
+            return
+        op = "<" if before_id is not None else "<="
+        cur.execute(
+            f"""
+            SELECT id, day, text FROM joys
+            WHERE chat_id = ? AND (day, created_at, id) {op} (?, ?, ?)
+            ORDER BY {_JOYS_PAGE_ORDER_DESC}
+            LIMIT ?
+            """,
+            (chat_id, *key, limit),
+        )
+    else:
+        cur.execute(
+            f"""
+            SELECT id, day, text FROM joys
+            WHERE chat_id = ?
+            ORDER BY {_JOYS_PAGE_ORDER_DESC}
+            LIMIT ?
+            """,
+            (chat_id, limit),
+        )
+    yield from cur
+
+
+def get_joy_page_start(chat_id: int, page: int, page_size: int) -> Optional[int]:
+    """
+    id первой записи страницы page (с 1) для перехода по номеру ("wantnow 3").
+    Пропуск идёт только по индексу, без чтения текстов.
+    """
     conn = db_connect()
     cur = conn.cursor()
-    date_str = date_obj.isoformat()
     cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM joys
+        f"""
+        SELECT id FROM joys
         WHERE chat_id = ?
-          AND substr(created_at, 1, 10) = ?
+        ORDER BY {_JOYS_PAGE_ORDER_DESC}
+        LIMIT 1 OFFSET ?
         """,
-        (chat_id, date_str),
+        (chat_id, (page - 1) * page_size),
     )
-    count = cur.fetchone()[0]
-    conn.close()
-    return count > 0
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def has_joys_around(chat_id: int, joy_id: int, newer: bool) -> bool:
+    """Есть ли записи новее (newer=True) или старше указанной."""
+    conn = db_connect()
+    cur = conn.cursor()
+    key = _joy_page_key(cur, chat_id, joy_id)
+    if key is None:
+        return False
+    op = ">" if newer else "<"
+    cur.execute(
+        f"SELECT EXISTS(SELECT 1 FROM joys WHERE chat_id = ? AND (day, created_at, id) {op} (?, ?, ?))",
+        (chat_id, *key),
+    )
+    return bool(cur.fetchone()[0])
+
+
+def count_newer_joys_same_day(chat_id: int, joy_id: int) -> int:
+    """Сколько записей того же дня новее указанной (для сквозной нумерации внутри дня)."""
+    conn = db_connect()
+    cur = conn.cursor()
+    key = _joy_page_key(cur, chat_id, joy_id)
+    if key is None:
+        return 0
+    cur.execute(
+        "SELECT COUNT(*) FROM joys WHERE chat_id = ? AND day = ? AND (created_at, id) > (?, ?)",
+        (chat_id, key[0], key[1], key[2]),
+    )
+    return cur.fetchone()[0]
 
 
 def get_all_user_ids() -> List[int]:
@@ -624,78 +1638,556 @@ def get_all_user_ids() -> List[int]:
     cur = conn.cursor()
     cur.execute("SELECT DISTINCT chat_id FROM joys")
     rows = cur.fetchall()
-    conn.close()
     return [r[0] for r in rows]
 
 
+def get_bot_state(key: str) -> Optional[str]:
+    conn = db_connect()
+    cur = conn.cursor()
+    cur.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def set_bot_state(key: str, value: str):
+    conn = db_connect()
+    cur = conn.cursor()
+    now = now_minsk().isoformat(timespec="seconds")
+    with db_transaction():
+        cur.execute(
+            """
+            INSERT INTO bot_state (key, value, updated_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET
+                value = excluded.value,
+                updated_at = excluded.updated_at
+            """,
+            (key, value, now),
+        )
+
+
+class UpdateDeduplicator:
+    """
+    Дедупликация update_id.
+
+    Telegram выдаёт update_id по возрастанию, поэтому достаточно:
+    - watermark — update_id, до которого всё обработано (хранится в bot_state,
+      в памяти — копия, читается один раз);
+    - небольшого окна id выше watermark, уже взятых в работу (только в памяти).
+    Бот работает одним экземпляром: watermark и окно меняет только этот
+    процесс, поэтому проверка — сравнение в памяти. Повторную доставку
+    после рестарта ловит отметка в processed_updates (см. commit_update).
+    Упавшие update ждут повтора (до UPDATE_MAX_ATTEMPTS попыток), и watermark
+    не проходит выше них.
+    """
+
+    STATE_KEY = "update_watermark"
+
+    def __init__(self, window: int = UPDATE_DEDUP_WINDOW, max_attempts: int = UPDATE_MAX_ATTEMPTS):
+        self._lock = threading.Lock()
+        self._window = window
+        self._max_attempts = max_attempts
+        self._recent: set = set()
+        self._recent_order: deque = deque()
+        # update_id -> число неудачных попыток (ждут повтора)
+        self._failures: Dict[int, int] = {}
+        self.watermark: Optional[int] = None
+
+    def _ensure_loaded(self):
+        if self.watermark is not None:
+            return
+        stored = get_bot_state(self.STATE_KEY)
+        self.watermark = int(stored) if stored else 0
+
+    def is_new(self, update_id: int) -> bool:
+        """True, если update ещё не обработан и не взят в работу (и запоминает его)."""
+        with self._lock:
+            self._ensure_loaded()
+            if update_id <= self.watermark or update_id in self._recent:
+                return False
+            self._recent.add(update_id)
+            self._recent_order.append(update_id)
+            while len(self._recent_order) > self._window:
+                self._recent.discard(self._recent_order.popleft())
+            return True
+
+    def current(self) -> int:
+        """Текущий подтверждённый watermark (0, если update ещё не было)."""
+        with self._lock:
+            self._ensure_loaded()
+            return self.watermark
+
+    def release(self, update_id: int):
+        """Update больше не ждёт повтора: обработан, оказался дублем или пропущен."""
+        with self._lock:
+            self._failures.pop(update_id, None)
+
+    def failed(self, update_id: int) -> bool:
+        """
+        Update упал. True — его стоит обработать снова (id освобождается
+        из окна); False — попытки исчерпаны, update пропускается.
+        """
+        with self._lock:
+            attempts = self._failures.get(update_id, 0) + 1
+            if attempts >= self._max_attempts:
+                self._failures.pop(update_id, None)
+                return False
+            self._failures[update_id] = attempts
+            if update_id in self._recent:
+                self._recent.discard(update_id)
+                self._recent_order.remove(update_id)
+            return True
+
+    def advance(self, update_id: int) -> bool:
+        """
+        Подтверждает, что все update до update_id включительно обработаны.
+        Не проходит выше update, ждущих повтора. Пишет в БД только
+        если watermark действительно сдвинулся.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if self._failures:
+                update_id = min(update_id, min(self._failures) - 1)
+            if update_id <= self.watermark:
+                return False
+            set_bot_state(self.STATE_KEY, str(update_id))
+            self.watermark = update_id
+            while self._recent_order and self._recent_order[0] <= update_id:
+                self._recent.discard(self._recent_order.popleft())
+            return True
+
+
+UPDATE_DEDUP = UpdateDeduplicator()
+
+
 def mark_update_processed(update_id: int) -> bool:
     """
-    Пытается пометить update как обработанный.
-    Возвращает True, если запись добавлена впервые.
-    Возвращает False, если такой update_id уже есть.
+    Пытается взять update в работу.
+    Возвращает True, если update ещё не обработан.
+    Возвращает False, если такой update_id уже обработан или уже в работе.
+    """
+    return UPDATE_DEDUP.is_new(update_id)
+
+
+def prune_processed_updates(limit: int = UPDATE_PRUNE_CHUNK) -> int:
     """
+    Удаляет порцию старых строк processed_updates (не выше watermark).
+    Возвращает число удалённых строк.
+    """
+    watermark = UPDATE_DEDUP.current()
+    if not watermark:
+        return 0
     conn = db_connect()
     cur = conn.cursor()
-    processed_at = now_minsk().isoformat(timespec="seconds")
-    try:
+    with db_transaction():
         cur.execute(
-            "INSERT INTO processed_updates (update_id, processed_at) VALUES (?, ?)",
-            (update_id, processed_at)
+            """
+            DELETE FROM processed_updates
+            WHERE update_id IN (
+                SELECT update_id
+                FROM processed_updates
+                WHERE update_id <= ?
+                LIMIT ?
+            )
+            """,
+            (watermark, limit),
         )
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
+    return cur.rowcount
+
+
+def processed_updates_pruner():
+    """Фоновый поток: понемногу чистит processed_updates, не блокируя запись надолго."""
+    while True:
+        try:
+            while prune_processed_updates() > 0:
+                time.sleep(0.1)
+        except Exception as e:
+            print(f"Ошибка при очистке processed_updates: {e}")
+        time.sleep(UPDATE_PRUNE_INTERVAL)
+
+
+def mark_reminders_sent(entries: List[Tuple[int, date]], reminder_type: str):
+    """Отмечает рассылку для пачки (chat_id, местный день) одной транзакцией."""
+    if not entries:
+        return
+    conn = db_connect()
+    cur = conn.cursor()
+    sent_at = now_minsk().isoformat(timespec="seconds")
+    with db_transaction():
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO sent_reminders (chat_id, reminder_date, reminder_type, sent_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            [(chat_id, day.isoformat(), reminder_type, sent_at) for chat_id, day in entries],
+        )
+
+
+def _user_settings_row(settings: UserSettings) -> Tuple:
+    """Строка user_settings с пересчитанными ближайшими моментами доставки."""
+    now = utc_now()
+    today = settings.today()
+    next_at = {}
+    for kind in DELIVERY_KINDS:
+        if settings.stored:
+            next_at[kind] = settings.next_due(kind, now)
+        else:
+            # Новый пользователь: сегодняшняя доставка (если уже прошла —
+            # планировщик сразу решит, догонять её или нет)
+            next_at[kind] = settings.due_at(kind, today)
+    return (
+        settings.chat_id,
+        settings.tz_name,
+        settings.reminder_time.strftime("%H:%M"),
+        settings.report_time.strftime("%H:%M"),
+        to_utc_iso(next_at["reminder"]),
+        to_utc_iso(next_at["report"]),
+        now_minsk().isoformat(timespec="seconds"),
+    )
+
+
+def _settings_from_row(chat_id: int, tz_name: str, reminder_time: str, report_time: str) -> UserSettings:
+    return UserSettings(
+        chat_id,
+        tz_name,
+        parse_hhmm(reminder_time) or DEFAULT_REMINDER_TIME,
+        parse_hhmm(report_time) or DEFAULT_REPORT_TIME,
+        stored=True,
+    )
 
 
-def has_sent_reminder_today(chat_id: int, reminder_type: str) -> bool:
+def get_user_settings(chat_id: int) -> UserSettings:
+    """Настройки пользователя (по умолчанию — Минск, 20:00 и 22:00)."""
     conn = db_connect()
     cur = conn.cursor()
-    today = today_minsk().isoformat()
     cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM sent_reminders
-        WHERE chat_id = ?
-          AND reminder_date = ?
-          AND reminder_type = ?
-        """,
-        (chat_id, today, reminder_type),
+        "SELECT tz, reminder_time, report_time FROM user_settings WHERE chat_id = ?",
+        (chat_id,),
     )
-    count = cur.fetchone()[0]
-    conn.close()
-    return count > 0
+    row = cur.fetchone()
+    if not row:
+        return UserSettings(chat_id)
+    return _settings_from_row(chat_id, *row)
 
 
-def mark_reminder_sent(chat_id: int, reminder_type: str):
+def insert_user_settings(settings: UserSettings):
+    """Создаёт строку настроек, если её ещё нет."""
     conn = db_connect()
     cur = conn.cursor()
-    today = today_minsk().isoformat()
-    sent_at = now_minsk().isoformat(timespec="seconds")
-    try:
+    with db_transaction():
         cur.execute(
             """
-            INSERT INTO sent_reminders (chat_id, reminder_date, reminder_type, sent_at)
-            VALUES (?, ?, ?, ?)
+            INSERT OR IGNORE INTO user_settings
+                (chat_id, tz, reminder_time, report_time, next_reminder_at, next_report_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
             """,
-            (chat_id, today, reminder_type, sent_at),
+            _user_settings_row(settings),
         )
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-    finally:
-        conn.close()
+    settings.stored = True
 
 
+def save_user_settings(settings: UserSettings) -> WriteHandle:
+    """Сохраняет настройки и переносит ближайшие доставки под новое время."""
+    settings.stored = True
+    return db_write(_write_user_settings, _user_settings_row(settings))
 
-def set_dialog_state(chat_id: int, state: str, meta: Optional[dict] = None):
+
+def _write_user_settings(row: Tuple):
+    cur = db_connect().cursor()
+    with db_transaction():
+        cur.execute(
+            """
+            INSERT INTO user_settings
+                (chat_id, tz, reminder_time, report_time, next_reminder_at, next_report_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id) DO UPDATE SET
+                tz = excluded.tz,
+                reminder_time = excluded.reminder_time,
+                report_time = excluded.report_time,
+                next_reminder_at = excluded.next_reminder_at,
+                next_report_at = excluded.next_report_at,
+                updated_at = excluded.updated_at
+            """,
+            row,
+        )
+
+
+def _check_delivery_kind(kind: str):
+    if kind not in DELIVERY_KINDS:
+        raise ValueError(f"Неизвестный тип доставки: {kind}")
+
+
+def next_delivery_at() -> Optional[datetime]:
+    """Ближайший момент доставки среди всех пользователей (по индексам)."""
+    cur = db_connect().cursor()
+    cur.execute("""
+        SELECT MIN(next_at) FROM (
+            SELECT MIN(next_reminder_at) AS next_at FROM user_settings
+            UNION ALL
+            SELECT MIN(next_report_at) FROM user_settings
+        )
+    """)
+    value = cur.fetchone()[0]
+    return from_utc_iso(value) if value else None
+
+
+def get_upcoming_deliveries(limit: int = 10) -> List[Tuple[datetime, str, int]]:
+    """Ближайшие доставки: [(момент UTC, тип, chat_id)]."""
+    cur = db_connect().cursor()
+    cur.execute(
+        """
+        SELECT next_at, kind, chat_id FROM (
+            SELECT * FROM (
+                SELECT next_reminder_at AS next_at, 'reminder' AS kind, chat_id
+                FROM user_settings ORDER BY next_reminder_at LIMIT :limit
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT next_report_at, 'report', chat_id
+                FROM user_settings ORDER BY next_report_at LIMIT :limit
+            )
+        )
+        ORDER BY next_at
+        LIMIT :limit
+        """,
+        {"limit": limit},
+    )
+    return [(from_utc_iso(next_at), kind, chat_id) for next_at, kind, chat_id in cur.fetchall()]
+
+
+def _iter_due_users(kind: str, now: datetime,
+                    chunk: int = FANOUT_CHUNK) -> Iterator[List[Tuple[UserSettings, datetime]]]:
+    """
+    Пользователи, чья доставка kind наступила к now, пачками
+    (keyset-пагинация по индексу (next_<kind>_at, chat_id)).
+    """
+    _check_delivery_kind(kind)
+    column = f"next_{kind}_at"
+    conn = db_connect()
+    now_str = to_utc_iso(now)
+    last_at, last_chat_id = "", _MIN_CHAT_ID
+    while True:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT chat_id, tz, reminder_time, report_time, {column}
+            FROM user_settings
+            WHERE {column} <= :now
+              AND ({column} > :last_at OR ({column} = :last_at AND chat_id > :last_id))
+            ORDER BY {column}, chat_id
+            LIMIT :limit
+            """,
+            {"now": now_str, "last_at": last_at, "last_id": last_chat_id, "limit": chunk},
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return
+        yield [
+            (_settings_from_row(chat_id, tz_name, reminder_time, report_time), from_utc_iso(due))
+            for chat_id, tz_name, reminder_time, report_time, due in rows
+        ]
+        if len(rows) < chunk:
+            return
+        last_at, last_chat_id = rows[-1][4], rows[-1][0]
+
+
+# Минимальный chat_id для keyset-пагинации (id групп отрицательные)
+_MIN_CHAT_ID = -(2 ** 63)
+
+
+def iter_due_plan(kind: str, now: datetime, advance: List[Tuple[int, str, str]],
+                  chunk: int = FANOUT_CHUNK) -> Iterator[List[Tuple[int, date, object]]]:
+    """
+    План доставки kind для всех, у кого она наступила, пачками [(chat_id, местный день, данные)]:
+    - просроченные (после крайнего срока догонки) пропускаются;
+    - уже получившие сегодня (sent_reminders) отсеиваются одним запросом на пачку;
+    - напоминание — только тем, у кого за местный день нет записей;
+    - для отчёта радости всей пачки читаются ещё одним запросом.
+    В advance складывается (chat_id, старый, новый next_at) для всех обработанных —
+    сдвинуть их после рассылки (advance_deliveries).
+    """
+    _check_delivery_kind(kind)
+    conn = db_connect()
+    skipped = 0
+    for users in _iter_due_users(kind, now, chunk):
+        due_days: List[Tuple[int, str]] = []
+        for settings, due in users:
+            day = settings.day_of(kind, due)
+            advance.append((settings.chat_id, to_utc_iso(due), to_utc_iso(settings.next_due(kind, now))))
+            if now >= settings.deadline(kind, day):
+                skipped += 1
+                continue
+            due_days.append((settings.chat_id, day.isoformat()))
+        if not due_days:
+            continue
+
+        values = ",".join("(?, ?)" for _ in due_days)
+        params: List[object] = [p for pair in due_days for p in pair]
+        joy_filter = """
+              AND NOT EXISTS (
+                  SELECT 1 FROM joys j
+                  WHERE j.chat_id = d.chat_id AND j.day = d.day
+              )""" if kind == "reminder" else ""
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            WITH due(chat_id, day) AS (VALUES {values})
+            SELECT d.chat_id, d.day
+            FROM due d
+            WHERE NOT EXISTS (
+                SELECT 1 FROM sent_reminders s
+                WHERE s.chat_id = d.chat_id
+                  AND s.reminder_date = d.day
+                  AND s.reminder_type = ?
+            ){joy_filter}
+            """,
+            params + [kind],
+        )
+        pending = cur.fetchall()
+        if not pending:
+            continue
+
+        if kind == "reminder":
+            yield [(chat_id, date.fromisoformat(day), None) for chat_id, day in pending]
+            continue
+
+        joys_by_chat: Dict[int, List[str]] = {chat_id: [] for chat_id, _ in pending}
+        values = ",".join("(?, ?)" for _ in pending)
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            WITH due(chat_id, day) AS (VALUES {values})
+            SELECT j.chat_id, j.text
+            FROM due d
+            JOIN joys j ON j.chat_id = d.chat_id AND j.day = d.day
+            WHERE (j.flags & ?) = 0
+            ORDER BY j.chat_id, j.created_at ASC
+            """,
+            [p for pair in pending for p in pair] + [JOY_REPORT_EXCLUDE_FLAGS],
+        )
+        for chat_id, text in cur.fetchall():
+            joys_by_chat[chat_id].append(text)
+        yield [(chat_id, date.fromisoformat(day), joys_by_chat[chat_id]) for chat_id, day in pending]
+
+    if skipped:
+        print(f"{kind}: пропущено просроченных доставок: {skipped}")
+
+
+def advance_deliveries(kind: str, advance: List[Tuple[int, str, str]]):
+    """
+    Переносит next_<kind>_at обработанных пользователей на следующую доставку.
+    Не трогает тех, кто успел поменять настройки во время рассылки.
+    """
+    _check_delivery_kind(kind)
+    if not advance:
+        return
+    column = f"next_{kind}_at"
     conn = db_connect()
     cur = conn.cursor()
+    for start in range(0, len(advance), FANOUT_CHUNK):
+        with db_transaction():
+            cur.executemany(
+                f"UPDATE user_settings SET {column} = ? WHERE chat_id = ? AND {column} = ?",
+                [(new, chat_id, old) for chat_id, old, new in advance[start:start + FANOUT_CHUNK]],
+            )
+
+
+class DialogStateCache:
+    """
+    Кеш dialog_state: write-through из set/clear_dialog_state, отрицательные
+    записи для чатов без диалога, LRU/TTL через LruCache.
+    После прогрева (warm_up) кеш знает все чаты, у которых есть состояние
+    (их немного — только незаконченные диалоги), поэтому для остальных
+    ответ "диалога нет" получается без обращения к БД.
+    """
+
+    def __init__(self, capacity: int = DIALOG_CACHE_SIZE, ttl: float = DIALOG_CACHE_TTL):
+        self._cache = LruCache(capacity, ttl)
+        self._lock = threading.Lock()
+        # chat_id всех чатов с состоянием; None — не прогрет (или не влез в память)
+        self._with_state: Optional[set] = None
+
+    def warm_up(self, rows: Iterable[Tuple[int, Optional[str], Optional[dict]]]):
+        with_state = set()
+        for chat_id, state, meta in rows:
+            with_state.add(chat_id)
+            if len(with_state) > self._cache.capacity:
+                print("dialog_state не помещается в кеш — без отрицательного прогрева")
+                with self._lock:
+                    self._with_state = None
+                return
+            self._cache.put(chat_id, (state, meta))
+        with self._lock:
+            self._with_state = with_state
+
+    def get(self, chat_id: int) -> Optional[Tuple[Optional[str], Optional[dict]]]:
+        """(state, meta) из кеша или None, если нужно читать БД."""
+        cached = self._cache.get(chat_id)
+        if cached is not None:
+            return cached
+        with self._lock:
+            known_empty = self._with_state is not None and chat_id not in self._with_state
+        if known_empty:
+            cached = (None, None)
+            self._cache.put(chat_id, cached)
+            return cached
+        return None
+
+    def store(self, chat_id: int, state: Optional[str], meta: Optional[dict]):
+        """Запомнить актуальное состояние (после чтения из БД или записи в неё)."""
+        self._cache.put(chat_id, (state, meta))
+        with self._lock:
+            if self._with_state is None:
+                return
+            if state is None:
+                self._with_state.discard(chat_id)
+            elif len(self._with_state) < self._cache.capacity:
+                self._with_state.add(chat_id)
+            else:
+                self._with_state = None
+
+    def stats(self) -> Dict[str, int]:
+        stats = self._cache.stats()
+        stats["warm"] = int(self._with_state is not None)
+        return stats
+
+
+DIALOG_CACHE = DialogStateCache()
+
+
+def _decode_dialog_meta(meta_json: Optional[str]) -> Optional[dict]:
+    if not meta_json:
+        return None
+    try:
+        return json.loads(meta_json)
+    except Exception:
+        return None
+
+
+def warm_dialog_state_cache():
+    """Загружает все незаконченные диалоги в кеш (при старте бота)."""
+    cur = db_connect().cursor()
+    cur.execute("SELECT chat_id, state, meta FROM dialog_state WHERE state IS NOT NULL")
+    DIALOG_CACHE.warm_up(
+        (chat_id, state, _decode_dialog_meta(meta_json)) for chat_id, state, meta_json in cur
+    )
+
+
+def set_dialog_state(chat_id: int, state: str, meta: Optional[dict] = None):
+    """
+    Состояние диалога читается следующим же сообщением чата: кеш
+    обновляется только после коммита (read-your-writes) — в группе
+    с другими записями. Сообщения одного чата обрабатываются по очереди,
+    поэтому следующее увидит уже закоммиченное состояние.
+    """
     now = now_minsk().isoformat(timespec="seconds")
     meta_json = json.dumps(meta) if meta is not None else None
-    cur.execute(
+    handle = db_write(_write_dialog_state, chat_id, state, meta_json, now)
+    after_commit(handle, lambda: DIALOG_CACHE.store(chat_id, state, _decode_dialog_meta(meta_json)))
+
+
+def _write_dialog_state(chat_id: int, state: str, meta_json: Optional[str], now: str):
+    db_connect().execute(
         """
         INSERT INTO dialog_state (chat_id, state, meta, updated_at)
         VALUES (?, ?, ?, ?)
@@ -706,157 +2198,478 @@ def set_dialog_state(chat_id: int, state: str, meta: Optional[dict] = None):
         """,
         (chat_id, state, meta_json, now),
     )
-    conn.commit()
-    conn.close()
 
 
 def get_dialog_state(chat_id: int) -> Tuple[Optional[str], Optional[dict]]:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT state, meta FROM dialog_state WHERE chat_id = ?",
-        (chat_id,),
-    )
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None, None
-    state, meta_json = row
-    meta = None
-    if meta_json:
-        try:
-            meta = json.loads(meta_json)
-        except Exception:
-            meta = None
-    return state, meta
+    """Состояние диалога: из кеша, при промахе — из БД (с записью в кеш)."""
+    cached = DIALOG_CACHE.get(chat_id)
+    if cached is None:
+        cur = db_connect().cursor()
+        cur.execute(
+            "SELECT state, meta FROM dialog_state WHERE chat_id = ?",
+            (chat_id,),
+        )
+        row = cur.fetchone()
+        cached = (row[0], _decode_dialog_meta(row[1])) if row else (None, None)
+        DIALOG_CACHE.store(chat_id, *cached)
+    state, meta = cached
+    # копия — чтобы обработчик не поменял закешированный словарь
+    return state, dict(meta) if isinstance(meta, dict) else meta
 
 
 def clear_dialog_state(chat_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM dialog_state WHERE chat_id = ?", (chat_id,))
-    conn.commit()
-    conn.close()
+    handle = db_write(_delete_dialog_state, chat_id)
+    after_commit(handle, lambda: DIALOG_CACHE.store(chat_id, None, None))
+
+
+def _delete_dialog_state(chat_id: int):
+    db_connect().execute("DELETE FROM dialog_state WHERE chat_id = ?", (chat_id,))
 
 # --------------------------
 # Обработка текста
 # --------------------------
 
-def normalize_text_for_match(text: str) -> str:
-    lower = text.lower().replace("ё", "е")
-    normalized = re.sub(r"[^\w\s]+", " ", lower)
-    normalized = " ".join(normalized.split())
+# Раскладка: какая русская буква на той же клавише (включая ;[]',.` и их Shift-варианты)
+_LAYOUT_TABLE = str.maketrans(
+    "qwertyuiop[]{}asdfghjkl;:'\"zxcvbnm,.<>`~",
+    "йцукенгшщзхъхъфывапролджжээячсмитьбюбюёё",
+)
+# Слово целиком набрано латиницей (с клавишами, на которых в русской раскладке буквы)
+_LATIN_TOKEN_RE = re.compile(r"[a-z`~\[\]{};:'\",.<>]*[a-z][a-z`~\[\]{};:'\",.<>]*")
+# Обрамляющая пунктуация, которая не бывает буквой ни в одной раскладке
+_TOKEN_EDGE_CHARS = "!?()«»/\\-"
+_WORD_RE = re.compile(r"\w+")
+_NON_SPACE_RE = re.compile(r"\S+")
+
+# Транслит: сначала "y" после гласной → й ("moy", "krasivyy"), затем
+# многобуквенные сочетания (длинные раньше), затем одиночные буквы
+_TRANSLIT_Y_RE = re.compile(r"(?<=[aeiouy])y(?![aeiou])")
+_TRANSLIT_PAIRS = {
+    "shch": "щ", "sch": "щ", "zh": "ж", "kh": "х", "ts": "ц", "ch": "ч", "sh": "ш",
+    "yo": "ё", "yu": "ю", "ya": "я", "ye": "е",
+    "a": "а", "b": "б", "c": "ц", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х",
+    "i": "и", "j": "й", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п",
+    "q": "к", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс",
+    "y": "ы", "z": "з", "'": "ь",
+}
+_TRANSLIT_RE = re.compile("|".join(sorted(map(re.escape, _TRANSLIT_PAIRS), key=len, reverse=True)))
+# Признаки английского слова — такое слово транслитом не считаем ("wantnow", "hello", "coffee")
+_ENGLISH_MARKERS_RE = re.compile(r"[wqx]|th|ee|oo|ea|ou|ck|ph|gh|ll|tt|pp|ff|zz|c(?!h)")
+
+# "y" не считаем: в английской раскладке это "н", одна из частых русских букв
+_LATIN_VOWELS = frozenset("aeiou")
+_RU_VOWELS = frozenset("аеёиоуыэюя")
+_RU_CONSONANTS = frozenset("бвгджзйклмнпрстфхцчшщ")
+# Сочетания, которых в русских словах не бывает: так раскладка отличается от мусора
+_RU_IMPOSSIBLE_BIGRAMS = frozenset(
+    [v + s for v in _RU_VOWELS | {"ь", "ъ", "й"} for s in "ьъ"]
+    + [c + "ы" for c in "жшчщкгхйьъ" + "".join(_RU_VOWELS)]
+    + [c + v for c in "ьъ" for v in "ьъы"]
+    + ["йй", "ъа", "ъо", "ъу", "ъи", "ъы"]
+)
+# Не меньше стольки букв, чтобы судить о слове самом по себе;
+# слова короче переводятся, только если рядом есть уверенно переведённые
+_LATIN_MIN_DETECT_LEN = 4
+
+
+def _looks_russian(word: str) -> bool:
+    """Похоже ли на русское слово: есть гласные, нет невозможных сочетаний и длинных цепочек согласных."""
+    letters = [ch for ch in word if ch.isalpha()]
+    if not letters or letters[0] in "ьъы":
+        return False
+    vowels = sum(ch in _RU_VOWELS for ch in letters)
+    if vowels * 5 < len(letters):
+        return False
+    run = 0
+    for ch in letters:
+        run = run + 1 if ch in _RU_CONSONANTS else 0
+        if run > 4:
+            return False
+    return not any(word[i:i + 2] in _RU_IMPOSSIBLE_BIGRAMS for i in range(len(word) - 1))
+
+
+def _translit_to_russian(word: str) -> str:
+    word = _TRANSLIT_Y_RE.sub("j", word)
+    return _TRANSLIT_RE.sub(lambda m: _TRANSLIT_PAIRS[m.group()], word)
+
+
+def _latin_token_conversion(core: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Для латинского слова — (способ, русский вариант):
+    "layout" — набрано в английской раскладке ("ecnfkf" → "устала"),
+    "translit" — транслит ("grustno" → "грустно"), (None, None) — оставить как есть.
+    """
+    if len(core) < _LATIN_MIN_DETECT_LEN:
+        return None, None
+    letters = [ch for ch in core if "a" <= ch <= "z"]
+    # Русские гласные в английской раскладке — в основном f, t, b, j, s, z:
+    # английских гласных почти нет, а после перевода получается русское слово
+    latin_vowels = sum(ch in _LATIN_VOWELS for ch in letters)
+    if latin_vowels * 4 < len(letters):
+        layout = core.translate(_LAYOUT_TABLE)
+        if _looks_russian(layout):
+            return "layout", layout
+    if len(letters) == len(core) and not _ENGLISH_MARKERS_RE.search(core):
+        translit = _translit_to_russian(core)
+        if _looks_russian(translit):
+            return "translit", translit
+    return None, None
+
+
+def _convert_latin(core: str, mode: str) -> str:
+    if mode == "layout":
+        return core.translate(_LAYOUT_TABLE)
+    return _translit_to_russian(core) if core.isalpha() else core
+
+
+def _latin_message_confident(tokens: List[str], cores: List[Optional[str]],
+                             conversions: Dict[int, Tuple[str, str]], lexicon: "Lexicon") -> bool:
+    """
+    Всё сообщение набрано латиницей одним способом, и это уверенно русский текст:
+    каждое длинное слово переводится, а хотя бы половина из них после перевода —
+    слова из словарей или известные словоформы ("ya segodnya tak ustala").
+    Английский текст так почти не проходит: "best day ever" → "бест дай евер".
+    """
+    if any(core is None and any(ch.isalpha() for ch in token) for token, core in zip(tokens, cores)):
+        return False
+    long_words = [i for i, core in enumerate(cores) if core is not None and len(core) >= _LATIN_MIN_DETECT_LEN]
+    if not long_words or any(i not in conversions for i in long_words):
+        return False
+    if len({conversions[i][0] for i in long_words}) != 1:
+        return False
+    forms = [conversions[i][1].replace("ё", "е") for i in long_words]
+    in_lexicon = sum(form in lexicon.match_words for form in forms)
+    # Одно слово само по себе — только слово словарей: "karaoke", "broker" —
+    # английские слова, хоть по-русски и читаются
+    if len(forms) < 2 and not in_lexicon:
+        return False
+    known = sum(form in lexicon.match_words or form in lexicon.known_words for form in forms)
+    return known * 2 >= len(forms)
+
+
+def _fix_latin_tokens(tokens: List[str], lexicon: "Lexicon") -> List[str]:
+    """
+    Стадия нормализации: латинские слова, набранные не в той раскладке
+    или транслитом, заменяются русскими — только когда в этом есть уверенность:
+    - русский вариант — слово из словарей ("ecnfkf" → "устала"); короткое
+      слово — если рядом уже переведённый сосед ("ne znayu" → "не знаю");
+    - или всё сообщение уверенно русское (см. _latin_message_confident).
+    Английские слова ("best", "here", "debut", "poke") остаются как есть:
+    по отдельности они бывают похожи на русские и задевают словари.
+    """
+    cores: List[Optional[str]] = []
+    conversions: Dict[int, Tuple[str, str]] = {}
+    for i, token in enumerate(tokens):
+        core = token.strip(_TOKEN_EDGE_CHARS)
+        if (not core or not core.isascii() or not _LATIN_TOKEN_RE.fullmatch(core)
+                or core in lexicon.match_words):
+            cores.append(None)
+            continue
+        cores.append(core)
+        mode, russian = _latin_token_conversion(core)
+        if mode:
+            conversions[i] = (mode, russian)
+    if not conversions:
+        return tokens
+
+    fixed = list(tokens)
+    if _latin_message_confident(tokens, cores, conversions, lexicon):
+        mode = next(iter(conversions.values()))[0]
+        for i, core in enumerate(cores):
+            if core is not None:
+                fixed[i] = conversions[i][1] if i in conversions else _convert_latin(core, mode)
+        return fixed
+
+    words = lexicon.match_words
+    modes: Dict[int, str] = {}
+    for i, (mode, russian) in conversions.items():
+        if russian.replace("ё", "е") in words:
+            fixed[i] = russian
+            modes[i] = mode
+    # Короткие слова — способом соседа и тоже только в слово словаря
+    for i, core in enumerate(cores):
+        if core is None or i in modes or len(core) >= _LATIN_MIN_DETECT_LEN:
+            continue
+        for mode in (modes.get(i - 1), modes.get(i + 1)):
+            if mode:
+                russian = _convert_latin(core, mode)
+                if russian.replace("ё", "е") in words:
+                    fixed[i] = russian
+                    break
+    return fixed
+
+
+def _lower_for_match(text: str) -> str:
+    """lower() + ё→е с сохранением длины (чтобы позиции совпадали с исходным текстом)."""
+    lower = text.lower()
+    if len(lower) != len(text):
+        # Редкие символы, у которых lower() меняет длину, оставляем как есть
+        lower = "".join(ch.lower() if len(ch.lower()) == 1 else ch for ch in text)
+    return lower.replace("ё", "е")
+
+
+def _normalize_pattern(pattern: str) -> str:
+    """Паттерн словаря в том же виде, что нормализованный текст (латиницу не переводим)."""
+    return " ".join(_WORD_RE.findall(pattern.lower().replace("ё", "е")))
+
+
+def _normalize_text_uncached(text: str, lexicon: "Lexicon") -> Tuple[str, Tuple[int, ...], Tuple[Tuple[int, int], ...]]:
+    """
+    Нормализованный текст, начала его слов и для каждого слова — отрезок
+    в исходном тексте (переведённое с латиницы слово — отрезок всего слова).
+    """
+    lower = _lower_for_match(text)
+    chunks = [(m.group(), m.start()) for m in _NON_SPACE_RE.finditer(lower)]
+    fixed = _fix_latin_tokens([chunk for chunk, _ in chunks], lexicon)
+    words: List[str] = []
+    spans: List[Tuple[int, int]] = []
+    for (chunk, start), token in zip(chunks, fixed):
+        if token == chunk:
+            for m in _WORD_RE.finditer(chunk):
+                words.append(m.group())
+                spans.append((start + m.start(), start + m.end()))
+        else:
+            for word in _WORD_RE.findall(token.replace("ё", "е")):
+                words.append(word)
+                spans.append((start, start + len(chunk)))
+    starts = []
+    pos = 0
+    for word in words:
+        starts.append(pos)
+        pos += len(word) + 1
+    return " ".join(words), tuple(starts), tuple(spans)
+
+
+_NORMALIZE_CACHE = LruCache(NORMALIZE_CACHE_SIZE, float("inf"))
+
+
+def _normalize(text: str, lexicon: "Lexicon") -> Tuple[str, Tuple[int, ...], Tuple[Tuple[int, int], ...]]:
+    """
+    Единая нормализация для классификатора и маскировки мата.
+    Короткие тексты запоминаются (повторы "привет"/"устала" не пересчитываются);
+    ключ — версия словарей и текст: перевод латиницы зависит от словарей.
+    """
+    if len(text) > NORMALIZE_CACHE_MAX_LEN:
+        return _normalize_text_uncached(text, lexicon)
+    key = (lexicon.version, text)
+    normalized = _NORMALIZE_CACHE.get(key)
+    if normalized is None:
+        normalized = _normalize_text_uncached(text, lexicon)
+        _NORMALIZE_CACHE.put(key, normalized)
     return normalized
 
 
+def normalize_text_for_match(text: str, lexicon: Optional["Lexicon"] = None) -> str:
+    """
+    Текст для сравнения со словарями: нижний регистр, ё→е, без пунктуации,
+    латиница не в той раскладке и транслит — по-русски (когда это уверенно).
+    """
+    return _normalize(text, lexicon or LEXICON)[0]
+
+
+class ChatSession:
+    """Что бот помнит о чате между сообщениями (только в памяти)."""
+
+    __slots__ = ("last_text_hash", "last_text_at", "last_joy_index")
+
+    def __init__(self):
+        self.last_text_hash: Optional[int] = None
+        self.last_text_at = 0.0
+        self.last_joy_index: Optional[int] = None
+
+
+class SessionStore:
+    """
+    Сессии чатов в LruCache: размер ограничен (самые давние вытесняются),
+    неактивные чаты забываются по TTL — память не растёт с числом чатов.
+    """
+
+    def __init__(self, capacity: int = SESSION_CACHE_SIZE, ttl: float = SESSION_TTL):
+        self._cache = LruCache(capacity, ttl)
+
+    def get(self, chat_id: int) -> ChatSession:
+        return self._cache.get_or_create(chat_id, ChatSession)
+
+    def stats(self) -> Dict[str, int]:
+        return self._cache.stats()
+
+
+SESSIONS = SessionStore()
+
+
 def _is_duplicate_message(chat_id: int, text: str, window_seconds: float = 2.0) -> bool:
     """
     Простая защита от дублирующихся ответов:
     если от одного и того же chat_id прилетает то же самое сообщение
     в течение малого окна времени — считаем его дублем и не отвечаем.
     """
-    now = time.time()
-    normalized = text.strip()
-    last = _LAST_MESSAGE_CACHE.get(chat_id)
-    if last:
-        last_text, last_ts = last
-        if normalized == last_text and (now - last_ts) <= window_seconds:
-            return True
-    _LAST_MESSAGE_CACHE[chat_id] = (normalized, now)
+    now = time.monotonic()
+    text_hash = hash(text.strip())
+    session = SESSIONS.get(chat_id)
+    if session.last_text_hash == text_hash and (now - session.last_text_at) <= window_seconds:
+        return True
+
+    def remember():
+        session.last_text_hash = text_hash
+        session.last_text_at = now
+
+    # Запоминаем только обработанное: повтор упавшего update не должен считаться дублем
+    on_update_commit(remember)
     return False
 
 
-def contains_profanity(text: str) -> bool:
+# --------------------------
+# Поиск по словарям (Aho-Corasick)
+# --------------------------
+
+class AhoCorasick:
     """
-    Проверяем мат:
-    - одиночные "корни" ищем regex-ом по словам (чтобы не ловить лишнее);
-    - фразы с пробелами ("хуй знает", "ёб твою мать" и т.п.) ищем как подстроку
-      в нормализованном тексте.
+    Автомат Ахо-Корасик над набором подстрок.
+    Строится один раз при загрузке словаря, а потом за один проход по тексту
+    находит все вхождения всех паттернов — без цикла по словарю.
     """
-    normalized = normalize_text_for_match(text)
-
-    for bad_root in BAD_WORDS:
-        br = bad_root.lower().replace("ё", "е")
 
-        # Фразы (есть пробел) — ищем как подстроку в нормализованном тексте
-        if " " in br:
-            if br in normalized:
-                return True
-            continue
+    __slots__ = ("_goto", "_fail", "_out", "patterns", "payloads")
 
-        # Слишком короткие корни часто дают ложные срабатывания
-        if len(br) < 3:
-            continue
+    def __init__(self, entries: Iterable[Tuple[str, object]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._out: List[Tuple[int, ...]] = [()]
+        self.patterns: List[str] = []
+        self.payloads: List[object] = []
 
-        # Ищем корень внутри слова, но с границами слова
-        pattern = r"\b\w*" + re.escape(br) + r"\w*\b"
-        if re.search(pattern, normalized):
+        # 1) Бор из всех паттернов
+        for pattern, payload in entries:
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._out.append(())
+                state = nxt
+            self._out[state] += (len(self.patterns),)
+            self.patterns.append(pattern)
+            self.payloads.append(payload)
+
+        # 2) Суффиксные ссылки обходом в ширину
+        self._fail: List[int] = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """Все вхождения: (начало, конец, индекс паттерна)."""
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for idx in out[state]:
+                yield i + 1 - len(patterns[idx]), i + 1, idx
+
+    def search(self, text: str) -> bool:
+        """Есть ли в тексте хоть одно вхождение (останавливается на первом)."""
+        for _ in self.iter_matches(text):
             return True
+        return False
 
-    return False
 
+def _profanity_roots(bad_words: Iterable[str]) -> Iterator[str]:
+    """Корни и фразы bad_words в нормализованном виде (без слишком коротких корней)."""
+    for bad_root in bad_words:
+        br = bad_root.lower().replace("ё", "е")
+        if " " not in br and len(br) < 3:
+            continue
+        yield br
 
-def clean_profanity(text: str) -> str:
+
+def _build_profanity_matcher(bad_words: Iterable[str]) -> AhoCorasick:
     """
-    Маскируем мат:
-    - одиночные корни: проверяем regex-ом по словам;
-    - фразы с пробелами: если встречаются в нормализованном тексте,
-      маскируем слова, которые входят в фразу.
+    Один автомат на весь словарь мата (bad_words):
+    - фразы с пробелами ("хуй знает", "ёб твою мать") ищутся как подстрока
+      в нормализованном тексте;
+    - одиночные корни ищутся внутри слов (корень как часть слова);
+    - слишком короткие корни (< 3 символов) пропускаем — ложные срабатывания.
     """
-    words = text.split()
-    if not words:
-        return text
-
-    normalized_full = normalize_text_for_match(text)
+    return AhoCorasick((br, " " in br) for br in _profanity_roots(bad_words))
 
-    # 1) Собираем "фразовые" выражения, которые реально встретились
-    phrase_matches = []
-    for bad_root in BAD_WORDS:
-        br = bad_root.lower().replace("ё", "е")
-        if " " in br and br in normalized_full:
-            phrase_matches.append(br)
-
-    cleaned_words = []
 
-    # 2) Идём по словам и решаем, маскировать или нет
-    for word in words:
-        lower_word = word.lower().replace("ё", "е")
-        word_cleaned = False
-
-        # 2a) Если слово входит в найденную "фразу" — маскируем
-        for ph in phrase_matches:
-            for ph_word in ph.split():
-                if ph_word and ph_word in lower_word:
-                    cleaned_word = "".join("*" if ch.isalpha() else ch for ch in word)
-                    cleaned_words.append(cleaned_word)
-                    word_cleaned = True
-                    break
-            if word_cleaned:
-                break
+def find_profanity_spans(text: str, lexicon: Optional["Lexicon"] = None) -> List[Tuple[int, int]]:
+    """
+    Находит мат за один проход автомата по тому же нормализованному тексту,
+    что видит классификатор. Возвращает отрезки (start, end) в исходном
+    тексте, расширенные до границ слов.
+    """
+    lexicon = lexicon or LEXICON
+    normalized, norm_starts, tokens = _normalize(text, lexicon)
+    spans = []
+    for hit_start, hit_end, _ in lexicon.profanity_matcher.iter_matches(normalized):
+        first = bisect.bisect_right(norm_starts, hit_start) - 1
+        last = bisect.bisect_right(norm_starts, hit_end - 1) - 1
+        spans.append((tokens[first][0], tokens[last][1]))
+    return spans
+
+
+def _profanity_words(text: str) -> Tuple[List[Tuple[int, int]], set]:
+    """Отрезки слов текста и номера тех, что задевает корень или фраза из словаря мата."""
+    words = [m.span() for m in _NON_SPACE_RE.finditer(text)]
+    word_starts = [start for start, _ in words]
+    masked = set()
+    if not words:
+        return words, masked
+    for span_start, span_end in find_profanity_spans(text):
+        first = bisect.bisect_right(word_starts, span_start) - 1
+        last = bisect.bisect_right(word_starts, span_end - 1) - 1
+        masked.update(range(max(first, 0), last + 1))
+    return words, masked
 
-        if word_cleaned:
-            continue
 
-        # 2b) Проверка по "корням" без пробелов
-        for bad_root in BAD_WORDS:
-            br = bad_root.lower().replace("ё", "е")
+def _mask_word(word: str) -> str:
+    return "".join("*" if ch.isalpha() else ch for ch in word)
 
-            if " " in br:
-                continue
-            if len(br) < 3:
-                continue
 
-            pattern = r"\b\w*" + re.escape(br) + r"\w*\b"
-            if re.search(pattern, lower_word):
-                cleaned_word = "".join("*" if ch.isalpha() else ch for ch in word)
-                cleaned_words.append(cleaned_word)
-                word_cleaned = True
-                break
+def clean_profanity(text: str) -> str:
+    """
+    Маскируем мат: каждое слово, которое задевает найденный корень
+    или фраза из словаря мата, заменяется звёздочками (знаки препинания остаются).
+    """
+    words, masked = _profanity_words(text)
+    if not words:
+        return text
+    return " ".join(
+        _mask_word(text[start:end]) if i in masked else text[start:end]
+        for i, (start, end) in enumerate(words)
+    )
 
-        if not word_cleaned:
-            cleaned_words.append(word)
 
-    return " ".join(cleaned_words)
+def mask_profanity_in_place(text: str) -> Optional[str]:
+    """
+    Как clean_profanity, но остальной текст (пробелы, переносы строк)
+    не трогает. None — маскировать нечего.
+    """
+    words, masked = _profanity_words(text)
+    if not masked:
+        return None
+    parts = []
+    last = 0
+    for i in sorted(masked):
+        start, end = words[i]
+        parts.append(text[last:start])
+        parts.append(_mask_word(text[start:end]))
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
 
 
 def clean_text_pipeline(text: str) -> str:
@@ -866,224 +2679,706 @@ def clean_text_pipeline(text: str) -> str:
     text = clean_profanity(text)
     return text
 
-# --------------------------
-# Распознавание состояний
-# --------------------------
+# --------------------------
+# Поиск с опечатками (индекс удалений, SymSpell)
+# --------------------------
+
+# С какой длины слова прощаем одну и две опечатки. Короткие слова слишком
+# легко превращаются одно в другое ("доска" → "тоска", "встала" → "устала"),
+# поэтому их не трогаем. Приветствие — целое сообщение из пары слов,
+# там "првиет" исправляем и при шести буквах.
+FUZZY_KEYWORD_LENGTHS = (7, 10)
+FUZZY_GREETING_LENGTHS = (6, 10)
+
+
+def _deletion_variants(word: str, max_distance: int) -> set:
+    """Само слово и все его варианты без 1..max_distance букв."""
+    variants = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier if len(w) > 1 for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+# Соседние клавиши русской раскладки: промах по ним — опечатка
+_KEYBOARD_ROWS = ("йцукенгшщзхъ", "фывапролджэ", "ячсмитьбю")
+_KEYBOARD_NEIGHBOURS = frozenset(
+    pair
+    for r, row in enumerate(_KEYBOARD_ROWS)
+    for i, ch in enumerate(row)
+    for other in (
+        row[i + 1:i + 2]
+        + (_KEYBOARD_ROWS[r + 1][max(i - 1, 0):i + 1] if r + 1 < len(_KEYBOARD_ROWS) else "")
+    )
+    for pair in ((ch, other), (other, ch))
+)
+_TYPO_VOWELS = frozenset("аеиоуыэюя")
+
+
+def _substitution_cost(a: str, b: str) -> int:
+    """
+    Замена буквы: соседняя клавиша или гласная вместо гласной ("превет") —
+    одна опечатка; другая согласная ("перешиваю" — не "переживаю") —
+    это уже другое слово, считаем как две правки.
+    """
+    if a == b:
+        return 0
+    if (a, b) in _KEYBOARD_NEIGHBOURS or (a in _TYPO_VOWELS and b in _TYPO_VOWELS):
+        return 1
+    return 2
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Расстояние Дамерау-Левенштейна (перестановка соседних букв — одна правка,
+    замена — по _substitution_cost).
+    Больше limit не считаем: возвращаем limit + 1, как только строка таблицы вышла за порог.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + _substitution_cost(ca, cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return prev[-1]
+
+
+class FuzzyIndex:
+    """
+    Индекс удалений (SymSpell) над словарём слов: для каждого слова заранее
+    записаны все его варианты без одной-двух букв. Слово с опечаткой ищется
+    по своим вариантам без букв — число обращений зависит только от длины
+    слова, а не от размера словаря.
+    """
+
+    __slots__ = ("_words", "_deletes", "min_len", "long_len")
+
+    def __init__(self, words: Iterable[str], lengths: Tuple[int, int]):
+        self.min_len, self.long_len = lengths
+        self._words = frozenset(words)
+        deletes: Dict[str, List[str]] = {}
+        for word in sorted(self._words):
+            for variant in _deletion_variants(word, self.max_distance(len(word))):
+                deletes.setdefault(variant, []).append(word)
+        self._deletes: Dict[str, Tuple[str, ...]] = {k: tuple(v) for k, v in deletes.items()}
+
+    def max_distance(self, length: int) -> int:
+        """Сколько опечаток прощаем слову такой длины."""
+        if length >= self.long_len:
+            return 2
+        if length >= self.min_len:
+            return 1
+        return 0
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._words
+
+    def lookup(self, token: str) -> Optional[str]:
+        """Слово словаря, от которого token отличается опечатками (или само token), иначе None."""
+        if token in self._words:
+            return token
+        max_distance = self.max_distance(len(token))
+        if not max_distance:
+            return None
+        # Лучший кандидат — ближайший, при равенстве — первый по алфавиту (детерминированно)
+        best: Optional[str] = None
+        best_key = (max_distance + 1, "")
+        deletes = self._deletes
+        for variant in _deletion_variants(token, max_distance):
+            for word in deletes.get(variant, ()):
+                allowed = min(best_key[0], self.max_distance(min(len(word), len(token))))
+                if not allowed:
+                    continue
+                distance = _edit_distance(token, word, allowed)
+                if distance <= allowed and (distance, word) < best_key:
+                    best, best_key = word, (distance, word)
+        return best
+
+# --------------------------
+# Распознавание состояний
+# --------------------------
+
+# Категории сообщений в порядке приоритета ответа (первая сработавшая побеждает).
+# "cancel" сюда не входит: отмена имеет смысл только внутри диалога письма.
+MESSAGE_CATEGORIES = (
+    "profanity", "wantnow", "greeting",
+    "severe_sad", "anxiety", "tired", "sad", "no_joy",
+)
+MESSAGE_CATEGORY_PRIORITY = {category: i for i, category in enumerate(MESSAGE_CATEGORIES)}
+
+def _build_classifier_matcher(patterns: Dict[str, Tuple[str, ...]]) -> AhoCorasick:
+    """Один автомат на все словари состояний и мат: паттерн → категория."""
+    entries: List[Tuple[str, object]] = []
+    for category, words in (
+        ("severe_sad", patterns["severe_sad_patterns"]),
+        ("anxiety", patterns["anxiety_patterns"]),
+        ("tired", patterns["tired_patterns"]),
+        # sad_roots — корни грусти: печаль/печально, грусть/грустненько, тоска/тоскливо...
+        ("sad", patterns["sad_patterns"] + patterns["sad_roots"]),
+        ("no_joy", patterns["no_joy_patterns"]),
+        ("cancel", patterns["cancel_patterns"]),
+    ):
+        entries.extend((pattern, category) for pattern in words)
+    entries.extend((br, "profanity") for br in _profanity_roots(patterns["bad_words"]))
+    return AhoCorasick(entries)
+
+# Метки радости (битовая маска в joys.flags): вердикты классификатора,
+# посчитанные один раз при записи. Отчёты фильтруют по ним прямо в SQL.
+JOY_LABEL_FLAGS = {
+    "severe_sad": 1,
+    "anxiety": 2,
+    "tired": 4,
+    "sad": 8,
+    "no_joy": 16,
+    "profanity": 32,
+}
+# Что не попадает в отчёты: грустные записи
+JOY_REPORT_EXCLUDE_FLAGS = JOY_LABEL_FLAGS["sad"]
+
+
+def joy_flags(classification: "MessageClassification") -> int:
+    """Битовая маска JOY_LABEL_FLAGS по результату classify_message."""
+    flags = 0
+    for category in classification.hits:
+        flags |= JOY_LABEL_FLAGS.get(category, 0)
+    return flags
+
+
+def classify_joy(text: str, lexicon: Optional["Lexicon"] = None) -> int:
+    """Метки JOY_LABEL_FLAGS для текста радости (по снимку lexicon или текущему)."""
+    return joy_flags(classify_message(text, lexicon))
+
+# --------------------------
+# Словари: загрузка и горячая замена
+# --------------------------
+
+LEXICON_PATTERNS_FILE = "patterns.json"
+LEXICON_RESPONSES_FILE = "responses.json"
+# Частотный список словоформ: настоящие слова не исправляем как опечатки
+LEXICON_WORDS_FILE = "words.txt"
+LEXICON_PATTERN_KEYS = (
+    "bad_words", "sad_patterns", "sad_roots", "tired_patterns", "anxiety_patterns",
+    "severe_sad_patterns", "no_joy_patterns", "cancel_patterns",
+    "greeting_exact", "greeting_starts",
+)
+LEXICON_RESPONSE_KEYS = (
+    "greeting", "joy", "sad", "tired", "anxiety", "no_joy", "reminder",
+    "report_headers", "wantnow_empty", "joy_emojis", "stats_emojis", "calm_emojis",
+)
+
+
+class Lexicon:
+    """
+    Неизменяемый снимок словарей: паттерны, ответы и скомпилированные
+    автоматы. При правке файлов строится новый снимок и подменяется
+    одной операцией присваивания (LEXICON), обработчики продолжают
+    работать со снимком, который уже взяли.
+    """
+
+    __slots__ = (
+        "patterns", "responses", "greeting_exact", "greeting_starts", "known_words", "match_words",
+        "profanity_matcher", "classifier_matcher", "keyword_index", "greeting_index",
+        "version", "signature",
+    )
+
+    def __init__(self, patterns: Dict[str, Tuple[str, ...]], responses: Dict[str, Tuple[str, ...]],
+                 known_words: frozenset, matchers: tuple, version: str, signature: tuple):
+        self.patterns = patterns
+        self.responses = responses
+        self.greeting_exact = frozenset(patterns["greeting_exact"])
+        self.greeting_starts = frozenset(patterns["greeting_starts"])
+        # Настоящие слова, похожие на слова словарей ("странно" ≠ "страшно"): не исправляем
+        self.known_words = known_words
+        # Все слова паттернов: латиницу переводим, только если выходит одно из них
+        self.match_words = frozenset(
+            word for key in LEXICON_PATTERN_KEYS for pattern in patterns[key]
+            for word in _normalize_pattern(pattern).split()
+        )
+        (self.profanity_matcher, self.classifier_matcher,
+         self.keyword_index, self.greeting_index) = matchers
+        self.version = version
+        self.signature = signature
+
+
+def _read_lexicon_file(name: str, keys: Tuple[str, ...]) -> Dict[str, Tuple[str, ...]]:
+    path = os.path.join(LEXICON_DIR, name)
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    missing = [key for key in keys if not isinstance(data.get(key), list)]
+    if missing:
+        raise ValueError(f"{path}: нет списков {', '.join(missing)}")
+    return {key: tuple(str(item) for item in data[key]) for key in keys}
+
+
+def _read_word_list(name: str) -> frozenset:
+    """Слова по одному в строке (строки с # — комментарии)."""
+    path = os.path.join(LEXICON_DIR, name)
+    with open(path, encoding="utf-8") as f:
+        words = frozenset(
+            line.strip().lower().replace("ё", "е")
+            for line in f
+            if line.strip() and not line.startswith("#")
+        )
+    if not words:
+        raise ValueError(f"{path}: пустой список слов")
+    return words
+
+
+def _lexicon_signature() -> tuple:
+    """(mtime, размер) файлов словарей — дешёвая проверка, не менялись ли они."""
+    signature = []
+    for name in (LEXICON_PATTERNS_FILE, LEXICON_RESPONSES_FILE, LEXICON_WORDS_FILE):
+        st = os.stat(os.path.join(LEXICON_DIR, name))
+        signature.append((st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+def _lexicon_version(patterns: Dict[str, Tuple[str, ...]], known_words: Iterable[str]) -> str:
+    """Хеш словарей классификатора (и списка слов для опечаток): метки с другой версией устарели."""
+    payload = json.dumps(
+        [
+            list(patterns[key]) if not key.startswith("greeting") else sorted(set(patterns[key]))
+            for key in LEXICON_PATTERN_KEYS
+        ] + [sorted(set(known_words))],
+        ensure_ascii=False,
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def _keyword_vocabulary(patterns: Dict[str, Tuple[str, ...]]) -> Iterator[str]:
+    """
+    Ключевые слова словарей состояний — однословные паттерны ("вымоталась",
+    "тревожно"). Слова из фраз ("сегодня", "просто", "работе") сюда не входят:
+    сами по себе они ничего не значат, а исправление в них только ошибается.
+    """
+    for key in (
+        "severe_sad_patterns", "anxiety_patterns", "tired_patterns",
+        "sad_patterns", "no_joy_patterns", "cancel_patterns",
+    ):
+        for pattern in patterns[key]:
+            words = _normalize_pattern(pattern).split()
+            if len(words) == 1:
+                yield words[0]
+
+
+def _greeting_vocabulary(patterns: Dict[str, Tuple[str, ...]]) -> Iterator[str]:
+    """
+    Однословные приветствия. Начала вроде "доброе"/"добрый" сюда не входят:
+    их соседи ("добрые новости") — обычные слова, а не опечатки.
+    """
+    return (g for g in patterns["greeting_exact"] if " " not in g)
+
+
+def _build_matchers(patterns: Dict[str, Tuple[str, ...]]) -> tuple:
+    """
+    Автоматы и индексы опечаток (profanity, classifier, keyword, greeting).
+    Сборка занимает миллисекунды, поэтому на диск их не сохраняем.
+    """
+    return (
+        _build_profanity_matcher(patterns["bad_words"]),
+        _build_classifier_matcher(patterns),
+        FuzzyIndex(_keyword_vocabulary(patterns), FUZZY_KEYWORD_LENGTHS),
+        FuzzyIndex(_greeting_vocabulary(patterns), FUZZY_GREETING_LENGTHS),
+    )
+
 
-def is_severe_sad_message(text: str) -> bool:
-    lower = normalize_text_for_match(text)
-    for pattern in SEVERE_SAD_PATTERNS:
-        if pattern in lower:
-            return True
-    return False
+def load_lexicon() -> Lexicon:
+    """Читает файлы словарей и собирает снимок с автоматами."""
+    signature = _lexicon_signature()
+    patterns = _read_lexicon_file(LEXICON_PATTERNS_FILE, LEXICON_PATTERN_KEYS)
+    texts = _read_lexicon_file(LEXICON_RESPONSES_FILE, LEXICON_RESPONSE_KEYS)
+    empty = [key for key, items in texts.items() if not items]
+    if empty:
+        raise ValueError(f"Пустые списки ответов: {', '.join(empty)}")
+    known_words = _read_word_list(LEXICON_WORDS_FILE)
+    version = _lexicon_version(patterns, known_words)
+    return Lexicon(patterns, texts, known_words, _build_matchers(patterns), version, signature)
 
 
-def is_sad_message(text: str) -> bool:
-    lower = normalize_text_for_match(text)
-    words = lower.split()
+LEXICON = load_lexicon()
+_LEXICON_FAILED_SIGNATURE: Optional[tuple] = None
 
-    # Если сообщение содержит отдельное слово "ад" — считаем это тяжелым днём (грусть)
-    if "ад" in words:
-        return True
 
-    # Корневые проверки (ловим разные формы и опечатки)
-    # печал → печаль, печально, печальная, печалька...
-    # груст → грусть, грустно, грустненько...
-    # тоск  → тоска, тоскливо...
-    for root in ("печал", "груст", "тоск"):
-        if root in lower:
-            return True
+def reload_lexicon_if_changed() -> bool:
+    """
+    Если файлы словарей поменялись — собирает новый снимок и подменяет LEXICON.
+    Сборка идёт в вызывающем потоке, обработка сообщений при этом не ждёт.
+    Ошибка в файлах оставляет прежний снимок.
+    """
+    global LEXICON, _LEXICON_FAILED_SIGNATURE
+    signature = None
+    try:
+        signature = _lexicon_signature()
+        if signature in (LEXICON.signature, _LEXICON_FAILED_SIGNATURE):
+            return False
+        lexicon = load_lexicon()
+    except Exception as e:
+        # Запоминаем сломанную версию файлов, чтобы не повторять ошибку каждые N секунд
+        _LEXICON_FAILED_SIGNATURE = signature
+        print(f"Словари не перезагружены, работаем со старыми: {e}")
+        return False
+    if lexicon.version != LEXICON.version:
+        print(f"Словари обновлены: версия {LEXICON.version} → {lexicon.version}")
+    LEXICON = lexicon
+    return True
 
-    for pattern in SAD_PATTERNS:
-        if pattern in lower:
-            return True
 
-    return False
+def lexicon_watcher():
+    """Фоновый поток: следит за файлами словарей."""
+    while True:
+        time.sleep(LEXICON_RELOAD_INTERVAL)
+        reload_lexicon_if_changed()
 
 
-def is_tired_message(text: str) -> bool:
-    lower = normalize_text_for_match(text)
-    for pattern in TIRED_PATTERNS:
-        if pattern in lower:
-            return True
-    return False
+def responses(name: str) -> Tuple[str, ...]:
+    """Тексты ответов из текущего снимка словарей."""
+    return LEXICON.responses[name]
 
 
-def is_anxiety_message(text: str) -> bool:
-    lower = normalize_text_for_match(text)
-    for pattern in ANXIETY_PATTERNS:
-        if pattern in lower:
-            return True
-    return False
+class MessageClassification:
+    """
+    Результат classify_message: нормализованный текст и все сработавшие
+    категории с найденными паттернами; ranked() — они же по приоритету ответа.
+    """
 
+    __slots__ = ("normalized", "hits", "version")
 
-def is_no_joy_message(text: str) -> bool:
-    lower = normalize_text_for_match(text)
-    for pattern in NO_JOY_PATTERNS:
-        if pattern in lower:
-            return True
-    return False
+    def __init__(self, normalized: str, hits: Dict[str, List[str]], version: str):
+        self.normalized = normalized
+        self.hits = hits
+        # Версия словарей, по которым классифицировали (для меток в joys)
+        self.version = version
 
+    def has(self, category: str) -> bool:
+        return category in self.hits
 
-def is_cancel_message(text: str) -> bool:
-    lower = normalize_text_for_match(text)
-    for pattern in CANCEL_PATTERNS:
-        if pattern in lower:
-            return True
-    return False
+    def ranked(self) -> List[Tuple[int, str]]:
+        """Сработавшие категории с приоритетом (меньше — важнее), по порядку."""
+        return sorted(
+            (MESSAGE_CATEGORY_PRIORITY[c], c) for c in self.hits if c in MESSAGE_CATEGORY_PRIORITY
+        )
 
+    @property
+    def primary(self) -> Optional[str]:
+        """Категория, на которую нужно ответить, или None (обычная радость)."""
+        ranked = self.ranked()
+        return ranked[0][1] if ranked else None
 
-def is_greeting_message(text: str) -> bool:
+
+def _differs_in_ending(word: str, candidate: str) -> bool:
     """
-    Приветствие с учётом:
-    - коротких фраз
-    - опечаток типа 'првиет'
-    - русских слов в английской раскладке ('ghbdtn')
-    - латинского 'privet'
+    Слова расходятся только в двух последних буквах (и не перестановкой):
+    "выгорели" — другая форма "выгорела", "здоровья" — не "здорово".
+    Это окончание, а не опечатка.
     """
-    lower = normalize_text_for_match(text)
-
-    if len(lower) > 25:
+    prefix = 0
+    for a, b in zip(word, candidate):
+        if a != b:
+            break
+        prefix += 1
+    if prefix < max(len(word), len(candidate)) - 2:
         return False
+    return sorted(word[prefix:]) != sorted(candidate[prefix:])
 
-    exact_greetings = {
-        # базовые
-        "привет", "приветик", "приветики", "привет)", "привет))",
-        "приветствую", "здравствуй", "здравствуйте", "здравствуйте)",
-        "добрый день", "добрый вечер", "доброе утро", "доброй ночи",
-        "хай", "хей", "хелло", "хеллоу",
-        "hello", "hi", "hey",
-        "йоу", "йо", "ку",
-        "здорово", "здоров", "здарова", "здаров", "здорова",
-        "салют", "шалом", "бонжур", "хола",
-        "доброго дня", "доброго вечера",
-        "рад тебя видеть", "рада тебя видеть",
-        "снова я", "это я снова",
-        # опечатки
-        "првиет", "превет", "привте", "прив",
-        # латиница
-        "privet", "privetik",
-        # русское слово в англ. раскладке
-        "ghbdtn", "ghbdtn)", "ghbdtn!"
-    }
 
-    if lower in exact_greetings:
+def _fuzzy_lookup(index: FuzzyIndex, word: str, lexicon: Lexicon) -> Optional[str]:
+    """
+    Слово словаря для word с учётом опечаток; None — не похоже, word сам
+    настоящее слово или отличается от слова словаря только окончанием.
+    """
+    if word in index:
+        return word
+    if word in lexicon.known_words:
+        return None
+    candidate = index.lookup(word)
+    if candidate is None or _differs_in_ending(word, candidate):
+        return None
+    return candidate
+
+
+def _is_greeting_normalized(normalized: str, words: List[str], lexicon: Lexicon) -> bool:
+    if len(normalized) > 25:
+        return False
+    if normalized in lexicon.greeting_exact:
         return True
-
-    words = lower.split()
-    if not words:
+    if not words or len(words) > 3:
         return False
+    if words[0] in lexicon.greeting_starts:
+        return True
+    # "првиет", "привте", "здраствуйте" — опечатки находит индекс, списком их не держим
+    first = _fuzzy_lookup(lexicon.greeting_index, words[0], lexicon)
+    return first is not None and (len(words) == 1 or first in lexicon.greeting_starts)
 
-    greeting_starts = {
-        "привет", "првиет", "превет", "привте", "прив",
-        "здравствуй", "здравствуйте", "добрый", "доброе", "доброй",
-        "хай", "хэй", "хей", "хелло", "hello", "hi", "hey",
-        "privet", "privetik",
-        "ghbdtn",
-        "йоу", "йо", "ку",
-        "здорово", "здарова", "салют", "шалом", "бонжур", "хола"
-    }
 
-    return words[0] in greeting_starts and len(words) <= 3
+def _correct_typos(words: List[str], lexicon: Lexicon) -> Optional[str]:
+    """
+    Текст, где слова с опечатками заменены ключевыми словами словарей
+    состояний ("вымоталсь" → "вымоталась"), или None, если исправлять нечего.
+    """
+    index = lexicon.keyword_index
+    corrected = list(words)
+    changed = False
+    for i, word in enumerate(words):
+        if len(word) < index.min_len:
+            continue
+        fixed = _fuzzy_lookup(index, word, lexicon)
+        if fixed is not None and fixed != word:
+            corrected[i] = fixed
+            changed = True
+    return " ".join(corrected) if changed else None
+
+
+def classify_message(text: str, lexicon: Optional[Lexicon] = None) -> MessageClassification:
+    """
+    Классифицирует сообщение за один проход:
+    нормализация один раз, затем один автомат по всем словарям
+    (тяжёлые фразы, тревога, усталость, грусть, «не знаю», отмена, мат),
+    повтор по тексту с исправленными опечатками (если они нашлись)
+    и O(1)-проверки приветствия и wantnow.
+    Текст обрамляется пробелами, чтобы паттерны с пробелом по краю
+    (" выгорел ") ловили целое слово и в начале, и в конце сообщения.
+    Все проверки идут по одному снимку словарей, даже если он заменится
+    посреди вызова.
+    """
+    lexicon = lexicon or LEXICON
+    normalized = normalize_text_for_match(text, lexicon)
+    hits: Dict[str, List[str]] = {}
+
+    matcher = lexicon.classifier_matcher
+    for _, _, idx in matcher.iter_matches(f" {normalized} "):
+        hits.setdefault(matcher.payloads[idx], []).append(matcher.patterns[idx])
+
+    words = normalized.split()
+
+    # Второй проход — по тексту с исправленными опечатками. Мат здесь
+    # не ищем: маскируется только то, что реально написано.
+    corrected = _correct_typos(words, lexicon)
+    if corrected is not None:
+        for _, _, idx in matcher.iter_matches(f" {corrected} "):
+            category, pattern = matcher.payloads[idx], matcher.patterns[idx]
+            if category == "profanity":
+                continue
+            found = hits.setdefault(category, [])
+            if pattern not in found:
+                found.append(pattern)
+
+    # Отдельное слово "ад" — тяжёлый день (грусть)
+    if "ад" in words:
+        hits.setdefault("sad", []).append("ад")
+
+    if normalized.startswith("wantnow") and parse_wantnow_page(normalized) is not None:
+        hits["wantnow"] = [normalized]
+
+    if _is_greeting_normalized(normalized, words, lexicon):
+        hits["greeting"] = [normalized]
 
+    return MessageClassification(normalized, hits, lexicon.version)
 
-def is_wantnow_message(text: str) -> bool:
-    """Проверяет, является ли сообщение запросом на отчет 'wantnow'."""
-    lower = normalize_text_for_match(text)
-    return lower == "wantnow"
 
 # --------------------------
 # Генерация ответов
 # --------------------------
 
 def add_emoji_prefix(text: str) -> str:
-    return f"{random.choice(CALM_EMOJIS)} {text}"
+    return f"{random.choice(responses('calm_emojis'))} {text}"
 
 
 def get_sad_response() -> str:
-    return add_emoji_prefix(random.choice(SAD_RESPONSES))
+    return add_emoji_prefix(random.choice(responses("sad")))
 
 
 def get_tired_response() -> str:
-    return add_emoji_prefix(random.choice(TIRED_RESPONSES))
+    return add_emoji_prefix(random.choice(responses("tired")))
 
 
 def get_anxiety_response() -> str:
-    return add_emoji_prefix(random.choice(ANXIETY_RESPONSES))
+    return add_emoji_prefix(random.choice(responses("anxiety")))
 
 
 def get_greeting_response() -> str:
-    return add_emoji_prefix(random.choice(GREETING_RESPONSES))
+    return add_emoji_prefix(random.choice(responses("greeting")))
 
 
 def get_no_joy_response() -> str:
-    return add_emoji_prefix(random.choice(NO_JOY_RESPONSES))
+    return add_emoji_prefix(random.choice(responses("no_joy")))
 
 
 def get_joy_response(chat_id: int) -> str:
-    if not JOY_RESPONSES:
-        return add_emoji_prefix("Записала это как твою радость.")
-    last_idx = LAST_JOY_INDEX.get(chat_id)
-    idx = random.randrange(len(JOY_RESPONSES))
-    if last_idx is not None and len(JOY_RESPONSES) > 1:
+    joy_responses = responses("joy")
+    session = SESSIONS.get(chat_id)
+    last_idx = session.last_joy_index
+    idx = random.randrange(len(joy_responses))
+    if last_idx is not None and len(joy_responses) > 1:
         for _ in range(3):
             if idx != last_idx:
                 break
-            idx = random.randrange(len(JOY_RESPONSES))
-    LAST_JOY_INDEX[chat_id] = idx
-    return add_emoji_prefix(JOY_RESPONSES[idx])
-
-
-def get_wantnow_report(chat_id: int) -> str:
-    """Генерирует отчет о всех записанных радостях."""
-    joys = get_all_joys(chat_id)
-
-    if not joys:
-        responses_no_joy_report = [
-            "Ну что, звездочка, этот день подошел к концу.\nА вот твои маленькие победы — сверяй список и гордись собой😊",
-            "День подошел к концу! И знаешь что?\nТы справилась лучше, чем думаешь. Вот твои маленькие победы — сияют и радуют😊",
-            "День завершён, детка!\nВот твои успехи. И не спорь😊",
-            "Ну что, день сделал своё — иногда криво, иногда красиво.\nА вот твои хорошие моменты!",
-            "Твой мозг: «ничего хорошего сегодня не было».\nЯ: держи список контрфактов, дорогуша 😏",
-            "Так, я тут посмотрела — ты опять вела себя подозрительно молодцом.\nВот список 😌",
-            "Ну что, день закончился и можно выдохнуть?\nДа.\nНо сначала — смотри: каким ты сегодня была молодцом😊",
-            "День закрылся, а отчёт пуст?\nСчитаем это стратегическим отдыхом.\nНо имей в виду — если завтра забудешь записать радость, я снова тебе напишу 👀"
-        ]
-        return random.choice(responses_no_joy_report)
+            idx = random.randrange(len(joy_responses))
+    session.last_joy_index = idx
+    return add_emoji_prefix(joy_responses[idx])
 
-    # Группируем радости по датам
-    joys_by_date: Dict[str, List[str]] = {}
-    for text, created_at in joys:
-        date_str = created_at.split("T")[0]  # YYYY-MM-DD
-        joys_by_date.setdefault(date_str, []).append(text)
 
-    # Сортируем даты по убыванию (новые сверху)
-    sorted_dates = sorted(joys_by_date.keys(), reverse=True)
+# callback_data кнопок листания: "wn:<страница>:<o|n>:<id записи-курсора>"
+WANTNOW_CALLBACK_PREFIX = "wn:"
+_WANTNOW_RE = re.compile(r"wantnow(?: (\d{1,6}))?")
 
-    report = f"{random.choice(JOY_EMOJIS)} Вот все твои записанные радости:\n\n"
 
-    today = today_minsk()
-    for date_str in sorted_dates:
-        date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
+def parse_wantnow_page(normalized: str) -> Optional[int]:
+    """Номер страницы из "wantnow" / "wantnow 3" (нормализованный текст), иначе None."""
+    match = _WANTNOW_RE.fullmatch(normalized)
+    if not match:
+        return None
+    return max(1, int(match.group(1) or 1))
 
-        if date_obj == today:
-            date_display = "Сегодня"
-        elif date_obj == today - timedelta(days=1):
-            date_display = "Вчера"
-        elif date_obj == today - timedelta(days=2):
-            date_display = "Позавчера"
-        else:
-            date_display = date_obj.strftime("%d.%m.%Y")
 
-        report += f"📅 {date_display}:\n"
-        for i, joy in enumerate(joys_by_date[date_str], 1):
-            report += f"  {i}. {joy}\n"
-        report += "\n"
+class MessageChunker:
+    """
+    Собирает длинный текст построчно и режет его на сообщения
+    не длиннее limit символов — по границам строк (очень длинная строка
+    режется жёстко). Память — O(одного сообщения).
+    """
 
-    total_count = len(joys)
-    report += f"\nВсего радостей: {total_count}"
+    def __init__(self, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        self.limit = limit
+        self.messages: List[str] = []
+        self._parts: List[str] = []
+        self._size = 0
+
+    def add(self, line: str):
+        while len(line) > self.limit:
+            self._flush()
+            self.messages.append(line[:self.limit])
+            line = line[self.limit:]
+        if self._size + len(line) > self.limit:
+            self._flush()
+        self._parts.append(line)
+        self._size += len(line)
+
+    def _flush(self):
+        text = "".join(self._parts).strip()
+        if text:
+            self.messages.append(text)
+        self._parts = []
+        self._size = 0
+
+    def finish(self) -> List[str]:
+        self._flush()
+        return self.messages
+
+
+def _wantnow_day_label(day_str: str, today: date) -> str:
+    day_obj = date.fromisoformat(day_str)
+    if day_obj == today:
+        return "Сегодня"
+    if day_obj == today - timedelta(days=1):
+        return "Вчера"
+    if day_obj == today - timedelta(days=2):
+        return "Позавчера"
+    return day_obj.strftime("%d.%m.%Y")
+
+
+def get_wantnow_report(chat_id: int, page: int = 1, before_id: Optional[int] = None,
+                       after_id: Optional[int] = None) -> Tuple[List[str], Optional[dict]]:
+    """
+    Одна страница отчёта о записанных радостях: (сообщения, inline-кнопки).
+    Записи читаются курсором в порядке отчёта и сразу раскладываются по
+    сообщениям до 4096 символов — память и время O(страницы), а не всей истории.
+    Без курсора страница открывается по номеру.
+    """
+    if before_id is None and after_id is None and page > 1:
+        start_id = get_joy_page_start(chat_id, page, WANTNOW_PAGE_SIZE)
+        if start_id is None:
+            return [add_emoji_prefix(f"Страницы {page} нет — записей меньше. Напиши wantnow, чтобы начать сначала.")], None
+        rows = iter_joys_page(chat_id, WANTNOW_PAGE_SIZE, from_id=start_id)
+    else:
+        rows = iter_joys_page(chat_id, WANTNOW_PAGE_SIZE, before_id=before_id, after_id=after_id)
+
+    today = get_user_settings(chat_id).today()
+    chunker = MessageChunker()
+    chunker.add(f"{random.choice(responses('joy_emojis'))} Вот все твои записанные радости"
+                + (f" (страница {page})" if page > 1 else "") + ":\n\n")
+
+    first_id = last_id = None
+    current_day = None
+    number = 0
+    for joy_id, day_str, text in rows:
+        if first_id is None:
+            first_id = joy_id
+            # страница могла начаться посреди дня — продолжаем его нумерацию
+            number = count_newer_joys_same_day(chat_id, joy_id)
+            current_day = day_str
+            chunker.add(f"📅 {_wantnow_day_label(day_str, today)}:\n")
+        elif day_str != current_day:
+            current_day = day_str
+            number = 0
+            chunker.add(f"\n📅 {_wantnow_day_label(day_str, today)}:\n")
+        number += 1
+        chunker.add(f"  {number}. {text}\n")
+        last_id = joy_id
+
+    if first_id is None:
+        if page == 1:
+            return [random.choice(responses("wantnow_empty"))], None
+        return [add_emoji_prefix("Здесь больше ничего нет. Напиши wantnow, чтобы начать сначала.")], None
+
+    has_newer = page > 1 and has_joys_around(chat_id, first_id, newer=True)
+    has_older = has_joys_around(chat_id, last_id, newer=False)
+
+    footer = f"\n\nВсего радостей: {get_joy_count(chat_id)}"
+    if has_older:
+        footer += f"\nДальше — кнопка ниже или «wantnow {page + 1}»."
+    chunker.add(footer)
+
+    buttons = []
+    if has_newer:
+        buttons.append({"text": "← Новее", "callback_data": f"{WANTNOW_CALLBACK_PREFIX}{page - 1}:n:{first_id}"})
+    if has_older:
+        buttons.append({"text": "Старее →", "callback_data": f"{WANTNOW_CALLBACK_PREFIX}{page + 1}:o:{last_id}"})
+    markup = {"inline_keyboard": [buttons]} if buttons else None
+    return chunker.finish(), markup
+
+
+def send_wantnow_report(chat_id: int, page: int = 1, before_id: Optional[int] = None,
+                        after_id: Optional[int] = None):
+    """Отправляет страницу wantnow; кнопки листания — у последнего сообщения."""
+    messages, markup = get_wantnow_report(chat_id, page, before_id, after_id)
+    for i, text in enumerate(messages):
+        last = i == len(messages) - 1
+        send_message(chat_id, text, human_delay=(i == 0), reply_markup=markup if last else None)
+
+
+def handle_wantnow_callback(chat_id: int, data: str) -> bool:
+    """Нажатие "Новее"/"Старее" под отчётом. False — чужие данные."""
+    try:
+        page_str, direction, joy_id_str = data[len(WANTNOW_CALLBACK_PREFIX):].split(":")
+        page, joy_id = max(1, int(page_str)), int(joy_id_str)
+    except ValueError:
+        return False
+    if direction == "o":
+        send_wantnow_report(chat_id, page, before_id=joy_id)
+    elif direction == "n":
+        send_wantnow_report(chat_id, page, after_id=joy_id)
+    else:
+        return False
+    return True
 
-    return report
+def format_joy_stats(stats: JoyStats) -> str:
+    lines = [f"{random.choice(responses('stats_emojis'))} У тебя уже {stats.total} записанных радостей!", ""]
+    lines.append(f"За последние 7 дней: {stats.week_total}")
+    if stats.current_streak > 1:
+        lines.append(f"Дней подряд сейчас: {stats.current_streak}")
+    if stats.longest_streak > 1:
+        lines.append(f"Самая длинная серия: {stats.longest_streak}")
+    if stats.first_day is not None:
+        lines.append(f"Первая радость: {stats.first_day:%d.%m.%Y}")
+    return "\n".join(lines)
 
 # --------------------------
 # Письмо себе в будущее
@@ -1107,7 +3402,7 @@ def handle_letter_command(chat_id: int):
 
 
 def handle_letter_period(chat_id: int, text: str):
-    if is_cancel_message(text):
+    if classify_message(text).has("cancel"):
         clear_dialog_state(chat_id)
         send_message(chat_id, add_emoji_prefix("Хорошо, отложим письмо."))
         return
@@ -1132,7 +3427,7 @@ def handle_letter_period(chat_id: int, text: str):
 
 
 def handle_letter_text(chat_id: int, text: str, meta: dict):
-    if is_cancel_message(text):
+    if classify_message(text).has("cancel"):
         clear_dialog_state(chat_id)
         send_message(chat_id, add_emoji_prefix("Окей, без письма."))
         return
@@ -1156,6 +3451,71 @@ def handle_letter_text(chat_id: int, text: str, meta: dict):
         )
     )
 
+# --------------------------
+# Настройки времени и часового пояса
+# --------------------------
+
+SETTINGS_TZ_WORDS = ("tz", "пояс", "зона")
+SETTINGS_REMINDER_WORDS = ("reminder", "напоминание")
+SETTINGS_REPORT_WORDS = ("report", "отчет", "отчёт")
+
+
+def format_user_settings(settings: UserSettings) -> str:
+    return (
+        f"Часовой пояс: {settings.tz_name}\n"
+        f"Напоминание: {settings.reminder_time:%H:%M}\n"
+        f"Отчёт: {settings.report_time:%H:%M}"
+    )
+
+
+SETTINGS_HELP = (
+    "Поменять можно так:\n"
+    "• /settings пояс Europe/Moscow (или UTC+3)\n"
+    "• /settings напоминание 21:00\n"
+    "• /settings отчёт 22:30"
+)
+
+
+def handle_settings_command(chat_id: int, text: str):
+    """/settings [пояс|напоминание|отчёт значение] — показать или поменять настройки."""
+    settings = get_user_settings(chat_id)
+    parts = text.split(maxsplit=2)
+    if len(parts) < 3:
+        send_message(
+            chat_id,
+            add_emoji_prefix(f"{format_user_settings(settings)}\n\n{SETTINGS_HELP}")
+        )
+        return
+
+    key, value = parts[1].lower(), parts[2].strip()
+    if key in SETTINGS_TZ_WORDS:
+        tz_name = parse_tz_name(value)
+        if tz_name is None:
+            send_message(
+                chat_id,
+                add_emoji_prefix("Не знаю такого часового пояса. Попробуй, например, Europe/Moscow или UTC+3.")
+            )
+            return
+        settings.tz_name = tz_name
+    elif key in SETTINGS_REMINDER_WORDS or key in SETTINGS_REPORT_WORDS:
+        at = parse_hhmm(value)
+        if at is None:
+            send_message(chat_id, add_emoji_prefix("Напиши время в формате ЧЧ:ММ, например 21:30."))
+            return
+        if key in SETTINGS_REMINDER_WORDS:
+            settings.reminder_time = at
+        else:
+            settings.report_time = at
+    else:
+        send_message(chat_id, add_emoji_prefix(SETTINGS_HELP))
+        return
+
+    after_commit(save_user_settings(settings), DELIVERY_SCHEDULER.wake)
+    send_message(
+        chat_id,
+        add_emoji_prefix(f"Готово!\n\n{format_user_settings(settings)}")
+    )
+
 # --------------------------
 # Обработка сообщений - ОСНОВНАЯ ФУНКЦИЯ
 # --------------------------
@@ -1182,29 +3542,31 @@ def handle_message(chat_id: int, text: str) -> bool:
             "Каждый день можно писать сюда что-то приятное из дня: встречу, вкусный кофе, спокойный вечер.\n"
             "В 20:00 я напомню, если ты ничего не написала, а в 22:00 пришлю небольшой отчёт за день.\n\n"
             "А ещё здесь можно написать письмо себе в будущее — для этого есть команда /letter.\n"
-            "Если вдруг по ходу диалога или письма ты передумаешь — просто напиши /cancel.\n\n"
+            "Если вдруг по ходу диалога или письма ты передумаешь — просто напиши /cancel.\n"
+            "Время напоминания, отчёта и часовой пояс можно поменять командой /settings.\n\n"
             "Можешь начать уже сейчас: напиши одну маленькую радость или тёплый момент из этого дня."
         )
         return True
 
     if stripped.startswith("/stats"):
-        total = get_joy_count(chat_id)
-        if total == 0:
+        stats = get_joy_stats(chat_id)
+        if stats.total == 0:
             send_message(
                 chat_id,
-                f"{random.choice(STATS_EMOJIS)} Пока у тебя нет записанных радостей."
+                f"{random.choice(responses('stats_emojis'))} Пока у тебя нет записанных радостей."
             )
         else:
-            send_message(
-                chat_id,
-                f"{random.choice(STATS_EMOJIS)} У тебя уже {total} записанных радостей!"
-            )
+            send_message(chat_id, format_joy_stats(stats))
         return True
 
     if stripped.startswith("/letter"):
         handle_letter_command(chat_id)
         return True
 
+    if stripped.startswith("/settings"):
+        handle_settings_command(chat_id, stripped)
+        return True
+
     if stripped.startswith("/cancel"):
         state, _ = get_dialog_state(chat_id)
         clear_dialog_state(chat_id)
@@ -1223,8 +3585,12 @@ def handle_message(chat_id: int, text: str) -> bool:
         handle_letter_text(chat_id, text, meta or {})
         return True
 
-    # 3. Проверка на мат — ОДИН ответ и выходим
-    if contains_profanity(text):
+    # 3. Классифицируем один раз и отвечаем по самой приоритетной категории
+    classification = classify_message(stripped)
+    category = classification.primary
+
+    # 3a. Мат — ОДИН ответ и выходим
+    if category == "profanity":
         send_message(
             chat_id,
             add_emoji_prefix(
@@ -1233,19 +3599,18 @@ def handle_message(chat_id: int, text: str) -> bool:
         )
         return True
 
-    # 4. Проверка на запрос отчета "wantnow"
-    if is_wantnow_message(stripped):
-        report = get_wantnow_report(chat_id)
-        send_message(chat_id, report)
+    # 4. Запрос отчета "wantnow"
+    if category == "wantnow":
+        send_wantnow_report(chat_id, parse_wantnow_page(classification.normalized) or 1)
         return True
 
     # 5. Приветствие
-    if is_greeting_message(stripped):
+    if category == "greeting":
         send_message(chat_id, get_greeting_response())
         return True
 
     # 6. Эмоциональные состояния - в порядке приоритета
-    if is_severe_sad_message(stripped):
+    if category == "severe_sad":
         send_message(
             chat_id,
             add_emoji_prefix(
@@ -1257,26 +3622,26 @@ def handle_message(chat_id: int, text: str) -> bool:
         )
         return True
 
-    if is_anxiety_message(stripped):
+    if category == "anxiety":
         send_message(chat_id, get_anxiety_response())
         return True
 
-    if is_tired_message(stripped):
+    if category == "tired":
         send_message(chat_id, get_tired_response())
         return True
 
-    if is_sad_message(stripped):
+    if category == "sad":
         send_message(chat_id, get_sad_response())
         return True
 
-    if is_no_joy_message(stripped):
+    if category == "no_joy":
         send_message(chat_id, get_no_joy_response())
         return True
 
     # 7. Обычная радость
     cleaned = clean_text_pipeline(text)
     if cleaned:
-        add_joy(chat_id, cleaned)
+        add_joy(chat_id, cleaned, classification)
         send_message(chat_id, get_joy_response(chat_id))
         return True
 
@@ -1288,147 +3653,832 @@ def handle_message(chat_id: int, text: str) -> bool:
 # Ежедневные напоминания и отчёты
 # --------------------------
 
-def send_reminder(chat_id: int):
-    today = today_minsk()
+def build_daily_report(joys: List[str]) -> str:
+    if not joys:
+        return f"{random.choice(responses('calm_emojis'))} День подошёл к концу. Завтра будет новый шанс!"
+    intro = random.choice(responses("report_headers"))
+    header = f"{random.choice(responses('joy_emojis'))} {intro}\n\n"
+    body = "".join(f"{i}. {joy}\n" for i, joy in enumerate(joys, 1))
+    return header + body + "\nСпокойной ночи!"
+
+
+class FanoutRun:
+    """Итоги одной рассылки: сколько поставлено, доставлено и не доставлено."""
+
+    __slots__ = ("name", "queued", "succeeded", "failed", "errors", "started", "finished")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queued = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    def summary(self) -> str:
+        elapsed = (self.finished or time.monotonic()) - self.started
+        return (
+            f"{self.name}: поставлено {self.queued}, доставлено {self.succeeded}, "
+            f"не доставлено {self.failed}, ошибок подготовки {self.errors}, {elapsed:.1f} с"
+        )
 
-    if has_sent_reminder_today(chat_id, "reminder"):
-        return
 
-    if not has_joy_for_date(chat_id, today):
-        send_message(
-            chat_id,
-            random.choice(REMINDER_TEXTS),
-            human_delay=False
-        )
-        mark_reminder_sent(chat_id, "reminder")
+class FanoutExecutor:
+    """
+    Параллельная рассылка с ограничением "в полёте" (concurrency):
+    сообщения уходят через OUTBOUND (несколько отправщиков, лимиты Telegram),
+    ошибка одного пользователя не мешает остальным, прогресс печатается
+    каждые progress_every результатов. Отметка в sent_reminders ставится
+    только после успешной доставки — пачками, одной транзакцией.
+    """
 
+    def __init__(self, concurrency: int = FANOUT_CONCURRENCY,
+                 progress_every: int = FANOUT_PROGRESS_EVERY):
+        self.concurrency = concurrency
+        self.progress_every = progress_every
 
+    def run(self, name: str, reminder_type: str,
+            plan: Iterable[List[Tuple[int, date, object]]], render) -> FanoutRun:
+        """
+        plan — пачки [(chat_id, местный день, данные)], render(chat_id, данные) -> текст.
+        Возвращает итоги рассылки.
+        """
+        run = FanoutRun(name)
+        cond = threading.Condition()
+        state = {"inflight": 0, "done": 0}
+        delivered: List[Tuple[int, date]] = []
+
+        def make_on_done(day: date):
+            def on_done(chat_id: int, result: str):
+                with cond:
+                    state["inflight"] -= 1
+                    state["done"] += 1
+                    if result == SEND_OK:
+                        run.succeeded += 1
+                        delivered.append((chat_id, day))
+                    else:
+                        run.failed += 1
+                    if self.progress_every and state["done"] % self.progress_every == 0:
+                        print(f"{name}: обработано {state['done']} (ок {run.succeeded}, ошибок {run.failed})")
+                    cond.notify_all()
+            return on_done
+
+        def flush_delivered():
+            with cond:
+                entries = delivered[:]
+                delivered.clear()
+            try:
+                mark_reminders_sent(entries, reminder_type)
+            except Exception as e:
+                print(f"{name}: не удалось отметить доставку: {e}")
+
+        for chunk in plan:
+            for chat_id, day, payload in chunk:
+                try:
+                    text = render(chat_id, payload)
+                except Exception as e:
+                    run.errors += 1
+                    print(f"Ошибка при подготовке {name} для пользователя {chat_id}: {e}")
+                    continue
 
-def send_daily_report(chat_id: int):
-    today = today_minsk()
+                with cond:
+                    while state["inflight"] >= self.concurrency:
+                        cond.wait()
+                    state["inflight"] += 1
+                try:
+                    send_message(chat_id, text, human_delay=False, on_done=make_on_done(day))
+                    run.queued += 1
+                except Exception as e:
+                    with cond:
+                        state["inflight"] -= 1
+                    run.errors += 1
+                    print(f"Ошибка при отправке {name} пользователю {chat_id}: {e}")
+            flush_delivered()
 
-    if has_sent_reminder_today(chat_id, "report"):
-        return
+        with cond:
+            while state["inflight"]:
+                cond.wait()
+        flush_delivered()
 
-    joys = get_todays_joys(chat_id)
-
-    if joys:
-        report_headers = [
-            "Ну что, подведем итоги дня. Знаешь, день сопротивлялся, но ты была сильнее!\nИ вот доказательства:\n",
-            "День думал, что он обычный. Ошибся!\nВот твои радости за сегодня:\n",
-            "Ты сегодня явно играла на стороне хорошего!\nВот твой выигрыш:\n",
-            "Сегодняшний улов.\nПосмотри, сколько хорошего произошло за сегодня:\n",
-            "У сегодняшнего дня отличная статистика!\nТвои радости за сегодня:\n",
-            "День завершён, детка!\nВот твои успехи. И не спорь😊\n",
-            "День подошел к концу! И знаешь что?\nТы справилась лучше, чем думаешь. Вот твои маленькие победы — сияют и радуют😊\n",
-        ]
-        intro = random.choice(report_headers)
-        report = f"{random.choice(JOY_EMOJIS)} {intro}\n\n"
-        for i, joy in enumerate(joys, 1):
-            report += f"{i}. {joy}\n"
-        report += "\nСпокойной ночи!"
-    else:
-        report = f"{random.choice(CALM_EMOJIS)} День подошёл к концу. Завтра будет новый шанс!"
+        run.finished = time.monotonic()
+        if run.queued or run.errors:
+            print(run.summary())
+        return run
+
+
+FANOUT = FanoutExecutor()
+
+
+def _render_delivery(kind: str, payload) -> str:
+    if kind == "reminder":
+        return random.choice(responses("reminder"))
+    return build_daily_report(payload)
+
+
+def run_delivery_fanout(kind: str, now: Optional[datetime] = None) -> FanoutRun:
+    """
+    Рассылка kind (напоминание или отчёт) всем, у кого подошло их время:
+    отправка, затем перенос next_<kind>_at на следующий день.
+    """
+    now = now or utc_now()
+    advance: List[Tuple[int, str, str]] = []
+    run = FANOUT.run(
+        kind, kind, iter_due_plan(kind, now, advance),
+        lambda chat_id, payload: _render_delivery(kind, payload),
+    )
+    advance_deliveries(kind, advance)
+    return run
+
+
+class DeliveryScheduler:
+    """
+    Планировщик по дедлайнам: у каждого пользователя в user_settings лежат
+    ближайшие моменты напоминания и отчёта (UTC, со сдвигом внутри окна),
+    поток спит до самого раннего из них (MIN по индексу) и рассылает всем,
+    чьё время подошло. Пропущенные при простое доставки догоняются,
+    пока не вышел их срок (UserSettings.deadline). Смена настроек
+    будит поток через wake(). Повторная отправка исключена отметками
+    в sent_reminders.
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._wake = threading.Event()
 
-    send_message(chat_id, report, human_delay=False)
-    mark_reminder_sent(chat_id, "report")
+    def upcoming(self, limit: int = 5) -> List[Tuple[datetime, str, int]]:
+        """Ближайшие доставки: [(когда UTC, тип, chat_id)]."""
+        return get_upcoming_deliveries(limit)
+
+    def wake(self):
+        """Пересчитать время сна (например, после смены настроек)."""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def tick(self, now: Optional[datetime] = None):
+        """Одна итерация: рассылает всё, что уже наступило."""
+        now = now or utc_now()
+        for kind in DELIVERY_KINDS:
+            try:
+                run_delivery_fanout(kind, now)
+            except Exception as e:
+                print(f"Ошибка в рассылке {kind}: {e}")
+
+    def run(self):
+        upcoming = self.upcoming()
+        if upcoming:
+            print("Ближайшие доставки:", ", ".join(
+                f"{kind} {chat_id} {at:%d.%m %H:%M} UTC" for at, kind, chat_id in upcoming
+            ))
+
+        while not self._stop.is_set():
+            self._wake.clear()
+            self.tick()
+
+            next_at = next_delivery_at()
+            delay = SCHEDULER_MAX_SLEEP
+            if next_at is not None:
+                # не меньше секунды, если что-то ещё ждёт (например, не сдвинулось из-за ошибки)
+                delay = min(max((next_at - utc_now()).total_seconds(), 1), SCHEDULER_MAX_SLEEP)
+            self._wake.wait(delay)
+
+
+DELIVERY_SCHEDULER = DeliveryScheduler()
 
 
 def daily_scheduler():
     """Отдельный поток для ежедневных напоминаний и отчётов."""
-    last_reminder_day = None
-    last_report_day = None
+    DELIVERY_SCHEDULER.run()
 
-    while True:
-        now = now_minsk()
-        today = now.date()
-
-        # Напоминание в 20:00 (Минск)
-        if now.hour == 20 and now.minute == 0:
-            if last_reminder_day != today:
-                print(f"Отправляем напоминания в {now}")
-                for user_id in get_all_user_ids():
-                    try:
-                        send_reminder(user_id)
-                    except Exception as e:
-                        print(f"Ошибка при отправке напоминания пользователю {user_id}: {e}")
-                last_reminder_day = today
-                time.sleep(61)
-            else:
-                time.sleep(30)
 
-        # Отчёт в 22:00 (Минск)
-        elif now.hour == 22 and now.minute == 0:
-            if last_report_day != today:
-                print(f"Отправляем отчёты в {now}")
-                for user_id in get_all_user_ids():
-                    try:
-                        send_daily_report(user_id)
-                    except Exception as e:
-                        print(f"Ошибка при отправке отчёта пользователю {user_id}: {e}")
-                last_report_day = today
-                time.sleep(61)
-            else:
-                time.sleep(30)
+def handle_callback_query(query: dict):
+    """Нажатие inline-кнопки: сейчас это только листание отчёта wantnow."""
+    message = query.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id")
+    data = query.get("data") or ""
+    if query.get("id") and chat_id:
+        answer_callback(chat_id, query["id"])
+    if chat_id and data.startswith(WANTNOW_CALLBACK_PREFIX):
+        handle_wantnow_callback(chat_id, data)
+
+
+def handle_update(update: dict):
+    """Разбирает один update Telegram и передаёт текст в handle_message."""
+    if "callback_query" in update:
+        handle_callback_query(update["callback_query"])
+        return
+    if "message" not in update:
+        return
+    msg = update["message"]
+    chat = msg.get("chat") or {}
+    chat_id = chat.get("id")
+    text = msg.get("text", "")
+
+    if chat_id and text is not None:
+        print(f"Обрабатываем сообщение {update.get('update_id')}: '{text[:50]}...'")
+        handle_message(chat_id, text)
+
+
+class ChatDispatcher:
+    """
+    Параллельная обработка по чатам: chat_id хешируется на один из
+    фиксированных воркеров, у каждого своя очередь. Сообщения одного чата
+    всегда попадают к одному воркеру и идут строго по порядку (диалог
+    письма видит их последовательно), разные чаты — параллельно.
+    Очереди ограничены: когда воркер не успевает, submit ждёт (backpressure).
+    """
+
+    def __init__(self, workers: int = DISPATCH_WORKERS, queue_size: int = DISPATCH_QUEUE_SIZE):
+        self._queues: List["queue.Queue"] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads: List[Optional[threading.Thread]] = [None] * workers
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self, index: int):
+        thread = self._threads[index]
+        if thread is not None and thread.is_alive():
+            return
+        with self._lock:
+            thread = self._threads[index]
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self._run, args=(index,), name=f"dispatch-{index}", daemon=True)
+                self._threads[index] = thread
+                thread.start()
+
+    def submit(self, chat_id: int, fn, *args) -> threading.Event:
+        """Ставит fn(*args) в очередь воркера чата. Event взводится после выполнения."""
+        index = hash(chat_id) % len(self._queues)
+        self._ensure_worker(index)
+        done = threading.Event()
+        self._queues[index].put((fn, args, done))  # ждёт, если очередь полна
+        return done
+
+    def _run(self, index: int):
+        q = self._queues[index]
+        while True:
+            item = q.get()
+            try:
+                if item is None:
+                    return
+                fn, args, done = item
+                try:
+                    fn(*args)
+                except Exception as e:
+                    print(f"Ошибка в обработчике: {e}")
+                finally:
+                    done.set()
+            finally:
+                q.task_done()
+
+    def drain(self, timeout: float = 10.0) -> bool:
+        """Ждёт, пока все очереди опустеют. True — всё обработано."""
+        deadline = time.monotonic() + timeout
+        for q in self._queues:
+            while q.unfinished_tasks:
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.05)
+        return True
+
+    def stop(self, timeout: float = 10.0) -> bool:
+        """Дорабатывает уже принятое и останавливает воркеры."""
+        drained = self.drain(timeout)
+        for index, thread in enumerate(self._threads):
+            if thread is not None and thread.is_alive():
+                self._queues[index].put(None)
+        for thread in self._threads:
+            if thread is not None:
+                thread.join(timeout)
+        self._threads = [None] * len(self._queues)
+        return drained
+
+
+DISPATCHER = ChatDispatcher()
+
+
+def _update_chat_id(update: dict) -> int:
+    if "callback_query" in update:
+        message = update["callback_query"].get("message") or {}
+    else:
+        message = update.get("message") or {}
+    return (message.get("chat") or {}).get("id") or 0
 
+
+def dispatch_update(update: dict, results: Dict[int, bool]):
+    """
+    Обработка одного update в воркере. Записи обработчика копятся
+    и коммитятся одним куском вместе с отметкой update_id (commit_update),
+    в группе с другими update. Ответы отправляются только после коммита;
+    если update уже был обработан (повторная доставка) — ни записей,
+    ни ответов. results[update_id] — True, если update завершён.
+    """
+    update_id = update.get("update_id")
+    results[update_id] = False
+    with deferred_sends() as outbox, update_writes(update_id) as unit:
+        try:
+            handle_update(update)
+        except Exception as e:
+            print(f"Ошибка при обработке update {update_id}: {e}")
+            return
+    try:
+        fresh = commit_update(unit)
+    except Exception as e:
+        print(f"Update {update_id}: запись не удалась, ответ не отправляем: {e}")
+        return
+    results[update_id] = True
+    if not fresh:
+        print(f"Update {update_id} уже обработан, ответ не отправляем")
+        return
+
+    for chat_id, text, human_delay, reply_markup in outbox:
+        send_message(chat_id, text, human_delay=human_delay, reply_markup=reply_markup)
+
+
+def process_update_batch(updates: List[dict]) -> List[dict]:
+    """
+    Обрабатывает батч getUpdates: дедупликация, параллельная обработка
+    по чатам (ChatDispatcher), затем сдвиг offset. Каждый update коммитится
+    вместе со своей отметкой в processed_updates, а watermark проходит только
+    по завершённым update: упавший update задерживает его, пока не будет
+    обработан повторно или не исчерпает UPDATE_MAX_ATTEMPTS попыток.
+    Возвращает упавшие update, которые стоит обработать снова
+    (long polling получит их и так — от watermark).
+    """
+    batch_max = max((u.get("update_id") or 0 for u in updates), default=0)
+    results: Dict[int, bool] = {}
+    pending: List[threading.Event] = []
+    submitted: List[dict] = []
+
+    for update in updates:
+        update_id = update.get("update_id")
+        if update_id is None:
+            continue
+
+        # Помечаем update как взятый в работу. Если не получилось — уже обработан.
+        if not mark_update_processed(update_id):
+            print(f"Update {update_id} уже обработан, пропускаем")
+            UPDATE_DEDUP.release(update_id)
+            continue
+        submitted.append(update)
+        pending.append(DISPATCHER.submit(_update_chat_id(update), dispatch_update, update, results))
+
+    for done in pending:
+        done.wait()
+
+    retry: List[dict] = []
+    for update in submitted:
+        update_id = update["update_id"]
+        if results.get(update_id):
+            UPDATE_DEDUP.release(update_id)
+        elif UPDATE_DEDUP.failed(update_id):
+            retry.append(update)
         else:
-            time.sleep(30)
+            print(f"Update {update_id} не удалось обработать за {UPDATE_MAX_ATTEMPTS} попыток, пропускаем")
+
+    # offset двигаем и для дублей, иначе Telegram пришлёт их снова
+    if batch_max:
+        UPDATE_DEDUP.advance(batch_max)
+
+    return retry
 
 
 def main_loop():
     """Основной цикл обработки сообщений."""
-    last_update_id = 0
-
+    # После webhook-режима getUpdates отвечает 409, пока webhook не снят
+    if not delete_webhook():
+        print("Не удалось снять webhook — getUpdates может не работать")
     while True:
         try:
+            # offset хранится в БД — после рестарта Telegram не пришлёт старое
+            last_update_id = UPDATE_DEDUP.current()
             updates = get_updates(last_update_id + 1 if last_update_id else None, POLL_TIMEOUT)
 
-            for update in updates:
-                update_id = update.get("update_id")
-                if update_id is None:
-                    continue
+            if updates:
+                process_update_batch(updates)
+            else:
+                # пустой ответ — таймаут long polling или ошибка сети
+                time.sleep(POLL_SLEEP)
 
-                # Помечаем update как новый. Если не получилось — уже обработан.
-                if not mark_update_processed(update_id):
-                    print(f"Update {update_id} уже обработан, пропускаем")
-                    continue
+        except Exception as e:
+            print(f"Ошибка в основном цикле: {e}")
+            time.sleep(POLL_SLEEP)
 
-                if update_id > last_update_id:
-                    last_update_id = update_id
+# --------------------------
+# Webhook
+# --------------------------
 
-                # Обрабатываем сообщение
-                if "message" in update:
-                    msg = update["message"]
-                    chat = msg.get("chat") or {}
-                    chat_id = chat.get("id")
-                    text = msg.get("text", "")
+class _WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает POST от Telegram: проверка секрета, сразу 200, update — в очередь."""
+
+    server_version = "chudomoodo"
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, status: int, body: bytes = b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def do_POST(self):
+        server: "WebhookServer" = self.server.webhook
+        # Тело этих запросов не читаем — закрываем соединение, иначе
+        # непрочитанные байты станут началом следующего запроса keep-alive
+        if self.path.split("?", 1)[0] != server.path:
+            self.close_connection = True
+            self._reply(404)
+            return
+        if server.secret:
+            token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token.encode(), server.secret.encode()):
+                self.close_connection = True
+                self._reply(403)
+                return
 
-                    if chat_id and text is not None:
-                        print(f"Обрабатываем сообщение {update_id}: '{text[:50]}...'")
-                        handle_message(chat_id, text)
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+        except ValueError:
+            length = -1
+        if length <= 0 or length > WEBHOOK_MAX_BODY:
+            self.close_connection = True
+            self._reply(413 if length > WEBHOOK_MAX_BODY else 400)
+            return
+        try:
+            update = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._reply(400)
+            return
+        if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+            self._reply(400)
+            return
+
+        if not server.offer(update):
+            # очередь переполнена — Telegram повторит доставку позже
+            self._reply(503)
+            return
+        self._reply(200, b"ok")
+
+    def do_GET(self):
+        self._reply(404)
+
+    def log_message(self, format, *args):
+        pass
 
-            time.sleep(POLL_SLEEP)
 
-        except Exception as e:
-            print(f"Ошибка в основном цикле: {e}")
-            time.sleep(POLL_SLEEP)
+class WebhookServer:
+    """
+    Встроенный HTTP-сервер для webhook Telegram. Ответ отдаётся сразу после
+    постановки update в очередь; обработка — в отдельном потоке теми же
+    process_update_batch/handle_message, что и при long polling.
+    Бот работает одним экземпляром (дедупликация update и кеш dialog_state
+    живут в памяти процесса): за webhook стоит ровно один процесс.
+    """
+
+    def __init__(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret: str = WEBHOOK_SECRET, queue_size: int = WEBHOOK_QUEUE_SIZE):
+        self.path = path
+        self.secret = secret
+        self.updates: "queue.Queue[dict]" = queue.Queue(maxsize=queue_size)
+        self.received = 0
+        self.rejected = 0
+        self._httpd = ThreadingHTTPServer((host, port), _WebhookHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.webhook = self
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def offer(self, update: dict) -> bool:
+        try:
+            self.updates.put_nowait(update)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    def start(self):
+        for target, name in ((self._httpd.serve_forever, "webhook-http"), (self._consume, "webhook-worker")):
+            t = threading.Thread(target=target, name=name, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def _next_batch(self) -> List[dict]:
+        try:
+            batch = [self.updates.get(timeout=1)]
+        except queue.Empty:
+            return []
+        while len(batch) < WEBHOOK_BATCH_MAX:
+            try:
+                batch.append(self.updates.get_nowait())
+            except queue.Empty:
+                break
+        batch.sort(key=lambda u: u["update_id"])
+        return batch
+
+    def _consume(self):
+        while not (self._stop.is_set() and self.updates.empty()):
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                retry = process_update_batch(batch)
+            except Exception as e:
+                print(f"Ошибка при обработке webhook-батча: {e}")
+                retry = []
+            finally:
+                for _ in batch:
+                    self.updates.task_done()
+            # Telegram уже получил 200 и сам не повторит — возвращаем в очередь
+            for update in retry:
+                try:
+                    self.updates.put_nowait(update)
+                except queue.Full:
+                    print(f"Очередь webhook переполнена, update {update['update_id']} не будет повторён")
+                    UPDATE_DEDUP.release(update["update_id"])
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Ждёт обработки всего, что уже принято. True — очередь пуста."""
+        deadline = time.monotonic() + (timeout if timeout is not None else 1e9)
+        while self.updates.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stop(self, timeout: float = 10.0):
+        """Перестаёт принимать запросы и дорабатывает очередь."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self.join(timeout)
+        self._stop.set()
+
+
+def set_webhook(url: str, secret: str) -> bool:
+    """Регистрирует webhook у Telegram (updates перестанут приходить в getUpdates)."""
+    payload = {
+        "url": url,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        "allowed_updates": ["message", "callback_query"],
+    }
+    if secret:
+        payload["secret_token"] = secret
+    result, _ = _telegram_send("setWebhook", payload, HTTP_SEND_READ_TIMEOUT)
+    return result == SEND_OK
+
+
+def delete_webhook() -> bool:
+    """Снимает webhook, чтобы снова работал getUpdates."""
+    result, _ = _telegram_send("deleteWebhook", {}, HTTP_SEND_READ_TIMEOUT)
+    return result == SEND_OK
+
+
+def webhook_loop():
+    """Webhook-режим: сервер принимает updates, основной поток просто ждёт."""
+    secret = WEBHOOK_SECRET
+    if WEBHOOK_URL:
+        secret = secret or secrets.token_urlsafe(32)
+        if not set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret):
+            raise RuntimeError("Не удалось зарегистрировать webhook")
+    elif not secret:
+        print("Внимание: WEBHOOK_SECRET не задан — заголовок секрета не проверяется")
+
+    server = WebhookServer(secret=secret)
+    server.start()
+    print(f"Webhook слушает {WEBHOOK_HOST}:{server.port}{WEBHOOK_PATH}")
+    try:
+        while True:
+            time.sleep(60)
+    finally:
+        server.stop()
+
+# --------------------------
+# Переразметка радостей (reanalyze)
+# --------------------------
+
+REANALYZE_CHUNK = 2000
+REANALYZE_CURSOR_KEY = "reanalyze_cursor"
+
+
+def _reanalyze_cursor(version: str) -> int:
+    """
+    Сохранённый курсор ("версия словарей:id"). Курсор от другой версии
+    словарей не годится — строки до него размечены старыми словарями,
+    поэтому начинаем сначала.
+    """
+    stored = get_bot_state(REANALYZE_CURSOR_KEY) or ""
+    stored_version, _, cursor_id = stored.rpartition(":")
+    if stored_version != version or not cursor_id.isdigit():
+        return 0
+    return int(cursor_id)
+
+
+def _reanalyze_rows(rows: List[Tuple[int, str]]) -> Tuple[str, List[Tuple[int, Optional[str], int]]]:
+    """
+    Воркер пула процессов: для пачки (id, text) возвращает версию словарей
+    и список (id, новый текст или None, если не изменился, метки).
+    Текст переписывается, только если в нём замаскирован мат; пробелы
+    и переносы строк остаются как были. Чистая функция — без БД.
+    """
+    lexicon = LEXICON
+    result = []
+    for joy_id, text in rows:
+        new_text = mask_profanity_in_place(text)
+        result.append((joy_id, new_text, classify_joy(new_text or text, lexicon)))
+    return lexicon.version, result
+
+
+def _iter_reanalyze_chunks(start_id: int, chunk: int, only_stale: bool) -> Iterator[List[Tuple[int, str]]]:
+    """Строки joys пачками по id-курсору (в памяти — только текущая пачка)."""
+    cur = db_connect().cursor()
+    stale = "AND (lexicon_version IS NULL OR lexicon_version != :version)" if only_stale else ""
+    last_id = start_id
+    while True:
+        cur.execute(
+            f"""
+            SELECT id, text FROM joys
+            WHERE id > :last_id {stale}
+            ORDER BY id
+            LIMIT :limit
+            """,
+            {"last_id": last_id, "version": LEXICON.version, "limit": chunk},
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _write_reanalyzed(batch: Tuple[str, List[Tuple[int, Optional[str], int]]],
+                      cursor_id: int) -> Tuple[int, int]:
+    """Пишет пачку и курсор одной транзакцией. Возвращает (изменено текстов, всего строк)."""
+    version, results = batch
+    cur = db_connect().cursor()
+    changed = [(text, joy_id) for joy_id, text, _ in results if text is not None]
+    with db_transaction():
+        if changed:
+            cur.executemany("UPDATE joys SET text = ? WHERE id = ?", changed)
+        cur.executemany(
+            "UPDATE joys SET flags = ?, lexicon_version = ? WHERE id = ?",
+            [(flags, version, joy_id) for joy_id, _, flags in results],
+        )
+        set_bot_state(REANALYZE_CURSOR_KEY, f"{version}:{cursor_id}")
+    return len(changed), len(results)
+
+
+def reanalyze_joys(workers: Optional[int] = None, chunk: int = REANALYZE_CHUNK,
+                   only_stale: bool = True, restart: bool = False) -> Dict[str, float]:
+    """
+    Перепроверяет записанные радости текущими словарями: маскирует мат
+    (mask_profanity_in_place) и пересчитывает метки. Таблица читается пачками
+    по id, пачки обрабатываются в пуле процессов (workers=0 — в этом
+    процессе), результаты пишутся по порядку, каждая пачка — транзакцией
+    вместе с курсором в bot_state: прерванный запуск продолжается с места
+    остановки, если словари с тех пор не менялись. only_stale — только
+    строки с другой версией словарей.
+    """
+    start_id = 0 if restart else _reanalyze_cursor(LEXICON.version)
+    cur = db_connect().cursor()
+    cur.execute("SELECT MAX(id) FROM joys")
+    max_id = cur.fetchone()[0] or 0
+    if start_id:
+        print(f"Продолжаем с id {start_id} из {max_id}")
+
+    stats = {"rows": 0, "changed": 0, "chunks": 0}
+    started = time.monotonic()
+
+    def record(batch: Tuple[str, List[Tuple[int, Optional[str], int]]], last_id: int):
+        changed, rows = _write_reanalyzed(batch, last_id)
+        stats["rows"] += rows
+        stats["changed"] += changed
+        stats["chunks"] += 1
+        elapsed = max(time.monotonic() - started, 1e-6)
+        print(
+            f"reanalyze: id {last_id}/{max_id} ({last_id * 100 // max(max_id, 1)}%), "
+            f"строк {stats['rows']}, текстов изменено {stats['changed']}, {stats['rows'] / elapsed:.0f} строк/с"
+        )
+
+    chunks = _iter_reanalyze_chunks(start_id, chunk, only_stale)
+    if workers == 0:
+        for rows in chunks:
+            record(_reanalyze_rows(rows), rows[-1][0])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # В полёте не больше 2 пачек на процесс; пишем строго по порядку,
+            # чтобы курсор не обгонял незаписанные пачки
+            max_inflight = 2 * (workers or os.cpu_count() or 1)
+            inflight: deque = deque()
+            for rows in chunks:
+                inflight.append((pool.submit(_reanalyze_rows, rows), rows[-1][0]))
+                if len(inflight) >= max_inflight:
+                    future, last_id = inflight.popleft()
+                    record(future.result(), last_id)
+            while inflight:
+                future, last_id = inflight.popleft()
+                record(future.result(), last_id)
+
+    # Прошли до конца — следующий запуск начнёт сначала
+    set_bot_state(REANALYZE_CURSOR_KEY, f"{LEXICON.version}:0")
+    stats["seconds"] = time.monotonic() - started
+    return stats
 
 # --------------------------
 # MAIN
 # --------------------------
 
-def main():
-    print("Запускаем бота...")
+def _format_stats(stats: Dict[str, int]) -> str:
+    return ", ".join(f"{key}={value}" for key, value in stats.items())
+
+
+def stats_logger():
+    """Фоновый поток: раз в STATS_LOG_INTERVAL печатает метрики очереди и кешей."""
+    while True:
+        time.sleep(STATS_LOG_INTERVAL)
+        print(
+            f"[stats] outbound: {_format_stats(OUTBOUND.stats())}; "
+            f"dialog_cache: {_format_stats(DIALOG_CACHE.stats())}; "
+            f"sessions: {_format_stats(SESSIONS.stats())}; "
+            f"normalize_cache: {_format_stats(_NORMALIZE_CACHE.stats())}"
+        )
+
+
+def main(mode: str = "polling"):
+    print(f"Запускаем бота ({mode})...")
     init_db()
+    warm_dialog_state_cache()
 
     scheduler_thread = threading.Thread(target=daily_scheduler, daemon=True)
     scheduler_thread.start()
 
-    main_loop()
+    pruner_thread = threading.Thread(target=processed_updates_pruner, daemon=True)
+    pruner_thread.start()
+
+    stats_thread = threading.Thread(target=stats_logger, daemon=True)
+    stats_thread.start()
+
+    lexicon_thread = threading.Thread(target=lexicon_watcher, daemon=True)
+    lexicon_thread.start()
+
+    try:
+        if mode == "webhook":
+            webhook_loop()
+        else:
+            main_loop()
+    finally:
+        DISPATCHER.stop()
+        DB_WRITER.flush()
+        OUTBOUND.drain()
+        close_http_sessions()
+        close_db_connections()
+
+
+def cli(argv: List[str]):
+    """
+    python chudomoodo_bot.py                — запустить бота (long polling);
+    python chudomoodo_bot.py webhook        — запустить бота с webhook-сервером;
+    python chudomoodo_bot.py rebuild-stats  — пересчитать агрегаты /stats;
+    python chudomoodo_bot.py reanalyze [--all] [--restart] [--workers N] [--chunk N]
+                                            — перепроверить радости текущими словарями.
+    """
+    command = argv[0] if argv else ""
+    if not command:
+        main()
+    elif command == "webhook":
+        main("webhook")
+    elif command == "rebuild-stats":
+        init_db()
+        started = time.monotonic()
+        rebuilt = rebuild_joy_stats()
+        print(f"Агрегаты пересчитаны для {rebuilt} пользователей за {time.monotonic() - started:.1f} с")
+        close_db_connections()
+    elif command == "reanalyze":
+        parser = argparse.ArgumentParser(prog="chudomoodo_bot.py reanalyze")
+        parser.add_argument("--all", action="store_true", help="все строки, а не только с устаревшими метками")
+        parser.add_argument("--restart", action="store_true", help="начать сначала, а не с сохранённого места")
+        parser.add_argument("--workers", type=int, default=None, help="процессов (0 — без пула)")
+        parser.add_argument("--chunk", type=int, default=REANALYZE_CHUNK, help="строк в пачке")
+        args = parser.parse_args(argv[1:])
+        init_db(backfill_labels=False)
+        stats = reanalyze_joys(args.workers, args.chunk, only_stale=not args.all, restart=args.restart)
+        print(
+            f"Готово: строк {stats['rows']}, текстов изменено {stats['changed']}, "
+            f"{stats['seconds']:.1f} с ({stats['rows'] / max(stats['seconds'], 1e-6):.0f} строк/с)"
+        )
+        close_db_connections()
+    else:
+        print(cli.__doc__)
+        sys.exit(2)
 
 
 if __name__ == "__main__":
-    main()
+    cli(sys.argv[1:])
 
 
 